@@ -1,23 +1,122 @@
-import shutil, time, os
+import shutil, time, os, json
 from datetime import datetime
+from urllib import request as urlrequest
+import metrics
 
-DB_PATH = "/metadata/metadata.db"
 STORAGE_PATH = "/storage"
 BACKUP_PATH = "/backup"
+METADATA_API = os.environ.get("METADATA_API", "http://metadata:5001")  # the leader: snapshots are taken there
+STORAGE_API = os.environ.get("STORAGE_API", "http://storage:5002")  # the node to hold when no node is registered
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")  # metadata snapshots and storage holds need it
+HOLD_TTL = float(os.environ.get("BACKUP_HOLD_TTL", "7200"))  # removals resume after this even if the backup dies
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))  # port of the /metrics sidecar
 
 os.makedirs(BACKUP_PATH, exist_ok=True)
 
+BACKUP_DURATION = metrics.histogram("backup_duration_seconds", "Time taken by a full backup run", buckets=(1, 5, 15, 60, 300, 900, 1800, 3600))
+BACKUP_BYTES = metrics.counter("backup_bytes_copied_total", "Bytes copied into the backup volume", ["kind"])
+BACKUP_FILES = metrics.counter("backup_files_copied_total", "Files copied into the backup volume", ["kind"])
+BACKUP_RUNS = metrics.counter("backup_runs_total", "Backup runs", ["status"])
+BACKUP_LAST_SUCCESS = metrics.gauge("backup_last_success_timestamp_seconds", "Unix time of the last successful backup")
+BACKUP_LAST_SEQ = metrics.gauge("backup_last_metadata_seq", "Metadata change log position of the last successful backup")
+SNAPSHOT_PAUSE = metrics.gauge("backup_snapshot_pause_seconds", "How long metadata writers waited for the last backup's snapshot")
+
+# copy one file and count it towards the backup metrics
+def copy_counted(src, dst, kind="storage"):
+    try:
+        shutil.copy2(src, dst)
+    except FileNotFoundError:
+        return dst  # a temp file that went away while the tree was copied; held objects never do
+    BACKUP_BYTES.inc(os.path.getsize(dst), kind=kind)
+    BACKUP_FILES.inc(kind=kind)
+    return dst
+
+def call(method, url, body=None, timeout=30):
+    data = json.dumps(body).encode() if body is not None else None
+    headers = {"Content-Type": "application/json", "X-Admin-Token": ADMIN_TOKEN}
+    req = urlrequest.Request(url, data=data, method=method, headers=headers)
+    return urlrequest.urlopen(req, timeout=timeout)
+
+# Storage nodes from the metadata registry, as [(node id, url, state)]
+def storage_nodes():
+    with call("GET", f"{METADATA_API}/nodes") as r:
+        nodes = [(n["id"], n["url"], n.get("state")) for n in json.load(r)["nodes"] if n.get("url")]
+    return nodes or [("storage", STORAGE_API, "up")]
+
+# Hold removals on every storage node; returns [(url, hold id)] of the holds taken.
+# A node the registry has as down is skipped if it cannot be reached; any
+# other failure releases the holds already taken and fails the backup.
+def hold_nodes():
+    holds = []
+    for node_id, url, state in storage_nodes():
+        try:
+            with call("POST", f"{url}/backup/hold", {"ttl": HOLD_TTL}) as r:
+                holds.append((url, json.load(r)["hold_id"]))
+        except Exception as e:
+            if state == "down":
+                print(f"Backup hold on down node {node_id} failed, going on without it: {e}")
+                continue
+            release_nodes(holds)
+            raise RuntimeError(f"backup hold on node {node_id} failed: {e}") from e
+    return holds
+
+def release_nodes(holds):
+    for url, hold_id in holds:
+        try:
+            call("DELETE", f"{url}/backup/hold/{hold_id}").close()
+        except Exception as e:
+            print(f"Releasing backup hold on {url} failed (it expires by itself): {e}")
+
+# Save a metadata snapshot to dest; returns the X-Snapshot-* headers
+def save_snapshot(dest):
+    with call("POST", f"{METADATA_API}/snapshot", timeout=600) as r, open(dest + ".tmp", "wb") as f:
+        shutil.copyfileobj(r, f, 1024 * 1024)
+        headers = r.headers
+    os.replace(dest + ".tmp", dest)
+    BACKUP_BYTES.inc(os.path.getsize(dest), kind="metadata")
+    BACKUP_FILES.inc(kind="metadata")
+    return {
+        "seq": int(headers["X-Snapshot-Seq"]),
+        "cursor": headers["X-Snapshot-Cursor"],
+        "files": int(headers["X-Snapshot-Files"]),
+        "snapshot_seconds": float(headers["X-Snapshot-Seconds"]),
+        "writer_pause_seconds": float(headers["X-Snapshot-Pause"]),
+    }
+
+# A consistent backup: every storage node holds its removals, metadata is
+# snapshotted, then the volume is copied. Every object the snapshot names is
+# still there when the copy reaches it; objects added after the snapshot are
+# copied too and are orphans once restored.
 def backup():
+    if not ADMIN_TOKEN:
+        raise RuntimeError("ADMIN_TOKEN is not set; metadata and storage refuse backups without it")
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    # Backup database
-    if os.path.exists(DB_PATH):
-        shutil.copy(DB_PATH, os.path.join(BACKUP_PATH, f"metadata_{timestamp}.db"))
-    # Backup storage files
-    storage_backup = os.path.join(BACKUP_PATH, f"storage_{timestamp}")
-    shutil.copytree(STORAGE_PATH, storage_backup)
-    print(f"Backup completed at {timestamp}")
+    holds = hold_nodes()
+    try:
+        snapshot = f"metadata_{timestamp}.snapshot"
+        manifest = save_snapshot(os.path.join(BACKUP_PATH, snapshot))
+        storage_backup = f"storage_{timestamp}"
+        shutil.copytree(STORAGE_PATH, os.path.join(BACKUP_PATH, storage_backup), copy_function=copy_counted)
+    finally:
+        release_nodes(holds)
+    manifest.update(timestamp=timestamp, metadata=snapshot, storage=storage_backup)
+    with open(os.path.join(BACKUP_PATH, f"backup_{timestamp}.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    BACKUP_LAST_SEQ.set(manifest["seq"])
+    SNAPSHOT_PAUSE.set(manifest["writer_pause_seconds"])
+    print(f"Backup completed at {timestamp} (metadata at {manifest['cursor']}, "
+          f"{manifest['files']} files, writers paused {manifest['writer_pause_seconds'] * 1000:.1f} ms)")
 
 if __name__ == "__main__":
+    metrics.serve(METRICS_PORT)
     while True:
-        backup()
+        start = time.perf_counter()
+        try:
+            backup()
+            BACKUP_RUNS.inc(status="ok")
+            BACKUP_LAST_SUCCESS.set(time.time())
+        except Exception as e:
+            BACKUP_RUNS.inc(status="error")
+            print(f"Backup failed: {e}")
+        BACKUP_DURATION.observe(time.perf_counter() - start)
         time.sleep(3600)  # Run every hour
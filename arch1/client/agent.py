@@ -0,0 +1,265 @@
+"""Local agent that runs the CLI's HTTP requests for it.
+
+Every ``cli.py`` command otherwise starts Python, imports requests, reads
+the token file and opens new connections to the API, often for one small
+request. Started once with ``python agent.py &``, the agent keeps pooled
+keep-alive connections and the token (re-read when the token file
+changes), and the CLI sends it each request over a Unix socket instead.
+The CLI finds the agent at ``AGENT_SOCKET`` and does not import requests
+when it is there; without it the CLI works as before.
+
+Requests from concurrent CLI invocations run in parallel, at most
+``AGENT_WORKERS`` at a time; the rest wait their turn.
+
+Protocol, one request per connection: the client sends one JSON line
+(method, url, params, headers, json, data, files as local paths, a
+directory to send as a tar stream, timeout); the agent answers with one
+JSON line (status and headers, or error) followed by the response body as
+it arrives.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+
+AGENT_SOCKET = os.environ.get("AGENT_SOCKET", os.path.expanduser("~/.mini_dropbox_agent.sock"))
+TOKEN_FILE = os.path.expanduser("~/.mini_dropbox_token")
+WORKERS = int(os.environ.get("AGENT_WORKERS", "8"))  # requests sent to the API at once
+CHUNK_SIZE = 64 * 1024
+
+
+# ---------------- Client side (used by cli.py) ----------------
+class Headers(dict):
+    """Response headers with case-insensitive lookup, like requests'."""
+
+    def __init__(self, headers):
+        super().__init__((k.lower(), v) for k, v in headers.items())
+
+    def get(self, key, default=None):
+        return super().get(key.lower(), default)
+
+    def __getitem__(self, key):
+        return super().__getitem__(key.lower())
+
+    def __contains__(self, key):
+        return super().__contains__(key.lower())
+
+
+class AgentResponse:
+    """The parts of requests.Response the CLI uses, read from the agent's socket."""
+
+    def __init__(self, sock, rfile, head):
+        self.sock = sock
+        self.rfile = rfile
+        self.status_code = head["status"]
+        self.headers = Headers(head["headers"])
+        self._content = None
+
+    def iter_content(self, chunk_size=CHUNK_SIZE):
+        if self._content is not None:
+            yield self._content
+            return
+        try:
+            while True:
+                chunk = self.rfile.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b"".join(self.iter_content())
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+class AgentClient:
+    def __init__(self, path):
+        self.path = path
+
+    def request(self, method, url, params=None, headers=None, json=None, data=None, files=None,
+                stream=False, timeout=None):
+        # files are sent by path; the agent opens them itself
+        paths = [(field, os.path.abspath(f.name)) for field, f in files or []]
+        for _, f in files or []:
+            f.close()
+        archive = None
+        if data is not None and not isinstance(data, (str, bytes, dict)):
+            import tarstream
+
+            if isinstance(data, tarstream.TarStream):
+                # like files: the agent reads the tree itself and builds the tar as it sends
+                archive, data = {"root": data.root, "compress": data.compress}, None
+        req = {"method": method, "url": url, "params": params, "headers": headers or {}, "json": json,
+               "data": data, "files": paths, "archive": archive, "timeout": timeout}
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            sock.sendall(_dumps(req))
+            rfile = sock.makefile("rb")
+            head = _loads(rfile.readline())
+        except Exception:
+            sock.close()
+            raise
+        if "error" in head:
+            sock.close()
+            raise ConnectionError(head["error"])
+        resp = AgentResponse(sock, rfile, head)
+        if not stream:
+            resp.content  # read it all now, as requests does
+        return resp
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+
+def connect(path=AGENT_SOCKET):
+    """An AgentClient if an agent is listening at ``path``, else None."""
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        return None  # stale socket file from an agent that exited
+    finally:
+        sock.close()
+    return AgentClient(path)
+
+
+def _dumps(obj):
+    return json.dumps(obj).encode() + b"\n"
+
+
+def _loads(line):
+    if not line:
+        raise ConnectionError("agent closed the connection")
+    return json.loads(line)
+
+
+# ---------------- Agent side ----------------
+class Token:
+    """The saved login token, re-read only when the file changes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.value = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if mtime != self.mtime:
+                with open(self.path) as f:
+                    self.value = f.read().strip()
+                self.mtime = mtime
+            return self.value
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        line = self.rfile.readline()
+        if not line:
+            return  # a CLI checking that the agent is up
+        req = json.loads(line)
+        headers = req["headers"]
+        token = server.token.get()
+        if token and "Authorization" not in headers:
+            headers["Authorization"] = f"Bearer {token}"
+        files = [(field, open(path, "rb")) for field, path in req["files"]]
+        data = req["data"]
+        if req.get("archive"):
+            import tarstream
+
+            data = tarstream.TarStream(req["archive"]["root"], req["archive"]["compress"])
+        try:
+            with server.slots:
+                try:
+                    resp = server.session.request(req["method"], req["url"], params=req["params"], headers=headers,
+                                                  json=req["json"], data=data, files=files or None,
+                                                  stream=True, timeout=req["timeout"])
+                except Exception as e:
+                    self.wfile.write(_dumps({"error": str(e)}))
+                    return
+                try:
+                    self.wfile.write(_dumps({"status": resp.status_code, "headers": dict(resp.headers)}))
+                    for chunk in resp.iter_content(CHUNK_SIZE):
+                        self.wfile.write(chunk)
+                finally:
+                    resp.close()
+        finally:
+            for _, f in files:
+                f.close()
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, workers):
+        import requests  # only the agent pays for this import
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.token = Token(TOKEN_FILE)
+        self.slots = threading.BoundedSemaphore(workers)
+        if connect(path) is not None:
+            raise SystemExit(f"an agent is already listening on {path}")
+        if os.path.exists(path):
+            os.unlink(path)
+        old_umask = os.umask(0o077)  # the socket sends requests with the user's token
+        try:
+            super().__init__(path, Handler)
+        finally:
+            os.umask(old_umask)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mini-Dropbox CLI agent")
+    parser.add_argument("--socket", default=AGENT_SOCKET, help="Unix socket to listen on (AGENT_SOCKET)")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Requests sent to the API at once")
+    args = parser.parse_args()
+
+    server = AgentServer(args.socket, args.workers)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # clean up the socket on kill too
+    print(f"Agent listening on {args.socket} ({args.workers} workers)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
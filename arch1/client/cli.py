@@ -1,6 +1,10 @@
 import argparse
+import datetime
+import json
 import os
-import requests
+import time
+import uuid
+import agent
 
 # api url for the services
 API_URL = os.environ.get("API_URL", "http://services:5000")
@@ -8,6 +12,17 @@ API_URL = os.environ.get("API_URL", "http://services:5000")
 # token file to store JWT token
 TOKEN_FILE = os.path.expanduser("~/.mini_dropbox_token")
 
+# metadata log position of the last upload or delete, sent with later requests
+# so they see it even when reads are served by a metadata follower
+SEQ_FILE = os.path.expanduser("~/.mini_dropbox_seq")
+SEQ_HEADER = "X-Metadata-Seq"
+
+# spans written by the services (shared trace volume)
+TRACE_FILE = os.environ.get("TRACE_FILE", "/traces/spans.jsonl")
+
+# headers sent with every request - filled in by main() when --trace is used
+TRACE_HEADERS = {}
+
 # saving the token into the TOKEN_FILE
 def save_token(token):
     with open(TOKEN_FILE, "w") as f:
@@ -20,21 +35,56 @@ def load_token():
             return f.read().strip()
     return None
 
+# remember the log position a write answered with
+def save_seq(resp):
+    seq = resp.headers.get(SEQ_HEADER)
+    if seq:
+        with open(SEQ_FILE, "w") as f:
+            f.write(seq)
+
+# sends the requests: the agent when one is running (see agent.py), otherwise a
+# requests session of our own. requests is imported only then; the import
+# alone takes longer than most commands.
+_http = None
+
+def http():
+    global _http
+    if _http is None:
+        _http = agent.connect()
+        if _http is None:
+            import requests
+            _http = requests.Session()
+    return _http
+
+# request headers: trace headers, the bearer token when logged in, and the last write's position
+def auth_headers():
+    headers = dict(TRACE_HEADERS)
+    # the agent keeps the token and adds it itself
+    token = load_token() if not isinstance(http(), agent.AgentClient) else None
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    if os.path.exists(SEQ_FILE):
+        with open(SEQ_FILE) as f:
+            headers[SEQ_HEADER] = f.read().strip()
+    return headers
+
 # create a post request to sign up user
 def signup(args):
     username = args.username
     password = args.password
-    resp = requests.post(f"{API_URL}/auth/signup", json={"username": username, "password": password})
+    resp = http().post(f"{API_URL}/auth/signup", json={"username": username, "password": password}, headers=dict(TRACE_HEADERS))
     print(resp.json())
 
 # create a post request to log in user and save the token
 def login(args):
     username = args.username
     password = args.password
-    resp = requests.post(f"{API_URL}/auth/login", json={"username": username, "password": password})
+    resp = http().post(f"{API_URL}/auth/login", json={"username": username, "password": password}, headers=dict(TRACE_HEADERS))
     data = resp.json()
     if "token" in data:
         save_token(data["token"])
+        if os.path.exists(SEQ_FILE):
+            os.remove(SEQ_FILE)  # a new session starts from whatever metadata has now
         print("Login successful!")
     else:
         print("Login failed:", data)
@@ -47,27 +97,46 @@ def print_response(resp):
         print("Raw response:", resp.text)
         print("Status code:", resp.status_code)
 
-# upload file to the storage service - requires token for auth
+# upload file(s) to the storage service - requires token for auth
 def upload(args):
-    file_name = args.file
-    files = {'file': open(file_name, 'rb')}
+    if args.archive:
+        return upload_archive(args)
+    if not args.file:
+        print("Give files to upload, or --archive <dir>")
+        return
+    files = [('file', open(file_name, 'rb')) for file_name in args.file]
     data = {}
-    token = load_token()
-    headers = {}
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
-    resp = requests.post(f"{API_URL}/files/upload", files=files, data=data, headers=headers)
+    headers = auth_headers()
+    resp = http().post(f"{API_URL}/files/upload", files=files, data=data, headers=headers)
+    save_seq(resp)
     print_response(resp)
     
+# upload a whole directory as one tar stream, built while it is sent (see tarstream.py)
+def upload_archive(args):
+    import tarstream
+
+    if not os.path.isdir(args.archive):
+        print(f"Not a directory: {args.archive}")
+        return
+    stream = tarstream.TarStream(args.archive, compress=args.compress)
+    headers = auth_headers()
+    headers["Content-Type"] = stream.content_type
+    params = {"prefix": args.prefix} if args.prefix else None
+    resp = http().post(f"{API_URL}/files/upload/archive", params=params, data=stream, headers=headers)
+    save_seq(resp)
+    print_response(resp)
+
 # download file from the storage service - requires token for auth
 def download(args):
-    file_name = args.file
-    token = load_token()
-    headers = {}
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
+    if len(args.file) > 1 or args.prefix is not None or args.extract:
+        return download_archive(args)
+    if not args.file:
+        print("Give a file to download, or --prefix")
+        return
+    file_name = args.file[0]
+    headers = auth_headers()
     params = {"filename": file_name}
-    resp = requests.get(f"{API_URL}/files/download", params=params, headers=headers, stream=True)
+    resp = http().get(f"{API_URL}/files/download", params=params, headers=headers, stream=True)
     if resp.status_code == 200:
         outname = args.output if args.output else file_name
         with open(outname, 'wb') as f:
@@ -77,32 +146,173 @@ def download(args):
     else:
         print("Download failed:", resp.text)  # or use print_response(resp)
 
-# delete file from the storage service - requires token for auth
+# download several files, or everything under a prefix, as one zip that the
+# server generates as it sends; with --extract it is unpacked as it arrives
+def download_archive(args):
+    headers = auth_headers()
+    params = {"filename": args.file} if args.file else {"prefix": args.prefix or ""}
+    resp = http().get(f"{API_URL}/files/download/archive", params=params, headers=headers, stream=True)
+    if resp.status_code != 200:
+        print("Download failed:", resp.text)
+        return
+    if args.extract:
+        import zipstream
+
+        files, size = zipstream.extract(resp.iter_content(chunk_size=zipstream.CHUNK_SIZE), args.extract)
+        print(f"Extracted {files} files ({size} bytes) to {args.extract}")
+        return
+    outname = args.output or "files.zip"
+    with open(outname, 'wb') as f:
+        for chunk in resp.iter_content(chunk_size=64 * 1024):
+            f.write(chunk)
+    print(f"Downloaded to {outname}")
+
+# delete file(s) from the storage service - requires token for auth
 def delete(args):
-    file_name = args.file
-    headers = {}
-    token = load_token()
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
-    params = {"filename": file_name}
-    resp = requests.delete(f"{API_URL}/files/delete", params=params, headers=headers)
-    if resp.status_code == 200:
+    headers = auth_headers()
+    params = {"filename": args.file}
+    resp = http().delete(f"{API_URL}/files/delete", params=params, headers=headers)
+    save_seq(resp)
+    if resp.status_code == 200 and "files" in resp.json():
+        for result in resp.json()["files"]:
+            print(f"{result['filename']}: {result['status']}", result.get("error") or "")
+    elif resp.status_code == 200:
         print(f"Deletion successful")
     else:
         print("Delete failed:", resp.text)  # or use print_response(resp)
 
+# deleted files that can still be restored - requires token for auth
+def list_trash(args):
+    headers = auth_headers()
+    resp = http().get(f"{API_URL}/trash", headers=headers)
+    if resp.status_code != 200:
+        print_response(resp)
+        return
+    body = resp.json()
+    for f in body["files"]:
+        deleted = datetime.datetime.fromtimestamp(f["deleted_at"]).isoformat(sep=" ", timespec="seconds")
+        print(f"{f.get('size') or 0:>14}  deleted {deleted}  {f['trash_id']}  {f['filename']}")
+    print(f"Deleted files can be restored for {body['retention'] / 86400:g} days")
+
+# bring back a deleted file - requires token for auth
+def restore(args):
+    headers = auth_headers()
+    params = {"trash_id": args.id} if args.id else {"filename": args.file}
+    resp = http().post(f"{API_URL}/trash/restore", params=params, headers=headers)
+    save_seq(resp)
+    if resp.status_code == 201:
+        print(f"Restored {resp.json()['filename']}")
+    else:
+        print("Restore failed:", resp.text)
+
 # list all files from the metadata service - requires token for auth
 def list_files(args):
     params = {}
-    headers = {}
-    token = load_token()
-    if token:
-        headers["Authorization"] = f"Bearer {token}"
-    resp = requests.get(f"{API_URL}/files", params=params, headers=headers)
+    headers = auth_headers()
+    resp = http().get(f"{API_URL}/files", params=params, headers=headers)
     print_response(resp)
 
+# show storage used and quota - requires token for auth
+def usage(args):
+    headers = auth_headers()
+    resp = http().get(f"{API_URL}/usage", headers=headers)
+    if resp.status_code != 200:
+        print_response(resp)
+        return
+    u = resp.json()
+    quota_bytes = u["quota_bytes"] or "unlimited"
+    quota_files = u["quota_files"] or "unlimited"
+    print(f"{u['user']}: {u['bytes']} bytes in {u['files']} files (quota: {quota_bytes} bytes, {quota_files} files)")
+
+# "10M", "1.5G" -> bytes
+def parse_size(value):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    if value[-1:].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+    return int(value)
+
+# search your files via the metadata indexes - requires token for auth
+def query(args):
+    params = {"prefix": args.prefix, "mime": args.mime, "sort": args.sort, "limit": args.limit,
+              "modified_after": args.since, "modified_before": args.until,
+              "min_size": parse_size(args.min_size) if args.min_size else None,
+              "max_size": parse_size(args.max_size) if args.max_size else None}
+    headers = auth_headers()
+    resp = http().get(f"{API_URL}/files/query", params=params, headers=headers)
+    if resp.status_code != 200:
+        print_response(resp)
+        return
+    for f in resp.json()["files"]:
+        modified = datetime.datetime.fromtimestamp(f.get("modified") or 0).isoformat(sep=" ", timespec="seconds")
+        print(f"{f.get('size') or 0:>14}  {modified}  {f.get('user') or '-':<12} {f['filename']}")
+
+# follow changes to files as they happen - requires token for auth
+def watch(args):
+    headers = auth_headers()
+    cursor = args.since or ""
+    try:
+        while True:
+            params = {"since": cursor, "consumer": args.consumer, "timeout": args.timeout}
+            try:
+                resp = http().get(f"{API_URL}/changes", params=params, headers=headers, timeout=args.timeout + 30)
+            except OSError as e:  # requests' errors are OSErrors too
+                print("Connection error, retrying:", e)
+                time.sleep(5)
+                continue
+            if resp.status_code == 410:
+                # missed changes we can no longer get; a full listing would be needed to catch up
+                cursor = resp.json()["cursor"]
+                print(f"Cursor expired ({resp.json()['error']}); run 'list' to resync, continuing from {cursor}")
+                continue
+            if resp.status_code != 200:
+                print_response(resp)
+                return
+            body = resp.json()
+            for change in body["changes"]:
+                at = datetime.datetime.fromtimestamp(change["at"]).isoformat(sep=" ", timespec="seconds")
+                size = (change["file"] or {}).get("size")
+                print(f"{at}  {change['type']:<7} {change['filename']}" + (f"  ({size} bytes)" if size is not None else ""))
+            cursor = body["cursor"]
+    except KeyboardInterrupt:
+        print(f"\nResume with: watch --since {cursor}")
+
+# show a per-hop timing waterfall for one traced request
+def trace(args):
+    spans = []
+    if os.path.exists(TRACE_FILE):
+        with open(TRACE_FILE) as f:
+            for line in f:
+                if args.request_id in line:
+                    span = json.loads(line)
+                    if span["trace"] == args.request_id:
+                        spans.append(span)
+    if not spans:
+        print(f"No spans for request {args.request_id} in {TRACE_FILE} (not sampled, or not flushed yet)")
+        return
+
+    children = {}
+    ids = {s["span"] for s in spans}
+    for s in spans:
+        parent = s["parent"] if s["parent"] in ids else None
+        children.setdefault(parent, []).append(s)
+    t0 = min(s["start"] for s in spans)
+    total = max(s["start"] + s["duration"] for s in spans) - t0
+    width = 40
+
+    print(f"Request {args.request_id}: {total * 1000:.1f} ms, {len(spans)} spans")
+    def show(parent, depth):
+        for s in sorted(children.get(parent, []), key=lambda s: s["start"]):
+            offset = s["start"] - t0
+            left = int(offset / total * width) if total else 0
+            bar = max(1, int(s["duration"] / total * width)) if total else 1
+            label = ("  " * depth + f"{s['service']}: {s['name']}")[:48]
+            print(f"{offset * 1000:8.1f} ms {s['duration'] * 1000:8.1f} ms  {label:<48} |{' ' * left}{'#' * bar}")
+            show(s["span"], depth + 1)
+    show(None, 0)
+
 def main():
     parser = argparse.ArgumentParser(description="Mini-Dropbox CLI Client")
+    parser.add_argument("--trace", action="store_true", help="Trace this request and print its request ID")
     subparsers = parser.add_subparsers(dest="command")
 
     # Signup
@@ -119,13 +329,18 @@ def main():
 
     # Upload
     parser_upload = subparsers.add_parser("upload")
-    parser_upload.add_argument("file")
+    parser_upload.add_argument("file", nargs="*")
+    parser_upload.add_argument("--archive", metavar="DIR", help="Upload every file under DIR in one streamed request")
+    parser_upload.add_argument("--prefix", default="", help="With --archive: put in front of each stored path, e.g. myproject/")
+    parser_upload.add_argument("--compress", action="store_true", help="With --archive: gzip the stream")
     parser_upload.set_defaults(func=upload)
 
     # Download
     parser_download = subparsers.add_parser("download")
-    parser_download.add_argument("file")
+    parser_download.add_argument("file", nargs="*", help="One file, or several to get as a zip")
+    parser_download.add_argument("--prefix", help="Get all your files under this path as a zip, e.g. myproject/")
     parser_download.add_argument("--output", help="Output file name")
+    parser_download.add_argument("--extract", metavar="DIR", help="Unpack the zip into DIR as it arrives")
     parser_download.set_defaults(func=download)
 
     # List files
@@ -134,10 +349,55 @@ def main():
 
     # Delete
     parser_upload = subparsers.add_parser("delete")
-    parser_upload.add_argument("file")
+    parser_upload.add_argument("file", nargs="+")
     parser_upload.set_defaults(func=delete)
 
+    # Trash
+    parser_trash = subparsers.add_parser("trash", help="List deleted files that can still be restored")
+    parser_trash.set_defaults(func=list_trash)
+
+    # Restore
+    parser_restore = subparsers.add_parser("restore", help="Restore a deleted file")
+    parser_restore.add_argument("file", nargs="?", help="Filename; the most recently deleted one is restored")
+    parser_restore.add_argument("--id", help="Trash ID from 'trash', to pick an older deletion")
+    parser_restore.set_defaults(func=restore)
+
+    # Query
+    parser_query = subparsers.add_parser("query", help="Find your files by prefix, size, time or type")
+    parser_query.add_argument("--prefix", help="Filename prefix, e.g. projects/")
+    parser_query.add_argument("--min-size", help="Bytes, or with K/M/G/T suffix")
+    parser_query.add_argument("--max-size", help="Bytes, or with K/M/G/T suffix")
+    parser_query.add_argument("--since", help="Modified at or after (epoch seconds or ISO 8601)")
+    parser_query.add_argument("--until", help="Modified at or before (epoch seconds or ISO 8601)")
+    parser_query.add_argument("--mime", help="MIME type, or type/* for a whole family")
+    parser_query.add_argument("--sort", default="name", help="name, size or modified; prefix - for descending, e.g. --sort=-size")
+    parser_query.add_argument("--limit", type=int, default=100)
+    parser_query.set_defaults(func=query)
+
+    # Usage
+    parser_usage = subparsers.add_parser("usage", help="Show storage used and quota")
+    parser_usage.set_defaults(func=usage)
+
+    # Watch for changes
+    parser_watch = subparsers.add_parser("watch", help="Print changes to files as they happen")
+    parser_watch.add_argument("--since", help="Cursor to continue from (from an earlier watch); default is now")
+    parser_watch.add_argument("--consumer", help="Name that keeps the server from discarding changes you have not read")
+    parser_watch.add_argument("--timeout", type=float, default=30, help="Seconds each poll waits for changes")
+    parser_watch.set_defaults(func=watch)
+
+    # Trace waterfall
+    parser_trace = subparsers.add_parser("trace")
+    parser_trace.add_argument("request_id")
+    parser_trace.set_defaults(func=trace)
+
     args = parser.parse_args()
+    if args.trace:
+        request_id = uuid.uuid4().hex
+        TRACE_HEADERS.update({"X-Request-ID": request_id, "X-Trace-Sampled": "1"})
+        # the gateway only lets an admin force sampling
+        if os.environ.get("ADMIN_TOKEN"):
+            TRACE_HEADERS["X-Admin-Token"] = os.environ["ADMIN_TOKEN"]
+        print(f"Request ID: {request_id} (view with: python cli.py trace {request_id})")
     if hasattr(args, "func"):
         args.func(args)
     else:
@@ -0,0 +1,78 @@
+"""A tar stream of a directory tree, built as it is sent.
+
+``upload --archive <dir>`` sends the whole tree in one request instead of
+one upload per file. ``TarStream`` yields the archive in chunks: each
+file's tar header, then its bytes as they are read, so nothing is staged
+in a temp file and memory use does not grow with the tree. With
+``compress`` the chunks are gzip-compressed on the way.
+
+Only regular files are included, with paths relative to the root and
+``/`` separators; symlinks are not followed.
+"""
+import os
+import stat
+import tarfile
+import zlib
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class TarStream:
+    def __init__(self, root, compress=False):
+        self.root = os.path.abspath(root)
+        self.compress = compress
+        self.files = 0
+        self.bytes = 0
+
+    @property
+    def content_type(self):
+        return "application/gzip" if self.compress else "application/x-tar"
+
+    def walk(self):
+        """``(path, archive name)`` of every regular file under the root, in a stable order."""
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                yield path, os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def _members(self):
+        for path, name in self.walk():
+            try:
+                if not stat.S_ISREG(os.lstat(path).st_mode):
+                    continue  # links, sockets, pipes
+                f = open(path, "rb")
+            except OSError:
+                continue  # removed or unreadable since the walk listed it
+            with f:
+                st = os.fstat(f.fileno())
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                info = tarfile.TarInfo(name)
+                info.size = st.st_size
+                info.mtime = int(st.st_mtime)
+                info.mode = stat.S_IMODE(st.st_mode)
+                yield info.tobuf(tarfile.PAX_FORMAT)
+                remaining = info.size
+                while remaining:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise OSError(f"{path} shrank while it was being sent")
+                    remaining -= len(chunk)
+                    yield chunk
+                rest = info.size % tarfile.BLOCKSIZE
+                if rest:
+                    yield tarfile.NUL * (tarfile.BLOCKSIZE - rest)
+                self.files += 1
+                self.bytes += info.size
+        yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)  # end of archive
+
+    def __iter__(self):
+        gz = zlib.compressobj(6, zlib.DEFLATED, 31) if self.compress else None  # wbits 31: gzip framing
+        for chunk in self._members():
+            if gz is not None:
+                chunk = gz.compress(chunk)
+            if chunk:  # an empty chunk would end a chunked request body
+                yield chunk
+        if gz is not None:
+            yield gz.flush()
@@ -0,0 +1,156 @@
+"""Unpacking a zip download while it arrives.
+
+``download --extract`` writes the files of a zip from
+``/files/download/archive`` as its bytes come in, instead of saving the
+archive and unpacking it afterwards. The archive is read strictly
+forwards, local header by local header, and the central directory at the
+end is not needed: stored entries have their size in the local header,
+and deflated ones end where their deflate stream does. Each file is
+checked against its CRC-32 and only then moved into place.
+"""
+import os
+import struct
+import time
+import zlib
+
+CHUNK_SIZE = 256 * 1024
+
+LOCAL_SIGNATURE = b"PK\x03\x04"
+DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+END_SIGNATURES = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06")  # central directory and end records
+LOCAL_HEADER = struct.Struct("<HHHHHIIIHH")  # after the signature
+FLAG_DESCRIPTOR = 0x08
+STORED, DEFLATED = 0, 8
+
+
+class ZipError(Exception):
+    pass
+
+
+class _Input:
+    """Byte chunks from the response as a forward-only stream."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = b""
+
+    def read_some(self, limit):
+        """Up to ``limit`` bytes, at least one unless the stream has ended."""
+        if not self.buf:
+            self.buf = next(self.chunks, b"")
+        data, self.buf = self.buf[:limit], self.buf[limit:]
+        return data
+
+    def read(self, size):
+        parts = []
+        while size:
+            data = self.read_some(size)
+            if not data:
+                raise ZipError("archive ends early")
+            parts.append(data)
+            size -= len(data)
+        return b"".join(parts)
+
+    def unread(self, data):
+        self.buf = data + self.buf
+
+
+def safe_path(dest, name):
+    """Where entry ``name`` goes under ``dest``, or None for names that would leave it."""
+    parts = name.replace("\\", "/").split("/")
+    if name.startswith("/") or ".." in parts or ":" in parts[0]:
+        return None
+    parts = [p for p in parts if p not in ("", ".")]
+    return os.path.join(dest, *parts) if parts else None
+
+
+def _mtime(dos_time, dos_date):
+    try:
+        return time.mktime(((dos_date >> 9) + 1980, (dos_date >> 5) & 15, dos_date & 31,
+                            dos_time >> 11, (dos_time >> 5) & 63, (dos_time & 31) * 2, 0, 0, -1))
+    except (OverflowError, ValueError):
+        return None
+
+
+def _zip64_sizes(extra):
+    """(uncompressed, compressed) from a Zip64 extra field, or None if there is none."""
+    while len(extra) >= 4:
+        tag, length = struct.unpack("<HH", extra[:4])
+        if tag == 0x0001 and length >= 16:
+            return struct.unpack("<QQ", extra[4:20])
+        extra = extra[4 + length:]
+    return None
+
+
+def extract(chunks, dest):
+    """Unpack the zip arriving as ``chunks`` into ``dest``. Returns (files, bytes) written."""
+    inp = _Input(chunks)
+    files = written = 0
+    while True:
+        signature = inp.read(4)
+        if signature in END_SIGNATURES:
+            return files, written
+        if signature != LOCAL_SIGNATURE:
+            raise ZipError("not a zip archive, or a damaged one")
+        (_, flags, method, dos_time, dos_date, crc, csize, usize,
+         name_len, extra_len) = LOCAL_HEADER.unpack(inp.read(LOCAL_HEADER.size))
+        name = inp.read(name_len).decode("utf-8" if flags & 0x800 else "cp437")
+        zip64 = _zip64_sizes(inp.read(extra_len))
+        if zip64 is not None and not flags & FLAG_DESCRIPTOR:
+            usize, csize = zip64
+        if method not in (STORED, DEFLATED):
+            raise ZipError(f"{name}: unsupported compression method {method}")
+        if method == STORED and flags & FLAG_DESCRIPTOR:
+            raise ZipError(f"{name}: stored entry without its size up front")
+
+        path = None if name.endswith("/") else safe_path(dest, name)
+        out = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            out = open(path + ".part", "wb")
+        try:
+            actual_crc, size = 0, 0
+            if method == STORED:
+                remaining = csize
+                while remaining:
+                    data = inp.read_some(min(CHUNK_SIZE, remaining))
+                    if not data:
+                        raise ZipError("archive ends early")
+                    remaining -= len(data)
+                    actual_crc = zlib.crc32(data, actual_crc)
+                    size += len(data)
+                    if out:
+                        out.write(data)
+            else:
+                inflater = zlib.decompressobj(-15)
+                while not inflater.eof:
+                    data = inflater.unconsumed_tail or inp.read_some(CHUNK_SIZE)
+                    if not data:
+                        raise ZipError("archive ends early")
+                    data = inflater.decompress(data, CHUNK_SIZE)  # bounded output, whatever the ratio
+                    actual_crc = zlib.crc32(data, actual_crc)
+                    size += len(data)
+                    if out:
+                        out.write(data)
+                inp.unread(inflater.unused_data)
+            if flags & FLAG_DESCRIPTOR:
+                head = inp.read(4)
+                if head == DESCRIPTOR_SIGNATURE:
+                    head = inp.read(4)
+                crc = struct.unpack("<I", head)[0]
+                csize, usize = struct.unpack("<QQ" if zip64 is not None else "<II", inp.read(16 if zip64 is not None else 8))
+            if actual_crc != crc or size != usize:
+                raise ZipError(f"{name}: damaged in transit (CRC or size mismatch)")
+        except BaseException:
+            if out:
+                out.close()
+                os.remove(path + ".part")
+            raise
+        if out:
+            out.close()
+            os.replace(path + ".part", path)
+            mtime = _mtime(dos_time, dos_date)
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+            files += 1
+            written += size
@@ -0,0 +1,79 @@
+"""Embedded mode: gateway, storage and metadata in one process.
+
+For a small deployment on one box, this runs the three services from their
+own directories (``services/``, ``storage/``, ``metadata/``) in a single
+Python process behind one port. The REST API on that port is the
+gateway's, unchanged. The calls the services make to each other go through
+their usual ``http`` sessions, but the metadata and storage base URLs are
+mounted with ``inprocess.InProcessAdapter``: each call is a function call
+into the other Flask app in the same thread, with no socket, no HTTP
+parsing and no server thread in between.
+
+Each service keeps its own metrics; the gateway's are on ``/metrics`` as
+before, storage's on ``/metrics/storage`` and metadata's on
+``/metrics/metadata``. Metadata always runs as the leader here.
+
+Run from ``arch1``:  python embedded/app.py [--port 5000]
+"""
+import argparse
+import os
+import sys
+import threading
+
+from werkzeug.serving import run_simple
+
+import inprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # holds services/, storage/, metadata/
+
+
+def load():
+    """Load the three services and connect them in process; returns (gateway, storage, metadata) modules."""
+    os.environ["METADATA_ROLE"] = "leader"  # there is no other metadata instance to follow
+    metadata = inprocess.load_service(os.path.join(ROOT, "metadata"), "metadata_app", "metadata")
+    storage = inprocess.load_service(os.path.join(ROOT, "storage"), "storage_app", "storage")
+    gateway = inprocess.load_service(os.path.join(ROOT, "services"), "gateway_app", "services")
+    routes = {
+        gateway.METADATA_API: inprocess.InProcessAdapter(metadata.app),
+        storage.node.NODE_URL: inprocess.InProcessAdapter(storage.app),
+    }
+    for service in (gateway, storage, metadata):
+        for url, adapter in routes.items():
+            service.http.mount(url.rstrip("/") + "/", adapter)
+    return gateway, storage, metadata
+
+
+def wsgi_app(gateway, storage, metadata):
+    """The public WSGI app: the gateway, plus the other services' /metrics."""
+    internal_metrics = {"/metrics/storage": storage.app, "/metrics/metadata": metadata.app}
+
+    def application(environ, start_response):
+        app = internal_metrics.get(environ.get("PATH_INFO"))
+        if app is None:
+            return gateway.app(environ, start_response)
+        environ["PATH_INFO"] = "/metrics"
+        return app(environ, start_response)
+
+    return application
+
+
+def start_background(storage, metadata):
+    metadata.start_snapshots()
+    threading.Thread(target=metadata._reconcile_loop, daemon=True).start()
+    storage.start_background()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mini-Dropbox, all services in one process")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+
+    sys.stdout.reconfigure(line_buffering=True)  # ensure prints appear immediately
+    gateway, storage, metadata = load()
+    start_background(storage, metadata)
+    run_simple(args.host, args.port, wsgi_app(gateway, storage, metadata), threaded=True)
+
+
+if __name__ == "__main__":
+    main()
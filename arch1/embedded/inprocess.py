@@ -0,0 +1,182 @@
+"""Loading the services into one process and calling them without a network hop.
+
+``load_service`` imports a service's ``app.py`` under its own module name.
+The services each ship their own ``metrics.py``, ``tracing.py`` and so on,
+so every service gets its own copies of those: its metrics, trace spans and
+in-flight counts stay separate, as they are in separate containers.
+
+``InProcessAdapter`` is a requests transport adapter that hands a request
+straight to a Flask app as a WSGI call in the calling thread. Mounted on a
+service's ``http`` session for another service's base URL, it replaces the
+socket, the HTTP framing and the server thread on the other side, while the
+code making the call, its request ID forwarding and its upstream metrics
+stay as they are. Request bodies are passed as the stream or iterator the
+caller gave; response bodies are read from the app's iterator as the
+caller consumes them, and a file sent with ``send_file`` is read straight
+from disk into the caller's buffer.
+"""
+import datetime
+import importlib.util
+import io
+import itertools
+import os
+import sys
+from urllib.parse import unquote_to_bytes, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from werkzeug.wsgi import ClosingIterator, FileWrapper
+
+
+def load_service(directory, name, service_name=None):
+    """Import ``directory/app.py`` as module ``name``, with its own copies of its helper modules."""
+    directory = os.path.realpath(directory)
+    if service_name:
+        os.environ["SERVICE_NAME"] = service_name  # read by tracing.py at import
+    before = set(sys.modules)
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(directory, "app.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+        # the services share module names (metrics, tracing, ...): forget this
+        # service's so the next one imports its own
+        for mod_name in set(sys.modules) - before - {name}:
+            path = getattr(sys.modules[mod_name], "__file__", None) or ""
+            if os.path.dirname(os.path.realpath(path)) == directory:
+                del sys.modules[mod_name]
+    return module
+
+
+class _IterStream(io.RawIOBase):
+    """A readable stream over an iterator of byte chunks (a generator request body)."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buf:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.buf = chunk.encode() if isinstance(chunk, str) else chunk
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+
+class _Body(io.RawIOBase):
+    """``Response.raw`` over a WSGI app iterator; closing it closes the iterator."""
+
+    def __init__(self, app_iter):
+        self.app_iter = app_iter
+        # send_file: read the file itself rather than FileWrapper's fixed blocks
+        self.file = app_iter.file if isinstance(app_iter, FileWrapper) else None
+        self.chunks = None if self.file is not None else iter(app_iter)
+        self.buf = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.file is not None:
+            return self.file.readinto(b) or 0
+        while not self.buf:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.buf = chunk
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            if hasattr(self.app_iter, "close"):
+                self.app_iter.close()  # runs the app's call_on_close handlers
+            super().close()
+
+
+def _no_write(data):
+    raise NotImplementedError("the in-process transport does not support WSGI write()")
+
+
+class InProcessAdapter(BaseAdapter):
+    """Send requests to a WSGI app in this process instead of over HTTP."""
+
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = urlsplit(request.url)
+        body = request.body
+        if body is None or isinstance(body, (bytes, str)):
+            body = io.BytesIO(body.encode() if isinstance(body, str) else body or b"")
+        elif not hasattr(body, "read"):
+            body = io.BufferedReader(_IterStream(body))
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote_to_bytes(url.path or "/").decode("latin-1"),
+            "QUERY_STRING": url.query,
+            "SERVER_NAME": url.hostname or "localhost",
+            "SERVER_PORT": str(url.port or 80),
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "REMOTE_ADDR": "127.0.0.1",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": url.scheme,
+            "wsgi.input": body,
+            "wsgi.input_terminated": True,  # the body ends where the stream does, with or without a length
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": FileWrapper,
+        }
+        for key, value in request.headers.items():
+            key = key.upper().replace("-", "_")
+            if key == "TRANSFER_ENCODING":
+                continue  # the body is not chunk-encoded in process
+            environ[key if key in ("CONTENT_TYPE", "CONTENT_LENGTH") else f"HTTP_{key}"] = value
+
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info:
+                raise exc_info[1].with_traceback(exc_info[2])
+            started[:] = [status, headers]
+            return _no_write
+
+        app_iter = self.app(environ, start_response)
+        if not started:
+            # an app that starts its response on the first iteration
+            chunks = iter(app_iter)
+            first = next(chunks, b"")
+            app_iter = ClosingIterator(itertools.chain([first], chunks), getattr(app_iter, "close", None))
+        status, headers = started
+        resp = requests.Response()
+        resp.status_code = int(status.split(" ", 1)[0])
+        resp.reason = status.partition(" ")[2]
+        resp.headers = CaseInsensitiveDict(headers)
+        resp.encoding = get_encoding_from_headers(resp.headers)
+        resp.raw = io.BufferedReader(_Body(app_iter))
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        resp.elapsed = datetime.timedelta(0)  # set by Session.send
+        return resp
+
+    def close(self):
+        pass
@@ -0,0 +1,417 @@
+"""The file records, stored by column, and snapshots of them on disk.
+
+``FILES`` used to be a dict of dicts: about a kilobyte per file, most of it
+dict overhead and strings repeated in every record (owner, MIME type, store
+kind, node, the object's directory). ``Catalog`` keeps the mapping
+interface, filename -> record, but gives every file a row number and keeps
+each field in a column: numbers in ``array``s, object IDs and SHA-256s as
+raw bytes, and the repeated strings as ids into one table where each is
+stored once. A record is turned back into a dict when it is read.
+
+Values that do not fit their column (an object ID that is not hex, a size
+that is not an int, a field the columns do not know) are kept as they are
+in a side table, so every record reads back the way it was written; a field
+missing from a record reads back as None.
+
+``save`` writes the columns to a file as they are in memory, with the names
+front-coded in name order (each one stored as the length it shares with the
+name before it and the rest). ``load`` maps the file and copies each column
+into its array in one go, so a restart does not parse a record at a time.
+"""
+import array
+import collections.abc
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b"MDCAT001"
+PRELUDE = struct.Struct("<8sQQ")  # magic, offset and length of the JSON header at the end
+
+NONE_INT = -(1 << 63)  # None in an integer column
+NONE_FLOAT = math.nan
+
+# flags, one byte per row
+LIVE = 1  # the row holds a record; free rows are reused
+HAS_OBJECT_ID = 2
+HAS_SHA256 = 4
+ENCRYPTED = 8
+OBJECT_PATH = 16  # path is the interned directory + "/" + object_id
+
+INT_FIELDS = ("size", "version", "crc32")
+STRING_FIELDS = ("store", "mime", "user", "node")  # few distinct values, interned
+COLUMNS = {  # snapshot section -> array typecode, or None for a bytearray
+    "flags": None, "object_id": None, "sha256": None,
+    "size": "q", "version": "q", "crc32": "q", "modified": "d",
+    "store": "I", "mime": "I", "user": "I", "node": "I", "path": "I",
+}
+KNOWN_FIELDS = {"filename", "object_id", "store", "path", "size", "version", "sha256", "crc32",
+                "encrypted", "mime", "modified", "user", "node", "password"}
+
+
+def _unhex(value, width):
+    """``value`` as ``width`` raw bytes if it is lowercase hex of that length, else None."""
+    if type(value) is not str or len(value) != 2 * width:
+        return None
+    try:
+        raw = bytes.fromhex(value)
+    except ValueError:
+        return None
+    return raw if raw.hex() == value else None
+
+
+def _shared(a, b):
+    """Length of the common prefix of ``a`` and ``b``."""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+class Catalog(collections.abc.MutableMapping):
+    def __init__(self):
+        self.rows = {}  # filename -> row
+        self.names = []  # row -> filename, None for a free row
+        self.free = []  # rows to reuse
+        self.flags = bytearray()
+        self.object_id = bytearray()  # 16 bytes per row
+        self.sha256 = bytearray()  # 32 bytes per row
+        self.size, self.version, self.crc32 = array.array("q"), array.array("q"), array.array("q")
+        self.modified = array.array("d")
+        self.store, self.mime, self.user, self.node = (array.array("I") for _ in range(4))
+        self.path = array.array("I")  # directory of the object, with OBJECT_PATH
+        self.strings = [None]  # id -> string; 0 is None
+        self.string_ids = {}
+        self.odd = {}  # row -> {field: value} that did not fit its column; never changed in place
+        self.by_object = {}  # raw object ID (or the odd ID string) -> row
+
+    # ---------------- mapping ----------------
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, filename):
+        return filename in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, filename):
+        return self._record(self.rows[filename])
+
+    def get(self, filename, default=None):
+        row = self.rows.get(filename)
+        return default if row is None else self._record(row)
+
+    def __setitem__(self, filename, record):
+        row = self.rows.get(filename)
+        if row is None:
+            row = self._new_row(filename)
+        else:
+            self._unlink_object(row)
+        odd = {key: value for key, value in record.items() if key not in KNOWN_FIELDS}
+        flags = LIVE
+
+        object_id = record.get("object_id")
+        raw = _unhex(object_id, 16)
+        if raw is not None:
+            self.object_id[16 * row:16 * row + 16] = raw
+            flags |= HAS_OBJECT_ID
+            self.by_object[raw] = row
+        elif object_id is not None:
+            odd["object_id"] = object_id
+            self.by_object[object_id] = row
+
+        raw = _unhex(record.get("sha256"), 32)
+        if raw is not None:
+            self.sha256[32 * row:32 * row + 32] = raw
+            flags |= HAS_SHA256
+        elif record.get("sha256") is not None:
+            odd["sha256"] = record["sha256"]
+
+        for field in INT_FIELDS:
+            value = record.get(field)
+            if value is None:
+                getattr(self, field)[row] = NONE_INT
+            elif type(value) is int and NONE_INT < value < -NONE_INT:
+                getattr(self, field)[row] = value
+            else:
+                getattr(self, field)[row] = NONE_INT
+                odd[field] = value
+        value = record.get("modified")
+        self.modified[row] = value if type(value) is float and not math.isnan(value) else NONE_FLOAT
+        if value is not None and self.modified[row] != value:
+            odd["modified"] = value
+
+        for field in STRING_FIELDS:
+            value = record.get(field)
+            getattr(self, field)[row] = self._intern(value)
+            if value is not None and type(value) is not str:
+                odd[field] = value
+
+        path = record.get("path")
+        self.path[row] = 0
+        if path is not None:
+            directory, slash, name = path.rpartition("/") if type(path) is str else ("", "", None)
+            if flags & HAS_OBJECT_ID and slash and name == object_id:
+                self.path[row] = self._intern(directory)
+                flags |= OBJECT_PATH
+            else:
+                odd["path"] = path
+
+        encrypted = record.get("encrypted")
+        if encrypted is True:
+            flags |= ENCRYPTED
+        elif encrypted is not False:
+            odd["encrypted"] = encrypted
+        if record.get("password") != "":
+            odd["password"] = record.get("password")
+
+        self.flags[row] = flags
+        if odd:
+            self.odd[row] = odd
+        else:
+            self.odd.pop(row, None)
+
+    def __delitem__(self, filename):
+        row = self.rows.pop(filename)
+        self._unlink_object(row)
+        self.names[row] = None
+        self.flags[row] = 0
+        self.odd.pop(row, None)
+        self.free.append(row)
+
+    def values(self):
+        return (self._record(row) for row, filename in enumerate(self.names) if filename is not None)
+
+    def items(self):
+        return ((filename, self._record(row)) for row, filename in enumerate(self.names) if filename is not None)
+
+    def find_object(self, object_id):
+        """The record pointing at ``object_id``, or None."""
+        raw = _unhex(object_id, 16)
+        row = self.by_object.get(raw if raw is not None else object_id)
+        return None if row is None else self._record(row)
+
+    # ---------------- rows ----------------
+    def _new_row(self, filename):
+        if self.free:
+            row = self.free.pop()
+        else:
+            row = len(self.names)
+            self.names.append(None)
+            self.flags.append(0)
+            self.object_id.extend(bytes(16))
+            self.sha256.extend(bytes(32))
+            for column in (self.size, self.version, self.crc32):
+                column.append(NONE_INT)
+            self.modified.append(NONE_FLOAT)
+            for column in (self.store, self.mime, self.user, self.node, self.path):
+                column.append(0)
+        self.names[row] = filename
+        self.rows[filename] = row
+        return row
+
+    def _unlink_object(self, row):
+        if self.flags[row] & HAS_OBJECT_ID:
+            key = bytes(self.object_id[16 * row:16 * row + 16])
+        else:
+            key = self.odd.get(row, {}).get("object_id")
+        if key is not None and self.by_object.get(key) == row:
+            del self.by_object[key]
+
+    def _intern(self, value):
+        if type(value) is not str:
+            return 0
+        sid = self.string_ids.get(value)
+        if sid is None:
+            sid = self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+        return sid
+
+    def _record(self, row):
+        flags = self.flags[row]
+        strings = self.strings
+        object_id = path = None
+        if flags & HAS_OBJECT_ID:
+            object_id = self.object_id[16 * row:16 * row + 16].hex()
+            if flags & OBJECT_PATH:
+                path = strings[self.path[row]] + "/" + object_id
+        size, version, crc32, modified = self.size[row], self.version[row], self.crc32[row], self.modified[row]
+        record = {
+            "filename": self.names[row],
+            "object_id": object_id,
+            "store": strings[self.store[row]],
+            "path": path,
+            "size": None if size == NONE_INT else size,
+            "version": None if version == NONE_INT else version,
+            "sha256": self.sha256[32 * row:32 * row + 32].hex() if flags & HAS_SHA256 else None,
+            "crc32": None if crc32 == NONE_INT else crc32,
+            "encrypted": flags & ENCRYPTED != 0,
+            "mime": strings[self.mime[row]],
+            "modified": None if modified != modified else modified,  # NaN
+            "user": strings[self.user[row]],
+            "node": strings[self.node[row]],
+            "password": "",
+        }
+        if row in self.odd:
+            record.update(self.odd[row])
+        return record
+
+    def column(self, field, names=None):
+        """``field`` of each of ``names`` (default: every record), in order; cheaper than reading whole records."""
+        if names is None:
+            rows = [row for row, filename in enumerate(self.names) if filename is not None]
+        else:
+            rows = [self.rows[filename] for filename in names]
+        if field in INT_FIELDS:
+            values = getattr(self, field)
+            out = [None if values[row] == NONE_INT else values[row] for row in rows]
+        elif field == "modified":
+            out = [None if self.modified[row] != self.modified[row] else self.modified[row] for row in rows]
+        elif field in STRING_FIELDS:
+            strings, values = self.strings, getattr(self, field)
+            out = [strings[values[row]] for row in rows]
+        else:
+            return [self._record(row).get(field) for row in rows]
+        if self.odd:
+            for i, row in enumerate(rows):
+                odd = self.odd.get(row)
+                if odd and field in odd:
+                    out[i] = odd[field]
+        return out
+
+    def stats(self):
+        columns = sum(len(getattr(self, name)) * (getattr(self, name).itemsize if code else 1)
+                      for name, code in COLUMNS.items())
+        return {"files": len(self.rows), "rows": len(self.names), "strings": len(self.strings) - 1,
+                "odd": len(self.odd), "column_bytes": columns}
+
+    # ---------------- copies & snapshots ----------------
+    def freeze(self):
+        """A copy for reading and saving after the lock is released; lookups by object ID are left out."""
+        copy = Catalog.__new__(Catalog)
+        copy.rows = dict(self.rows)
+        copy.names = list(self.names)
+        copy.free = []
+        for name, code in COLUMNS.items():
+            setattr(copy, name, getattr(self, name)[:])
+        copy.strings = list(self.strings)
+        copy.string_ids = {}
+        copy.odd = dict(self.odd)
+        copy.by_object = {}
+        return copy
+
+    def save(self, path, names=None, extra=None):
+        """Write the catalog to ``path``, replacing it atomically.
+
+        ``names`` is every filename in name order, if the caller already has
+        them sorted; ``extra`` is stored alongside and handed back by ``load``.
+        """
+        if names is None:
+            names = sorted(self.rows)
+        name_rows, shared, suffixes, odd_names = array.array("I"), array.array("I"), [], []
+        previous = ""
+        for filename in names:
+            if "\0" in filename:  # the separator of the suffixes
+                odd_names.append([filename, self.rows[filename]])
+                continue
+            common = _shared(previous, filename)
+            name_rows.append(self.rows[filename])
+            shared.append(common)
+            suffixes.append(filename[common:])
+            previous = filename
+
+        sections = {}
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(PRELUDE.pack(MAGIC, 0, 0))
+            parts = [(name, code, getattr(self, name)) for name, code in COLUMNS.items()]
+            parts += [("name_rows", "I", name_rows), ("name_shared", "I", shared),
+                      ("name_suffixes", None, "\0".join(suffixes).encode("utf-8"))]
+            for name, code, data in parts:
+                f.write(bytes(-f.tell() % 8))  # aligned, so a column could be used in place
+                sections[name] = [f.tell(), len(data) * (data.itemsize if code else 1), code]
+                f.write(data)
+            header = json.dumps({
+                "rows": len(self.names), "names": len(name_rows), "byteorder": sys.byteorder,
+                "itemsize": {code: array.array(code).itemsize for code in "Iqd"},
+                "sections": sections, "strings": self.strings, "odd_names": odd_names,
+                "odd": {str(row): odd for row, odd in self.odd.items()},
+                "saved_at": time.time(), "extra": extra,
+            }).encode("utf-8")
+            header_at = f.tell()
+            f.write(header)
+            f.seek(0)
+            f.write(PRELUDE.pack(MAGIC, header_at, len(header)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def load(self, path):
+        """Replace the contents with the snapshot at ``path``. Returns (filenames in name order, extra).
+
+        On an error the catalog is left as it was.
+        """
+        loaded = Catalog()
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, header_at, header_len = PRELUDE.unpack_from(mm, 0)
+            if magic != MAGIC or header_at + header_len > len(mm):
+                raise ValueError(f"{path} is not a catalog snapshot, or it is damaged")
+            header = json.loads(mm[header_at:header_at + header_len])
+            if header["byteorder"] != sys.byteorder or any(
+                    array.array(code).itemsize != size for code, size in header["itemsize"].items()):
+                raise ValueError(f"{path} was written on a different platform")
+            n = header["rows"]
+            widths = {"object_id": 16, "sha256": 32}
+            sections = {}
+            with memoryview(mm) as view:
+                for name, (offset, length, code) in header["sections"].items():
+                    if code is None:
+                        data = bytearray(view[offset:offset + length])
+                    else:
+                        data = array.array(code)
+                        data.frombytes(view[offset:offset + length])
+                    if name in COLUMNS and len(data) != n * widths.get(name, 1):
+                        raise ValueError(f"{path} is damaged: column {name} has the wrong length")
+                    sections[name] = data
+
+        for name in COLUMNS:
+            setattr(loaded, name, sections[name])
+        loaded.strings = header["strings"]
+        loaded.string_ids = {s: i for i, s in enumerate(loaded.strings) if i}
+        loaded.odd = {int(row): odd for row, odd in header["odd"].items()}
+        loaded.names = [None] * n
+        names = []
+        previous = ""
+        suffixes = sections["name_suffixes"].decode("utf-8").split("\0") if header["names"] else []
+        for row, common, suffix in zip(sections["name_rows"], sections["name_shared"], suffixes):
+            filename = previous[:common] + suffix
+            loaded.names[row] = filename
+            loaded.rows[filename] = row
+            names.append(filename)
+            previous = filename
+        for filename, row in header["odd_names"]:
+            loaded.names[row] = filename
+            loaded.rows[filename] = row
+        if header["odd_names"]:
+            names = sorted(loaded.rows)
+        if len(loaded.rows) != sum(flags & LIVE for flags in loaded.flags):
+            raise ValueError(f"{path} is damaged: names and rows do not match")
+        loaded.free = [row for row in range(n) if not loaded.flags[row] & LIVE]
+
+        object_ids = loaded.object_id
+        for row, flags in enumerate(loaded.flags):
+            if flags & HAS_OBJECT_ID:
+                loaded.by_object[bytes(object_ids[16 * row:16 * row + 16])] = row
+        for row, odd in loaded.odd.items():
+            if odd.get("object_id") is not None:
+                loaded.by_object[odd["object_id"]] = row
+        vars(self).update(vars(loaded))
+        return names, header["extra"]
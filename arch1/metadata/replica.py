@@ -0,0 +1,141 @@
+"""Leader/follower replication of the metadata store.
+
+One metadata instance is the leader (``METADATA_ROLE=leader``, the
+default) and takes every write. Followers (``METADATA_ROLE=follower``)
+copy its state and answer reads: ``GET /files``, ``/files/<name>``,
+``/catalog/query``, ``/users/<name>`` and ``/changes``. Any other request that reaches a follower is redirected to
+``METADATA_LEADER_URL`` with a 307, so a client pointed at a follower still
+works for writes.
+
+The leader's change log (changelog.py) is the replication log. A follower
+starts by loading ``GET /replication/snapshot`` (every record, user and
+quota, with the log position it was taken at) and then long-polls
+``GET /replication/log`` from that position, applying events in order.
+Followers keep the leader's epoch and sequence numbers, so ``/changes``
+cursors are the same on every instance. A follower that falls behind the
+retained log (``CHANGELOG_MAX_ENTRIES``, or what named ``/changes``
+consumers have all read), or sees the leader restart, loads a new snapshot.
+
+Read-your-writes: every write the leader answers carries ``X-Metadata-Seq``,
+the log position after the write. A read that passes it back (as
+``X-Metadata-Seq`` or ``?min_seq=``) waits up to ``REPLICA_READ_WAIT``
+seconds for the follower to get there, and is otherwise redirected to the
+leader. A single file or user a follower does not have is looked up on the
+leader too, so something just created is never reported missing.
+
+Reservations, the trash and the node registry are not replicated; those
+routes go to the leader, and so does usage, which counts reserved and
+trashed bytes.
+"""
+import os
+import threading
+import time
+
+import changelog
+import metrics
+
+ROLE = os.environ.get("METADATA_ROLE", "leader")
+LEADER_URL = os.environ.get("METADATA_LEADER_URL", "http://metadata:5001")
+READ_WAIT = float(os.environ.get("REPLICA_READ_WAIT", "2"))  # seconds a read waits for its min_seq
+POLL_TIMEOUT = 30  # seconds each /replication/log long-poll may wait on the leader
+MAX_BACKOFF = 30
+
+# rules of the routes a follower answers itself
+READ_ROUTES = {
+    "/files", "/catalog/query", "/files/<path:filename>",
+    "/users/<username>",
+    "/changes", "/replication/status", "/metrics",
+}
+LOOKUP_ROUTES = {"/files/<path:filename>", "/users/<username>"}  # a 404 here is retried on the leader
+
+SYNCS = metrics.counter("metadata_replication_syncs_total", "Snapshots a follower loaded from the leader", ["reason"])
+APPLIED = metrics.counter("metadata_replication_events_total", "Log events a follower applied")
+ERRORS = metrics.counter("metadata_replication_errors_total", "Failed requests to the leader")
+
+
+def is_follower():
+    return ROLE == "follower"
+
+
+def parse_token(token):
+    """(epoch, seq) of a read-your-writes token, or None if it is malformed."""
+    epoch, _, seq = (token or "").partition(":")
+    try:
+        return epoch, int(seq)
+    except ValueError:
+        return None
+
+
+class Follower:
+    """Keeps this instance in step with the leader from a background thread.
+
+    ``load(snapshot)`` replaces the local state, ``apply(events)`` applies log
+    events in order and raises ``changelog.CursorExpired`` on a gap.
+    """
+
+    def __init__(self, http, load, apply):
+        self.http = http
+        self.load = load
+        self.apply = apply
+        self.cursor = None  # leader position applied up to; None until a snapshot is loaded
+        self.head = 0  # leader's last sequence number, as of the last answer
+        self.contact = None  # monotonic time of the last answer from the leader
+
+    @property
+    def synced(self):
+        return self.cursor is not None
+
+    def lag(self):
+        """Events the leader has that this follower has not applied yet."""
+        if self.cursor is None:
+            return None
+        return max(0, self.head - parse_token(self.cursor)[1])
+
+    def sync(self, reason):
+        r = self.http.get(f"{LEADER_URL}/replication/snapshot", timeout=POLL_TIMEOUT)
+        r.raise_for_status()
+        snapshot = r.json()
+        self.load(snapshot)
+        self.cursor = snapshot["cursor"]
+        self.head = parse_token(self.cursor)[1]
+        self.contact = time.monotonic()
+        SYNCS.inc(reason=reason)
+        print(f"loaded metadata snapshot at {self.cursor} ({len(snapshot['files'])} files, {reason})")
+
+    def poll(self):
+        # not a named consumer: followers must not make the leader drop entries
+        # that anonymous /changes readers still need
+        params = {"since": self.cursor, "timeout": POLL_TIMEOUT}
+        r = self.http.get(f"{LEADER_URL}/replication/log", params=params, timeout=POLL_TIMEOUT + 10)
+        self.contact = time.monotonic()
+        if r.status_code == 410:
+            return self.sync("expired")
+        r.raise_for_status()
+        body = r.json()
+        if parse_token(body["cursor"])[0] != parse_token(self.cursor)[0]:
+            return self.sync("restart")  # the leader started over; its state is not ours plus these events
+        try:
+            self.apply(body["changes"])
+        except changelog.CursorExpired as e:
+            print(f"replication log gap, reloading: {e}")
+            return self.sync("gap")
+        APPLIED.inc(len(body["changes"]))
+        self.cursor = body["cursor"]
+        self.head = parse_token(body["head"])[1]
+
+    def run(self):
+        backoff = 1
+        while True:
+            try:
+                if self.cursor is None:
+                    self.sync("start")
+                self.poll()
+                backoff = 1
+            except Exception as e:
+                ERRORS.inc()
+                print(f"replication from {LEADER_URL} failed, retrying in {backoff}s: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
@@ -0,0 +1,304 @@
+"""Admission control and fair bandwidth sharing for the gateways.
+
+Every authenticated request passes ``admit`` before its handler runs:
+
+  * a token bucket per (user, route) limits request rate, with bursts;
+  * uploads and downloads also take one of the user's ``max_transfers``
+    slots, held until the response has been fully sent.
+
+Over a limit the gateway answers 429 with ``Retry-After``.
+
+Download bodies go through ``FairShaper``. When a total ``bandwidth`` is
+set, concurrent downloads share it by start-time fair queueing: every chunk
+is tagged with its flow's virtual finish time (bytes / user weight), and
+the chunk with the smallest tag goes next. A new small download starts at
+the current virtual time, so it is not queued behind a multi-GB transfer
+that has been sending for minutes, and idle share is used by the others.
+
+Limits are changed at runtime with ``PUT /admin/limits`` and are exported,
+with rejections and shaping delays, on ``/metrics``.
+"""
+import copy
+import json
+import math
+import os
+import threading
+import time
+
+from flask import g, jsonify, request
+
+import metrics
+
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")  # empty disables /admin/limits
+TRANSFER_ROUTES = {"/files/upload", "/files/upload/archive", "/files/download", "/files/download/archive"}
+MAX_BUCKETS = 10000  # idle buckets are dropped beyond this
+
+DEFAULT_LIMITS = {
+    # requests per second and burst size, per user and route; "*" covers routes not listed
+    "routes": {
+        "*": {"rate": 20, "burst": 40},
+        "/files/upload": {"rate": 5, "burst": 10},
+        "/files/download": {"rate": 10, "burst": 20},
+    },
+    "max_transfers": 4,  # concurrent uploads + downloads per user; 0 = unlimited
+    "bandwidth": 0,  # download bytes/s shared by all users; 0 = unlimited
+    "weights": {},  # user -> bandwidth share relative to others (default 1)
+}
+
+ADMISSIONS = metrics.counter("gateway_admission_total", "Requests by admission decision", ["route", "outcome"])
+SHAPED_BYTES = metrics.counter("gateway_shaped_bytes_total", "Download bytes sent through the fair shaper")
+SHAPER_WAIT = metrics.counter("gateway_shaper_wait_seconds_total", "Time downloads spent waiting for their bandwidth share")
+
+
+def _merge(base, update):
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            _merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def _number(value, name, positive=False):
+    if type(value) not in (int, float) or not math.isfinite(value) or value < 0 or (positive and value == 0):
+        raise ValueError(f"{name} must be a {'positive' if positive else 'non-negative'} number")
+
+
+def validate(limits):
+    """Raise ValueError unless ``limits`` is a complete, well-typed set of limits."""
+    unknown = set(limits) - set(DEFAULT_LIMITS)
+    if unknown:
+        raise ValueError(f"unknown limits: {', '.join(sorted(unknown))}")
+    routes = limits["routes"]
+    if not isinstance(routes, dict) or not isinstance(routes.get("*"), dict):
+        raise ValueError('routes must be an object with a "*" entry')
+    for route, limit in routes.items():
+        if not isinstance(limit, dict):
+            raise ValueError(f"routes[{route}] must be an object")
+        for key in ("rate", "burst"):
+            _number(limit.get(key), f"routes[{route}].{key}")
+    if type(limits["max_transfers"]) is not int or limits["max_transfers"] < 0:
+        raise ValueError("max_transfers must be a non-negative integer")
+    _number(limits["bandwidth"], "bandwidth")
+    if not isinstance(limits["weights"], dict):
+        raise ValueError("weights must be an object")
+    for user, weight in limits["weights"].items():
+        _number(weight, f"weights[{user}]", positive=True)
+    return limits
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "last")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def take(self):
+        """0 if a token was taken, else seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 60
+
+    def idle(self):
+        return self.tokens + (time.monotonic() - self.last) * self.rate >= self.burst
+
+
+class Slot:
+    """One of a user's concurrent transfer slots; released once."""
+
+    def __init__(self, controller, user):
+        self.controller = controller
+        self.user = user
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.controller._release(self.user)
+
+
+class FairShaper:
+    def __init__(self, rate):
+        self.rate = rate
+        self.cond = threading.Condition()
+        self.allowance = 0.0
+        self.last = time.monotonic()
+        self.vclock = 0.0
+        self.waiting = {}  # flow -> finish tag of its next chunk
+
+    def send(self, flow, n):
+        """Block until ``flow`` may send ``n`` more bytes."""
+        if self.rate <= 0:
+            return
+        started = time.monotonic()
+        with self.cond:
+            start = max(flow.finish, self.vclock)
+            tag = start + n / flow.weight
+            self.waiting[flow] = tag
+            while True:
+                now = time.monotonic()
+                # at most a tenth of a second of burst
+                self.allowance = min(self.rate / 10, self.allowance + (now - self.last) * self.rate)
+                self.last = now
+                if min(self.waiting.values()) == tag and self.allowance > 0:
+                    break
+                timeout = -self.allowance / self.rate if self.allowance <= 0 else None
+                self.cond.wait(timeout if timeout is not None else 1)
+            self.allowance -= n
+            self.vclock = start
+            flow.finish = tag
+            del self.waiting[flow]
+            self.cond.notify_all()
+        SHAPED_BYTES.inc(n)
+        SHAPER_WAIT.inc(time.monotonic() - started)
+
+
+class Flow:
+    __slots__ = ("weight", "finish")
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.finish = 0.0
+
+
+class Controller:
+    def __init__(self, limits):
+        self.lock = threading.Lock()
+        self.limits = limits
+        self.buckets = {}  # (user, route) -> TokenBucket
+        self.transfers = {}  # user -> transfers in progress
+        self.shaper = FairShaper(limits["bandwidth"])
+
+    def configure(self, update):
+        """Apply ``update`` to the limits; ValueError, with nothing changed, if the result is invalid."""
+        with self.lock:
+            limits = validate(_merge(copy.deepcopy(self.limits), update))
+            self.limits = limits
+            self.buckets.clear()  # rebuilt with the new rates
+            self.shaper.rate = limits["bandwidth"]
+        return limits
+
+    def _route_limit(self, route):
+        routes = self.limits["routes"]
+        return routes.get(route, routes["*"])
+
+    def admit(self, user, route):
+        """(Slot or None, None) when admitted, else (None, seconds to wait)."""
+        with self.lock:
+            key = (user, route)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= MAX_BUCKETS:
+                    for k in [k for k, b in self.buckets.items() if b.idle()]:
+                        del self.buckets[k]
+                limit = self._route_limit(route)
+                bucket = self.buckets[key] = TokenBucket(limit["rate"], limit["burst"])
+            wait = bucket.take()
+            if wait:
+                ADMISSIONS.inc(route=route, outcome="rate_limited")
+                return None, wait
+            if route not in TRANSFER_ROUTES:
+                ADMISSIONS.inc(route=route, outcome="admitted")
+                return None, None
+            cap = self.limits["max_transfers"]
+            if cap and self.transfers.get(user, 0) >= cap:
+                bucket.tokens = min(bucket.burst, bucket.tokens + 1)  # the request was not served
+                ADMISSIONS.inc(route=route, outcome="too_many_transfers")
+                return None, 1
+            self.transfers[user] = self.transfers.get(user, 0) + 1
+        ADMISSIONS.inc(route=route, outcome="admitted")
+        return Slot(self, user), None
+
+    def _release(self, user):
+        with self.lock:
+            left = self.transfers.get(user, 0) - 1
+            if left > 0:
+                self.transfers[user] = left
+            else:
+                self.transfers.pop(user, None)
+
+    def shape(self, chunks, user):
+        """Pass a download body through the fair shaper."""
+        flow = Flow(self.limits["weights"].get(user, 1))
+        for chunk in chunks:
+            self.shaper.send(flow, len(chunk))
+            yield chunk
+
+    # ---------------- metrics ----------------
+    def limit_samples(self):
+        samples = []
+        for route, limit in self.limits["routes"].items():
+            samples.append(((route, "rate"), limit["rate"]))
+            samples.append(((route, "burst"), limit["burst"]))
+        return samples
+
+
+CONTROLLER = Controller(validate(_merge(copy.deepcopy(DEFAULT_LIMITS), json.loads(os.environ.get("ADMISSION_LIMITS", "{}")))))
+
+metrics.gauge("gateway_rate_limit", "Configured per-user request rate and burst", ["route", "kind"],
+              fn=CONTROLLER.limit_samples)
+metrics.gauge("gateway_max_transfers", "Configured concurrent transfers per user",
+              fn=lambda: [((), CONTROLLER.limits["max_transfers"])])
+metrics.gauge("gateway_bandwidth_limit_bytes", "Configured shared download bandwidth (0 = unlimited)",
+              fn=lambda: [((), CONTROLLER.limits["bandwidth"])])
+metrics.gauge("gateway_active_transfers", "Uploads and downloads in progress",
+              fn=lambda: [((), sum(CONTROLLER.transfers.values()))])
+
+
+def admit(user):
+    """Run admission for the current request; returns a 429 response or None."""
+    route = request.url_rule.rule if request.url_rule else request.path
+    slot, wait = CONTROLLER.admit(user, route)
+    if wait is not None:
+        resp = jsonify({"error": "Too many requests", "retry_after": round(wait, 3)})
+        resp.status_code = 429
+        resp.headers["Retry-After"] = str(max(1, math.ceil(wait)))
+        return resp
+    if slot is not None:
+        g.admission_slot = slot
+    return None
+
+
+def shape(chunks, user):
+    return CONTROLLER.shape(chunks, user)
+
+
+def instrument(app):
+    """Release transfer slots when responses finish and add /admin/limits."""
+
+    @app.after_request
+    def _admission_finish(response):
+        slot = g.pop("admission_slot", None)
+        if slot is not None:
+            # streamed downloads hold the slot until the last byte is sent
+            response.call_on_close(slot.release)
+        return response
+
+    @app.teardown_request
+    def _admission_teardown(exc):
+        slot = g.pop("admission_slot", None)
+        if slot is not None:
+            slot.release()
+
+    @app.route("/admin/limits", methods=["GET", "PUT"])
+    def admin_limits():
+        if not ADMIN_TOKEN or request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+            return jsonify({"error": "Forbidden"}), 403
+        if request.method == "PUT":
+            update = request.get_json(silent=True)
+            if not isinstance(update, dict):
+                return jsonify({"error": "JSON object required"}), 400
+            try:
+                return jsonify(CONTROLLER.configure(update)), 200
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        return jsonify(CONTROLLER.limits), 200
+
+    return app
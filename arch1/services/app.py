@@ -2,15 +2,44 @@ import os
 import jwt
 import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask import Flask, request, jsonify, Response
-import requests, os
+from flask import Flask, request, jsonify, Response, stream_with_context
+import itertools
+import uuid
+import metrics
+import tracing
+import profiling
+import admission
+import zipstream
+import placement
 
 app = Flask(__name__)
+metrics.instrument(app)
+tracing.instrument(app, edge=True)  # clients call this service: it decides sampling
+profiling.instrument(app)
+admission.instrument(app)
 
 STORAGE_API = "http://storage:5002" # storage service URL
 METADATA_API = "http://metadata:5001" # metadata service URL
+METADATA_READ_API = os.environ.get("METADATA_READ_API", METADATA_API)  # may be a metadata follower
 SECRET_KEY = os.environ.get("SECRET_KEY", "supersecretkey") # secret key for JWT - in more secure setup, use env variable
 
+# shared session: keep-alive to storage/metadata, request ID forwarded, upstream latency recorded
+http = metrics.instrument_session(tracing.TracedSession())
+
+# read-your-writes: writes answer with the metadata log position they reached,
+# and a client that sends it back on reads sees at least that state even when
+# reads go to a metadata follower
+SEQ_HEADER = "X-Metadata-Seq"
+
+def seq_of(resp):
+    return {SEQ_HEADER: resp.headers.get(SEQ_HEADER, "")}
+
+def read_headers():
+    return {SEQ_HEADER: request.headers[SEQ_HEADER]} if SEQ_HEADER in request.headers else None
+
+# picks the storage node for each upload from the node registry (see placement.py)
+PLACEMENT = placement.Placement(http, f"{METADATA_API}/nodes", STORAGE_API)
+
 
 # --- JWT Helpers ---
 def encode_token(username):
@@ -46,14 +75,14 @@ def signup():
     hashed_password = generate_password_hash(password)
     try:
         # send to metadata service
-        resp = requests.post(f"{METADATA_API}/users", json={
+        resp = http.post(f"{METADATA_API}/users", json={
             "username": username,
             "password": hashed_password
         })
 
         # check response from metadata service
         if resp.status_code == 201:
-            return jsonify({"message": "Signup successful!"}), 201
+            return jsonify({"message": "Signup successful!"}), 201, seq_of(resp)
         elif resp.status_code == 409:
             return jsonify({"error": "Username already exists"}), 409
         else:
@@ -74,7 +103,7 @@ def login():
 
     try:
         # fetch user from metadata service
-        resp = requests.get(f"{METADATA_API}/users/{username}")
+        resp = http.get(f"{METADATA_READ_API}/users/{username}")
 
         # check the response
         if resp.status_code != 200:
@@ -93,6 +122,20 @@ def login():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# stream uploaded files back out as a multipart body without buffering them
+def multipart_body(files, boundary):
+    for file in files:
+        name = file.filename.replace('"', "%22")
+        yield (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+               f'Content-Type: {file.mimetype or "application/octet-stream"}\r\n\r\n').encode()
+        while True:
+            chunk = file.stream.read(1024 * 1024)
+            if not chunk:
+                break
+            yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
 # auth decorator
 def require_auth(f):
     def wrapper(*args, **kwargs):
@@ -109,6 +152,11 @@ def require_auth(f):
         if not username:
             return jsonify({"error": "Invalid or expired token"}), 401
         request.username = username
+
+        # per-user rate and concurrency limits (429 with Retry-After)
+        rejected = admission.admit(username)
+        if rejected is not None:
+            return rejected
         return f(*args, **kwargs)
     wrapper.__name__ = f.__name__
     return wrapper
@@ -117,25 +165,103 @@ def require_auth(f):
 @app.route("/files/upload", methods=["POST"])
 @require_auth
 def upload():
+    # admission: reserve quota for the whole request before reading its body,
+    # so an upload over quota is refused without being transferred
+    if request.content_length is None:
+        # a chunked body would reserve nothing; archives of unknown size go to /files/upload/archive
+        return jsonify({"error": "Content-Length is required"}), 411
+    try:
+        resp = http.post(f"{METADATA_API}/users/{request.username}/reservations",
+                         json={"bytes": request.content_length})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if resp.status_code == 413:
+        return resp.json(), 413
+    if resp.status_code != 201:
+        return jsonify({"error": "Metadata error - " + resp.text}), 500
+    reservation = resp.json()["reservation"]
+
+    try:
+        return forward_upload()
+    finally:
+        # the stored files now count towards usage themselves
+        try:
+            http.delete(f"{METADATA_API}/users/{request.username}/reservations/{reservation}")
+        except Exception:
+            pass  # it expires on its own
+
+def forward_upload():
     if "file" not in request.files:
         return jsonify({"error": "No file part"}), 400
     
-    # get the file
-    file = request.files["file"]
-    files = {'file': (file.filename, file.stream, file.mimetype)}
+    # get the file(s)
+    files = request.files.getlist("file")
 
-    # forward the file to the storage service via POST
-    resp = requests.post(f"{STORAGE_API}/upload", files=files)
+    # the least loaded of two storage nodes gets the upload; it stays on that node
+    with PLACEMENT.place() as storage_api:
+        if len(files) == 1:
+            # forward the file body as-is; storage ingests it in a single pass
+            file = files[0]
+            resp = http.post(f"{storage_api}/upload", params={"filename": file.filename, "user": request.username},
+                             data=file.stream, headers={"Content-Type": file.mimetype or "application/octet-stream"})
+        else:
+            # several files go to storage in one streamed multipart request,
+            # which it records in metadata with a single batch
+            boundary = uuid.uuid4().hex
+            resp = http.post(f"{storage_api}/upload", params={"user": request.username},
+                             data=multipart_body(files, boundary),
+                             headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
 
-    # check response from storage service
+    # check response from storage service; 403 if the name is another user's file
+    if resp.status_code == 403:
+        return resp.json(), 403
     if resp.status_code != 200:
         return jsonify({"error": "Storage error"}), 500
 
     try:
-        return resp.json(), resp.status_code
+        return resp.json(), resp.status_code, seq_of(resp)
     except Exception:
         return jsonify({"error": "Non-JSON response from storage", "raw": resp.text}), resp.status_code
 
+# upload a whole tree as one tar stream (optionally compressed); storage
+# unpacks it as it arrives and records every file in one metadata batch
+@app.route("/files/upload/archive", methods=["POST"])
+@require_auth
+def upload_archive():
+    # the size of a streamed archive is usually not known up front, so storage
+    # is told the quota headroom and refuses an archive that outgrows it
+    reserved = request.content_length or 0
+    try:
+        resp = http.post(f"{METADATA_API}/users/{request.username}/reservations", json={"bytes": reserved})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if resp.status_code == 413:
+        return resp.json(), 413
+    if resp.status_code != 201:
+        return jsonify({"error": "Metadata error - " + resp.text}), 500
+    reservation = resp.json()["reservation"]
+    headroom = resp.json().get("headroom") or {}
+    params = {"user": request.username, "prefix": request.args.get("prefix", "")}
+    if headroom.get("bytes") is not None:
+        params["max_bytes"] = headroom["bytes"] + reserved
+    if headroom.get("files") is not None:
+        params["max_files"] = headroom["files"] + 1  # the reservation holds one file
+
+    try:
+        with PLACEMENT.place() as storage_api:
+            resp = http.post(f"{storage_api}/upload/archive", params=params,
+                             data=request.stream,
+                             headers={"Content-Type": request.content_type or "application/x-tar"})
+        try:
+            return resp.json(), resp.status_code, seq_of(resp)
+        except Exception:
+            return jsonify({"error": "Non-JSON response from storage", "raw": resp.text}), 502
+    finally:
+        try:
+            http.delete(f"{METADATA_API}/users/{request.username}/reservations/{reservation}")
+        except Exception:
+            pass  # it expires on its own
+
 # download file endpoint
 @app.route("/files/download", methods=["GET"])
 @require_auth
@@ -145,16 +271,24 @@ def download():
     if not filename:
         return jsonify({"error": "No filename provided"}), 400
 
-    # forward request to storage service via GET
-    params = {"filename": filename}
-    resp = requests.get(f"{STORAGE_API}/download", params=params, stream=True)
+    # forward request to storage service via GET; a Range header is passed on
+    # so storage reads (and decrypts) only that part of the file. Storage
+    # answers 404 for a file that is not the caller's
+    params = {"filename": filename, "user": request.username}
+    headers = read_headers() or {}
+    if "Range" in request.headers:
+        headers["Range"] = request.headers["Range"]
+    resp = http.get(f"{STORAGE_API}/download", params=params, headers=headers, stream=True)
 
     # check response from storage service
-    if resp.status_code == 200:
+    if resp.status_code in (200, 206):
+        passthrough = {k: resp.headers[k] for k in ("Content-Length", "Content-Range", "Accept-Ranges") if k in resp.headers}
         return Response(
-            resp.iter_content(chunk_size=8192),
+            # concurrent downloads share the configured bandwidth fairly
+            admission.shape(resp.iter_content(chunk_size=8192), request.username),
+            status=resp.status_code,
             content_type=resp.headers.get('Content-Type'),
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
+            headers={"Content-Disposition": f"attachment; filename={filename}", **passthrough}
         )
     else:
         try:
@@ -162,36 +296,175 @@ def download():
         except Exception:
             return jsonify({"error": "File not found - " + resp.text}), 404
 
+# download several files as one zip, generated while it is sent (see
+# zipstream.py): ?filename= (repeated) for those files, or ?prefix= for all
+# of the caller's files under a path
+ARCHIVE_PAGE = 1000  # records asked of metadata at a time for ?prefix=
+
+def prefix_records(prefix):
+    # the caller's files under prefix in name order, fetched a page at a time as the zip is sent
+    after = None
+    while True:
+        params = {"owner": request.username, "prefix": prefix, "sort": "name", "limit": ARCHIVE_PAGE}
+        if after is not None:
+            params["after"] = after
+        resp = http.get(f"{METADATA_READ_API}/catalog/query", params=params, headers=read_headers())
+        resp.raise_for_status()
+        page = resp.json()["files"]
+        yield from page
+        if len(page) < ARCHIVE_PAGE:
+            return
+        after = page[-1]["filename"]
+
+@app.route("/files/download/archive", methods=["GET"])
+@require_auth
+def download_archive():
+    filenames = list(dict.fromkeys(request.args.getlist("filename")))
+    prefix = request.args.get("prefix")
+    if not filenames and prefix is None:
+        return jsonify({"error": "No filename or prefix provided"}), 400
+
+    if filenames:
+        resp = http.post(f"{METADATA_API}/catalog/batch",
+                         json={"ops": [{"op": "get", "filename": filename} for filename in filenames]})
+        if resp.status_code != 200:
+            return jsonify({"error": "Metadata error - " + resp.text}), 500
+        results = resp.json()["results"]
+        missing = [r["filename"] for r in results if r["status"] != 200 or r["file"].get("user") != request.username]
+        if missing:
+            return jsonify({"error": "File not found", "files": missing}), 404
+        records = iter([r["file"] for r in results])
+        archive_name = "files.zip"
+    else:
+        records = prefix_records(prefix)
+        try:
+            first = next(records, None)
+        except Exception as e:
+            return jsonify({"error": f"Metadata error - {e}"}), 500
+        if first is None:
+            return jsonify({"error": "No files match"}), 404
+        records = itertools.chain([first], records)
+        archive_name = (prefix.rstrip("/").rsplit("/", 1)[-1] or "files") + ".zip"
+
+    def generate():
+        writer = zipstream.ZipWriter()
+        for record in records:
+            resp = http.get(f"{STORAGE_API}/download", params={"filename": record["filename"]},
+                            headers=read_headers(), stream=True)
+            try:
+                if resp.status_code != 200:
+                    # the status line is long gone; cutting the stream short is all that is left
+                    raise zipstream.ZipError(f"{record['filename']}: storage answered {resp.status_code}")
+                yield from writer.entry(record["filename"], resp.iter_content(chunk_size=64 * 1024),
+                                        record.get("size") or 0, record.get("modified"),
+                                        record.get("crc32"), record.get("mime"))
+            finally:
+                resp.close()
+        yield from writer.finish()
+
+    return Response(
+        # shares the download bandwidth fairly, like single downloads
+        admission.shape(stream_with_context(generate()), request.username),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={archive_name}"}
+    )
+
 # list files endpoint
 @app.route("/files", methods=["GET"])
 @require_auth
 def list_files():
     # forward request to metadata service via GET
-    resp = requests.get(f"{METADATA_API}/files")
+    resp = http.get(f"{METADATA_READ_API}/files", headers=read_headers())
 
     # check response from metadata service
     if resp.status_code == 200:
-        return resp.json(), resp.status_code
+        # the cursor to follow /changes from, so clients need not re-list to sync
+        return resp.json(), resp.status_code, {"X-Change-Cursor": resp.headers.get("X-Change-Cursor", "")}
     else:
         return jsonify({"error": "Metadata error - " + resp.text}), 500
 
+# storage used by the caller, with their quota
+@app.route("/usage", methods=["GET"])
+@require_auth
+def get_usage():
+    resp = http.get(f"{METADATA_API}/users/{request.username}/usage")  # the trash is only on the leader
+    if resp.status_code == 200:
+        return resp.json(), 200
+    return jsonify({"error": "Metadata error - " + resp.text}), 500
+
+# search the caller's files by name prefix, size, modification time and MIME type
+@app.route("/files/query", methods=["GET"])
+@require_auth
+def query_files():
+    # forward the filters to the metadata service, which answers from its indexes;
+    # only the caller's own files are searched, whatever owner= says
+    params = {**request.args.to_dict(), "owner": request.username}
+    resp = http.get(f"{METADATA_READ_API}/catalog/query", params=params, headers=read_headers())
+    try:
+        return resp.json(), resp.status_code
+    except Exception:
+        return jsonify({"error": "Metadata error - " + resp.text}), 500
+
+# changes to files since a cursor; long-polls until there are some or the timeout passes
+@app.route("/changes", methods=["GET"])
+@require_auth
+def list_changes():
+    resp = http.get(f"{METADATA_READ_API}/changes", params=request.args, headers=read_headers())
+    try:
+        # 410 carries the current cursor to resync from
+        return resp.json(), resp.status_code
+    except Exception:
+        return jsonify({"error": "Metadata error - " + resp.text}), 500
+
 # delete file endpoint
 @app.route("/files/delete", methods=["DELETE"])
 @require_auth
 def delete_file():
-    # get the filename from query parameters
-    filename = request.args.get("filename")
-    if not filename:
+    # get the filename(s) from query parameters; repeat ?filename= to delete several
+    filenames = request.args.getlist("filename")
+    if not filenames:
         return jsonify({"error": "No filename provided"}), 400
     
-    # forward request to storage service via DELETE
-    params = {"filename": filename}
-    resp = requests.delete(f"{STORAGE_API}/delete", params=params)
+    # forward request to storage service via DELETE; only the caller's files are deleted
+    params = {"filename": filenames, "user": request.username}
+    resp = http.delete(f"{STORAGE_API}/delete", params=params)
     # check response from metadata service
     if resp.status_code == 200:
-        return resp.json(), resp.status_code
+        return resp.json(), resp.status_code, seq_of(resp)
+    elif resp.status_code == 404:
+        return resp.json(), 404
     else:
         return jsonify({"error": "Delete error - " + resp.text}), 500
 
+# files the caller deleted that can still be restored, newest first
+@app.route("/trash", methods=["GET"])
+@require_auth
+def list_trash():
+    resp = http.get(f"{METADATA_API}/trash", params={"user": request.username})
+    if resp.status_code == 200:
+        return resp.json(), 200
+    return jsonify({"error": "Metadata error - " + resp.text}), 500
+
+# restore a deleted file: ?trash_id=, or ?filename= for the most recently deleted one of that name
+@app.route("/trash/restore", methods=["POST"])
+@require_auth
+def restore_file():
+    trash_id = request.args.get("trash_id")
+    filename = request.args.get("filename")
+    if not trash_id and not filename:
+        return jsonify({"error": "No filename or trash_id provided"}), 400
+
+    # only the caller's own trash is searched, so nobody restores someone else's file
+    resp = http.get(f"{METADATA_API}/trash", params={"user": request.username})
+    if resp.status_code != 200:
+        return jsonify({"error": "Metadata error - " + resp.text}), 500
+    entry = next((e for e in resp.json()["files"]
+                  if e["trash_id"] == trash_id or (not trash_id and e["filename"] == filename)), None)
+    if entry is None:
+        return jsonify({"error": "Not in trash"}), 404
+
+    resp = http.post(f"{METADATA_API}/trash/{entry['trash_id']}/restore")
+    return resp.json(), resp.status_code, seq_of(resp)
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""Placement of new uploads on storage nodes.
+
+The node list comes from the registry in metadata (``GET /nodes``), which
+storage nodes keep current with heartbeats (free space, transfers in
+progress, recent latency not counting the time moving file bodies) and
+which marks nearly full or slow nodes as draining. It is cached for
+``PLACEMENT_REFRESH`` seconds.
+
+Each upload samples ``PLACEMENT_CHOICES`` nodes that are up, weighted by
+free space, and goes to the one with the lowest expected delay: the node's
+recent transfer latency times one plus the uploads this gateway has in
+progress there. Queue lengths in the reports are seconds old; the latency
+already reflects them, and the gateway's own count is current. Comparing
+two random nodes instead of all of them keeps gateways acting on the same
+reports from all piling onto the node that looked best ("power of two
+choices"). See benchmarks/bench_placement.py.
+
+Without a registry answer, or with no node up, uploads go to the
+configured ``STORAGE_API`` as before.
+"""
+import os
+import random
+import statistics
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+REFRESH = float(os.environ.get("PLACEMENT_REFRESH", "2"))  # seconds the node list is reused
+CHOICES = int(os.environ.get("PLACEMENT_CHOICES", "2"))
+
+PLACEMENTS = metrics.counter("gateway_placements_total", "Uploads sent to each storage node", ["node"])
+
+
+def score(node, active, default_latency):
+    """Expected delay of one more upload to ``node``."""
+    # a node that finished nothing since its last heartbeat is assumed typical
+    latency = node.get("latency_ms") or default_latency
+    return (1 + active.get(node["id"], 0)) * latency
+
+
+def pick(nodes, active, rng=random, choices=CHOICES):
+    """Of ``choices`` nodes sampled by free space, the one with the lowest score."""
+    if len(nodes) <= choices:
+        sample = rng.sample(nodes, len(nodes))  # random order, so ties do not always go to the same node
+    else:
+        weights = [max(n.get("free_bytes") or 0, 1) for n in nodes]
+        sample = []
+        while len(sample) < choices:
+            n = rng.choices(nodes, weights)[0]
+            if n not in sample:
+                sample.append(n)
+    latencies = [n["latency_ms"] for n in nodes if n.get("latency_ms")]
+    default_latency = statistics.median(latencies) if latencies else 1
+    return min(sample, key=lambda n: score(n, active, default_latency))
+
+
+class Placement:
+    def __init__(self, http, nodes_api, fallback):
+        self.http = http
+        self.nodes_api = nodes_api
+        self.fallback = fallback
+        self.lock = threading.Lock()
+        self.nodes = []  # nodes that are up, from the last registry read
+        self.fetched = 0.0
+        self.active = {}  # node id -> uploads this gateway has in progress there
+
+    def _refresh(self):
+        if time.monotonic() - self.fetched < REFRESH:
+            return
+        self.fetched = time.monotonic()
+        try:
+            r = self.http.get(self.nodes_api, timeout=REFRESH)
+            r.raise_for_status()
+            self.nodes = [n for n in r.json()["nodes"] if n["state"] == "up"]
+        except Exception as e:
+            print(f"node registry unavailable, keeping {len(self.nodes)} known nodes: {e}")
+
+    def choose(self):
+        """(node id, base URL); the node id is None for the fallback."""
+        with self.lock:
+            self._refresh()
+            if not self.nodes:
+                return None, self.fallback
+            node = pick(self.nodes, self.active)
+            return node["id"], node["url"]
+
+    @contextmanager
+    def place(self):
+        """Base URL to send one upload to, counted as in progress until the block exits."""
+        node_id, url = self.choose()
+        PLACEMENTS.inc(node=node_id or "default")
+        with self.lock:
+            self.active[node_id] = self.active.get(node_id, 0) + 1
+        try:
+            yield url
+        finally:
+            with self.lock:
+                left = self.active[node_id] - 1
+                if left:
+                    self.active[node_id] = left
+                else:
+                    del self.active[node_id]
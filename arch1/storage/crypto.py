@@ -0,0 +1,243 @@
+"""Encryption at rest for stored objects.
+
+Every object gets its own random 256-bit data key, wrapped (AES-GCM) with
+the master key from ``STORAGE_ENCRYPTION_KEY`` or the file named by
+``STORAGE_ENCRYPTION_KEY_FILE`` and kept in the object's header. The master
+key never touches the storage volume, so ``/storage`` and its ``/backup``
+copies hold only ciphertext.
+
+The body is split into ``CRYPTO_CHUNK_SIZE`` chunks, each sealed with
+AES-256-GCM on its own: the nonce is the chunk index and the associated
+data marks the last chunk, so chunks cannot be reordered and a truncated
+file fails authentication. Chunk ``i`` sits at a fixed offset, which lets
+a range read decrypt only the chunks it touches, and lets chunks be
+encrypted and decrypted on a thread pool (``CRYPTO_THREADS``) while the
+next ones are read or written.
+
+    header   magic, chunk size, master key ID, wrapped data key
+    chunks   ciphertext + 16-byte tag, all but the last CHUNK_SIZE long
+"""
+import base64
+import collections
+import hashlib
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+CHUNK_SIZE = int(os.environ.get("CRYPTO_CHUNK_SIZE", str(1024 * 1024)))
+# chunks sealed or opened in parallel; with one CPU a pool only adds hand-offs
+THREADS = int(os.environ.get("CRYPTO_THREADS", str(os.cpu_count() or 1)))
+WINDOW = 2  # chunks in flight per worker
+
+HEADER = struct.Struct(">4sI8s60s")  # magic, chunk size, master key ID, nonce + wrapped key + tag
+MAGIC = b"MDE1"
+TAG_SIZE = 16
+NONCE_SIZE = 12
+
+
+class DecryptionError(Exception):
+    """Stored bytes failed authentication, or were sealed with another master key."""
+
+
+def _load_master_key():
+    value = os.environ.get("STORAGE_ENCRYPTION_KEY")
+    path = os.environ.get("STORAGE_ENCRYPTION_KEY_FILE")
+    if not value and path:
+        with open(path) as f:
+            value = f.read().strip()
+    if not value:
+        return None
+    key = base64.b64decode(value)
+    if len(key) != 32:
+        raise ValueError("the storage encryption key must be 32 bytes, base64 encoded")
+    return key
+
+
+MASTER_KEY = _load_master_key()
+ENABLED = MASTER_KEY is not None  # new objects are encrypted only when a master key is configured
+KEY_ID = hashlib.sha256(MASTER_KEY).digest()[:8] if ENABLED else None
+
+_pool = None
+
+
+def _executor():
+    global _pool
+    if THREADS <= 1:
+        return None
+    if _pool is None:
+        _pool = ThreadPoolExecutor(THREADS, thread_name_prefix="crypto")
+    return _pool
+
+
+def _nonce(index):
+    return index.to_bytes(NONCE_SIZE, "big")
+
+
+def _aad(index, last):
+    return struct.pack(">Q?", index, last)
+
+
+# ---------------- keys ----------------
+def _new_header():
+    data_key = AESGCM.generate_key(bit_length=256)
+    nonce = os.urandom(NONCE_SIZE)
+    wrapped = nonce + AESGCM(MASTER_KEY).encrypt(nonce, data_key, MAGIC + KEY_ID)
+    return HEADER.pack(MAGIC, CHUNK_SIZE, KEY_ID, wrapped), AESGCM(data_key)
+
+
+def _open_header(header):
+    """(AESGCM with the object's data key, chunk size)."""
+    if len(header) < HEADER.size:
+        raise DecryptionError("object is shorter than its header")
+    magic, chunk_size, key_id, wrapped = HEADER.unpack(header[:HEADER.size])
+    if magic != MAGIC:
+        raise DecryptionError("not an encrypted object")
+    if not ENABLED or key_id != KEY_ID:
+        raise DecryptionError(f"object was encrypted with master key {key_id.hex()}, which is not configured")
+    try:
+        data_key = AESGCM(MASTER_KEY).decrypt(wrapped[:NONCE_SIZE], wrapped[NONCE_SIZE:], MAGIC + key_id)
+    except InvalidTag:
+        raise DecryptionError("object header failed authentication")
+    return AESGCM(data_key), chunk_size
+
+
+def _chunk_count(stored_size, chunk_size):
+    body = stored_size - HEADER.size
+    return max(1, -(-body // (chunk_size + TAG_SIZE)))
+
+
+def _plain_size(stored_size, chunk_size):
+    return stored_size - HEADER.size - _chunk_count(stored_size, chunk_size) * TAG_SIZE
+
+
+def plaintext_size(f):
+    """Size of the original object behind the encrypted file ``f``."""
+    fd = f.fileno()
+    header = os.pread(fd, HEADER.size, 0)
+    if len(header) < HEADER.size or header[:4] != MAGIC:
+        raise DecryptionError("not an encrypted object")
+    return _plain_size(os.fstat(fd).st_size, HEADER.unpack(header)[1])
+
+
+def _open_chunk(aead, index, last, sealed):
+    try:
+        return aead.decrypt(_nonce(index), sealed, _aad(index, last))
+    except InvalidTag:
+        raise DecryptionError(f"chunk {index} failed authentication")
+
+
+# ---------------- writing ----------------
+class EncryptingWriter:
+    """Writes a header, then sealed chunks, to ``f``; ``finish`` seals the last one.
+
+    Full chunks are sealed on the pool while more data arrives; up to
+    ``WINDOW`` per worker are in flight, and they are written in order.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        header, self.aead = _new_header()
+        f.write(header)
+        self.buffer = bytearray()
+        self.index = 0
+        self.pending = collections.deque()  # futures of sealed chunks not yet written
+        self.pool = _executor()
+
+    def _seal(self, chunk, last):
+        index = self.index
+        self.index += 1
+        if self.pool is None:
+            self.f.write(self.aead.encrypt(_nonce(index), chunk, _aad(index, last)))
+            return
+        self.pending.append(self.pool.submit(self.aead.encrypt, _nonce(index), chunk, _aad(index, last)))
+        while len(self.pending) > WINDOW * THREADS:
+            self.f.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        # a full chunk is held back until more data shows it is not the last
+        while len(self.buffer) > CHUNK_SIZE:
+            with memoryview(self.buffer) as view:
+                chunk = bytes(view[:CHUNK_SIZE])
+            del self.buffer[:CHUNK_SIZE]
+            self._seal(chunk, last=False)
+        return len(data)
+
+    def finish(self):
+        self._seal(bytes(self.buffer), last=True)
+        self.buffer = bytearray()
+        while self.pending:
+            self.f.write(self.pending.popleft().result())
+
+
+def seal(data):
+    """Encrypted form of an object held in memory (small ones, for the segment store)."""
+    header, aead = _new_header()
+    parts = [header]
+    count = max(1, -(-len(data) // CHUNK_SIZE))
+    view = memoryview(data)
+    for index in range(count):
+        chunk = view[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE]
+        parts.append(aead.encrypt(_nonce(index), bytes(chunk), _aad(index, index == count - 1)))
+    return b"".join(parts)
+
+
+def unseal(blob):
+    aead, chunk_size = _open_header(blob)
+    count = _chunk_count(len(blob), chunk_size)
+    step = chunk_size + TAG_SIZE
+    return b"".join(_open_chunk(aead, i, i == count - 1, blob[HEADER.size + i * step:HEADER.size + (i + 1) * step])
+                    for i in range(count))
+
+
+# ---------------- reading ----------------
+def read_range(f, start=0, stop=None):
+    """Yield the plaintext of bytes [start, stop) of the encrypted file ``f``.
+
+    Only the chunks overlapping the range are read and decrypted. The caller
+    closes ``f``, after closing this generator.
+    """
+    pending = collections.deque()
+    try:
+        fd = f.fileno()
+        stored = os.fstat(fd).st_size
+        aead, chunk_size = _open_header(os.pread(fd, HEADER.size, 0))
+        count = _chunk_count(stored, chunk_size)
+        size = _plain_size(stored, chunk_size)
+        stop = size if stop is None else min(stop, size)
+        if start >= stop:
+            return
+        first, last = start // chunk_size, (stop - 1) // chunk_size
+        step = chunk_size + TAG_SIZE
+
+        def load(index):
+            sealed = os.pread(fd, step, HEADER.size + index * step)
+            return _open_chunk(aead, index, index == count - 1, sealed)
+
+        def chunks():
+            pool = _executor()
+            if pool is None:
+                for index in range(first, last + 1):
+                    yield index, load(index)
+                return
+            for index in range(first, last + 1):
+                pending.append((index, pool.submit(load, index)))
+                if len(pending) >= WINDOW * THREADS:
+                    done, future = pending.popleft()
+                    yield done, future.result()
+            while pending:
+                done, future = pending.popleft()
+                yield done, future.result()
+
+        for index, chunk in chunks():
+            lo = start - index * chunk_size if index == first else 0
+            hi = stop - index * chunk_size if index == last else len(chunk)
+            yield chunk[lo:hi] if lo or hi < len(chunk) else chunk
+    finally:
+        # a client that went away leaves reads in flight; they must not outlive the fd
+        for _, future in pending:
+            future.cancel()
+        wait([future for _, future in pending])
@@ -0,0 +1,107 @@
+"""Holding object removals while a backup copies the volume.
+
+A backup takes a metadata snapshot and then copies the storage volume.
+Every object the snapshot refers to must still be on disk when the copy
+reaches it, including the previous versions of files overwritten and the
+trashed files reclaimed in the meantime. So before taking the snapshot the
+backup places a hold on each storage node (``POST /backup/hold``): while
+one is active, removals are queued instead of done, segment compaction and
+scrubber quarantine wait, and new objects are only ever added. The queue
+is worked off when the last hold is released (``DELETE /backup/hold/<id>``)
+or expires after its TTL, so a backup that dies cannot hold removals for
+ever.
+
+The queue lives in memory: removals still queued when the process stops
+are not done, and the scrubber later reports their objects as orphans.
+"""
+import os
+import threading
+import time
+import uuid
+
+import metrics
+
+TTL = float(os.environ.get("BACKUP_HOLD_TTL", "7200"))  # seconds a hold lasts unless released first
+MAX_TTL = 24 * 3600
+
+HOLD_STATE = metrics.gauge("storage_backup_hold", "Active backup holds and removals waiting for them", ["kind"])
+
+
+class RemovalHold:
+    def __init__(self, remove):
+        self.remove = remove  # deletes one record's object
+        self.holds = {}  # hold id -> expiry (monotonic)
+        self.pending = []  # records whose removal waits for the holds
+        self.lock = threading.Lock()
+        self._gauge()
+
+    def _gauge(self):
+        HOLD_STATE.set(len(self.holds), kind="holds")
+        HOLD_STATE.set(len(self.pending), kind="pending")
+
+    def acquire(self, ttl=TTL):
+        hold_id = uuid.uuid4().hex
+        with self.lock:
+            self.holds[hold_id] = time.monotonic() + min(max(ttl, 1), MAX_TTL)
+            self._gauge()
+        return hold_id
+
+    def release(self, hold_id):
+        """False if there is no such hold (released already, or expired)."""
+        with self.lock:
+            found = self.holds.pop(hold_id, None) is not None
+            self._gauge()
+        self._flush()
+        return found
+
+    def _expire(self):
+        now = time.monotonic()
+        for hold_id, expires in list(self.holds.items()):
+            if expires <= now:
+                del self.holds[hold_id]
+                print(f"backup hold {hold_id} expired")
+
+    def active(self):
+        with self.lock:
+            self._expire()
+            return bool(self.holds)
+
+    def defer(self, record):
+        """True if ``record``'s removal was queued because a hold is active."""
+        with self.lock:
+            self._expire()
+            if not self.holds:
+                return False
+            self.pending.append(record)
+            self._gauge()
+            return True
+
+    def _flush(self):
+        with self.lock:
+            self._expire()
+            if self.holds or not self.pending:
+                return
+            pending, self.pending = self.pending, []
+            self._gauge()
+        for record in pending:
+            try:
+                self.remove(record)
+            except Exception as e:
+                print(f"held removal of {record.get('object_id')} failed: {e}")
+
+    def status(self):
+        with self.lock:
+            self._expire()
+            now = time.monotonic()
+            return {
+                "holds": {hold_id: round(expires - now, 1) for hold_id, expires in self.holds.items()},
+                "pending": len(self.pending),
+            }
+
+    def start(self, interval=30):
+        # works off the queue once the holds have expired without being released
+        def loop():
+            while True:
+                time.sleep(interval)
+                self._flush()
+        threading.Thread(target=loop, daemon=True).start()
@@ -0,0 +1,398 @@
+"""Minimal Prometheus-style metrics for the mini-dropbox services.
+
+Only the standard library is needed, so the same file is copied into every
+service directory (including backup, which does not install Flask).
+
+Recording is lock-free on the hot path: every thread writes into its own
+shard, and shards are only merged when ``/metrics`` is scraped. When several
+worker processes serve the same app, set ``METRICS_DIR`` to a shared
+directory; each process periodically dumps its totals there and the scrape
+merges all of them.
+"""
+import json
+import os
+import threading
+import time
+
+METRICS_DIR = os.environ.get("METRICS_DIR")  # shared dir for multi-process workers
+FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1024, 16384, 65536, 262144, 1048576, 16777216, 268435456, 1073741824)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()  # only taken for shard (de)registration and gauge sets
+        self._shards = []  # (thread, shard) pairs
+        self._retired = {}  # totals folded in from threads that have exited
+        self._values = {}  # gauges that are set rather than incremented
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+                if len(self._shards) % 256 == 0:
+                    self._retire_dead()
+        return shard
+
+    def _retire_dead(self):
+        # caller holds self._lock
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                _merge(self._retired, shard)
+        self._shards = alive
+
+    def collect(self):
+        """Merge every shard into one {(name, labels): value} dict."""
+        with self._lock:
+            self._retire_dead()
+            total = {}
+            _merge(total, self._retired)
+            for _, shard in self._shards:
+                _merge(total, shard.copy())
+            total.update(self._values)
+        return total
+
+    def render(self):
+        values = self.collect()
+        if METRICS_DIR:
+            _dump(values)
+            values = _merge_dir(values)
+        for metric in self.metrics.values():
+            if metric.fn is not None:
+                for labels, value in metric.fn():
+                    values[(metric.name, tuple(labels))] = value
+
+        by_name = {}
+        for (name, labels), value in values.items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for labels, value in sorted(by_name.get(metric.name, [])):
+                lines.extend(metric.expose(labels, value))
+        return "\n".join(lines) + "\n"
+
+
+def _merge(into, shard):
+    for key, value in shard.items():
+        if isinstance(value, list):
+            current = into.get(key)
+            if current is None:
+                into[key] = list(value)
+            else:
+                for i, v in enumerate(value):
+                    current[i] += v
+        else:
+            into[key] = into.get(key, 0) + value
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=(), fn=None, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self._registry = registry
+        registry.metrics[name] = self
+
+    def _key(self, labels):
+        return (self.name, tuple(str(labels.get(n, "")) for n in self.labelnames))
+
+    def _fmt(self, labels, extra=()):
+        pairs = list(zip(self.labelnames, labels)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+    def expose(self, labels, value):
+        return [f"{self.name}{self._fmt(labels)} {_num(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        shard = self._registry._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        shard = self._registry._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._registry._lock:
+            self._registry._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, help, labelnames, registry=registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        shard = self._registry._shard()
+        key = self._key(labels)
+        counts = shard.get(key)
+        if counts is None:
+            # one slot per bucket, then +Inf, sum
+            counts = shard[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[len(self.buckets)] += 1
+        counts[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def expose(self, labels, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{self._fmt(labels, [('le', _num(bound))])} {_num(cumulative)}")
+        lines.append(f"{self.name}_sum{self._fmt(labels)} {_num(counts[-1])}")
+        lines.append(f"{self.name}_count{self._fmt(labels)} {_num(cumulative)}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def counter(name, help, labelnames=()):
+    return Counter(name, help, labelnames)
+
+
+def gauge(name, help, labelnames=(), fn=None):
+    """``fn`` makes a callback gauge: it returns [(label_values, value)] at scrape time."""
+    return Gauge(name, help, labelnames, fn=fn)
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return Histogram(name, help, labelnames, buckets)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _num(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# ---------------- Multi-process support ----------------
+def _dump(values):
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump([[name, list(labels), value] for (name, labels), value in values.items()], f)
+    os.replace(tmp, path)
+
+
+def _merge_dir(own):
+    merged = dict(own)
+    for entry in os.scandir(METRICS_DIR):
+        if not entry.name.startswith("metrics-") or not entry.name.endswith(".json"):
+            continue
+        pid = int(entry.name[len("metrics-"):-len(".json")])
+        if pid == os.getpid():
+            continue
+        alive = _pid_alive(pid)
+        try:
+            with open(entry.path) as f:
+                rows = json.load(f)
+        except (OSError, ValueError):
+            continue
+        other = {}
+        for name, labels, value in rows:
+            metric = REGISTRY.metrics.get(name)
+            # in-flight style gauges from a dead worker are meaningless
+            if metric is not None and metric.kind == "gauge" and not alive:
+                continue
+            other[(name, tuple(labels))] = value
+        _merge(merged, other)
+    return merged
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            _dump(REGISTRY.collect())
+        except OSError:
+            pass
+
+
+if METRICS_DIR:
+    threading.Thread(target=_flush_loop, daemon=True).start()
+
+
+# ---------------- Standard HTTP / upstream metrics ----------------
+HTTP_REQUESTS = counter("http_requests_total", "HTTP requests handled", ["route", "method", "status"])
+HTTP_LATENCY = histogram("http_request_duration_seconds", "Time from request start to end of response body", ["route", "method"])
+HTTP_IN_FLIGHT = gauge("http_requests_in_flight", "Requests currently being served", ["route"])
+HTTP_BYTES_IN = counter("http_request_bytes_total", "Request body bytes received", ["route"])
+HTTP_BYTES_OUT = counter("http_response_bytes_total", "Response body bytes sent", ["route"])
+UPSTREAM_LATENCY = histogram("upstream_request_duration_seconds", "Latency of calls to other services", ["target", "method"])
+UPSTREAM_REQUESTS = counter("upstream_requests_total", "Calls to other services", ["target", "method", "status"])
+
+
+def instrument(app):
+    """Record per-route HTTP metrics for a Flask app and expose ``/metrics``."""
+    from flask import Response, g, request
+
+    @app.before_request
+    def _metrics_start():
+        g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+        g.metrics_start = time.perf_counter()
+        HTTP_IN_FLIGHT.inc(route=g.metrics_route)
+        HTTP_BYTES_IN.inc(request.content_length or 0, route=g.metrics_route)
+
+    @app.after_request
+    def _metrics_finish(response):
+        route = g.get("metrics_route")
+        if route is None:
+            return response
+        g.metrics_finished = True
+        start = g.metrics_start
+        method = request.method
+        HTTP_REQUESTS.inc(route=route, method=method, status=response.status_code)
+
+        if response.is_streamed:
+            response.response = _count_bytes(response.response, route)
+            # a passed-through body is handed to the server as is, and closing it
+            # would not run the call_on_close handlers (done() below among them)
+            response.direct_passthrough = False
+        else:
+            HTTP_BYTES_OUT.inc(response.content_length or 0, route=route)
+
+        def done():
+            HTTP_LATENCY.observe(time.perf_counter() - start, route=route, method=method)
+            HTTP_IN_FLIGHT.dec(route=route)
+        response.call_on_close(done)
+        return response
+
+    @app.teardown_request
+    def _metrics_teardown(exc):
+        # after_request is skipped when the handler raised (and the debug server re-raises)
+        route = g.get("metrics_route")
+        if route is None or g.get("metrics_finished"):
+            return
+        HTTP_REQUESTS.inc(route=route, method=request.method, status=500)
+        HTTP_LATENCY.observe(time.perf_counter() - g.metrics_start, route=route, method=request.method)
+        HTTP_IN_FLIGHT.dec(route=route)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+    return app
+
+
+def in_flight():
+    """Requests this process is serving right now, not counting /metrics scrapes."""
+    return sum(value for (name, labels), value in REGISTRY.collect().items()
+               if name == HTTP_IN_FLIGHT.name and labels != ("/metrics",))
+
+
+def _count_bytes(body, route):
+    sent = 0
+    try:
+        for chunk in body:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        HTTP_BYTES_OUT.inc(sent, route=route)
+        close = getattr(body, "close", None)
+        if close is not None:
+            close()
+
+
+def instrument_session(session):
+    """Record latency of every call made through a ``requests.Session``, by target host."""
+    from urllib.parse import urlsplit
+
+    def hook(resp, *args, **kwargs):
+        target = urlsplit(resp.url).hostname or "unknown"
+        method = resp.request.method
+        UPSTREAM_LATENCY.observe(resp.elapsed.total_seconds(), target=target, method=method)
+        UPSTREAM_REQUESTS.inc(target=target, method=method, status=resp.status_code)
+
+    session.hooks["response"].append(hook)
+    return session
+
+
+def serve(port):
+    """Serve ``/metrics`` from a background thread, for processes without Flask."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = REGISTRY.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,116 @@
+"""Move files from the old flat /storage layout into the hashed fan-out tree.
+
+Runs next to the live storage service (same volume), e.g.
+
+    docker-compose exec storage python migrate_layout.py --rate 200
+
+For each flat file that metadata still points at:
+  1. hard-link it into objects/ab/cd/<object_id> (no data copy, same volume),
+  2. switch the metadata record to the new path with a compare-and-swap on
+     the old path, so a concurrent re-upload of the same name wins,
+  3. after a grace period, unlink the flat name.
+
+Downloads keep working throughout: metadata always points at a path that
+exists, and in-flight reads of the old path get the grace period to open it.
+Flat files without metadata are only reported.
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+from urllib.parse import quote
+
+import requests
+
+import layout
+
+STORAGE_PATH = os.environ.get("STORAGE_PATH", "/storage")
+METADATA_API = os.environ.get("METADATA_API", "http://metadata:5001/files")
+
+
+def flat_files(root):
+    for entry in sorted(os.scandir(root), key=lambda e: e.name):
+        if entry.is_file(follow_symlinks=False) and not entry.name.startswith("."):
+            yield entry.name, entry.path
+
+
+def migrate_one(http, root, filename, flat_path, dry_run):
+    r = http.get(f"{METADATA_API}/{quote(filename)}")
+    if r.status_code == 404:
+        return "orphan"
+    r.raise_for_status()
+    record = r.json()
+    if record.get("path") != flat_path:
+        return "skipped"  # already migrated or re-uploaded
+    if dry_run:
+        return "migrated"
+
+    object_id = layout.new_object_id()
+    new_path = layout.object_path(root, object_id, create=True)
+    try:
+        os.link(flat_path, new_path)
+    except OSError:
+        shutil.copy2(flat_path, new_path)  # e.g. filesystems without hard links
+
+    update = {k: v for k, v in record.items() if k not in ("object_id", "path")}
+    update.update(object_id=object_id, path=new_path, if_path=flat_path)
+    r = http.post(METADATA_API, json=update)
+    if r.status_code == 409:
+        os.remove(new_path)
+        return "skipped"
+    r.raise_for_status()
+    return "migrated"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate flat storage files into the fan-out layout")
+    parser.add_argument("--root", default=STORAGE_PATH)
+    parser.add_argument("--rate", type=float, default=100, help="Max files per second (0 = unlimited)")
+    parser.add_argument("--grace", type=float, default=30, help="Seconds to keep old names for in-flight reads")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    http = requests.Session()
+    counts = {"migrated": 0, "skipped": 0, "orphan": 0, "failed": 0}
+    pending_unlink = []
+    interval = 1.0 / args.rate if args.rate > 0 else 0
+
+    for filename, flat_path in flat_files(args.root):
+        started = time.monotonic()
+        try:
+            outcome = migrate_one(http, args.root, filename, flat_path, args.dry_run)
+        except Exception as e:
+            print(f"failed: {filename}: {e}", file=sys.stderr)
+            outcome = "failed"
+        counts[outcome] += 1
+        if outcome == "orphan":
+            print(f"orphan (no metadata, left in place): {filename}")
+        elif outcome == "migrated" and not args.dry_run:
+            pending_unlink.append((time.monotonic() + args.grace, flat_path))
+
+        # unlink old names whose grace period is over
+        while pending_unlink and pending_unlink[0][0] <= time.monotonic():
+            _unlink(pending_unlink.pop(0)[1])
+
+        spare = interval - (time.monotonic() - started)
+        if spare > 0:
+            time.sleep(spare)
+
+    if pending_unlink:
+        time.sleep(max(0, pending_unlink[-1][0] - time.monotonic()))
+        for _, flat_path in pending_unlink:
+            _unlink(flat_path)
+
+    print(", ".join(f"{k}: {v}" for k, v in counts.items()))
+
+
+def _unlink(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+if __name__ == "__main__":
+    main()
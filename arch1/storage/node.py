@@ -0,0 +1,129 @@
+"""This storage node's identity, its heartbeats, and the way to its peers.
+
+With more than one storage container, each object lives on the node that
+received its upload; the metadata record names that node. Every
+``HEARTBEAT_INTERVAL`` seconds the node reports to the registry in
+metadata (``POST /nodes/<id>/heartbeat``) its URL, free and total disk,
+transfers in progress and the mean latency of the transfers it finished
+since the last heartbeat. The gateways place uploads from those reports.
+
+The latency leaves out moving the body, which takes as long as the file
+is big however healthy the node: a download counts until its first byte
+is ready (metadata lookup, opening the file), an upload from when its body
+has arrived until it is answered (commit, fsync, metadata registration).
+
+``peer_url`` resolves another node's URL through the same registry, so a
+download or delete that reaches the wrong node can be sent on.
+"""
+import os
+import shutil
+import threading
+import time
+
+import metrics
+
+NODE_ID = os.environ.get("STORAGE_NODE_ID", "storage")  # must stay the same across restarts: records name it
+NODE_URL = os.environ.get("STORAGE_NODE_URL", "http://storage:5002")  # how gateways and peers reach this node
+INTERVAL = float(os.environ.get("HEARTBEAT_INTERVAL", "5"))
+TRANSFER_ROUTES = ("/upload", "/download")
+PEER_CACHE_TTL = 30  # seconds a peer URL is reused before asking the registry again
+
+HEARTBEATS = metrics.counter("storage_heartbeats_total", "Heartbeats sent to the node registry", ["status"])
+TRANSFER_WAIT = metrics.histogram("storage_transfer_wait_seconds",
+                                  "Transfer time not spent moving the body: to the first byte of a download, "
+                                  "after the body of an upload", ["route"])
+
+
+class Heartbeat:
+    def __init__(self, root, http, nodes_api):
+        self.root = root
+        self.http = http
+        self.nodes_api = nodes_api
+        self.last = self._latency_totals()
+        self.peers = {}  # node id -> (url, fetched at)
+
+    @staticmethod
+    def _latency_totals():
+        # (seconds, transfers) summed over the routes of the transfer wait histogram
+        seconds = count = 0
+        for (name, labels), counts in metrics.REGISTRY.collect().items():
+            if name == TRANSFER_WAIT.name and labels[0] in TRANSFER_ROUTES:
+                seconds += counts[-1]
+                count += sum(counts[:-1])
+        return seconds, count
+
+    def report(self):
+        usage = shutil.disk_usage(self.root)
+        seconds, count = self._latency_totals()
+        last_seconds, last_count = self.last
+        self.last = seconds, count
+        latency = (seconds - last_seconds) / (count - last_count) * 1000 if count > last_count else 0
+        return {
+            "url": NODE_URL,
+            "free_bytes": usage.free,
+            "total_bytes": usage.total,
+            "in_flight": metrics.in_flight(),
+            "latency_ms": round(latency, 3),
+        }
+
+    def send(self):
+        try:
+            r = self.http.post(f"{self.nodes_api}/{NODE_ID}/heartbeat", json=self.report(), timeout=INTERVAL)
+            r.raise_for_status()
+            HEARTBEATS.inc(status="ok")
+            return r.json()
+        except Exception as e:
+            HEARTBEATS.inc(status="error")
+            print(f"heartbeat failed: {e}")
+            return None
+
+    def start(self):
+        def loop():
+            while True:
+                self.send()
+                time.sleep(INTERVAL)
+        threading.Thread(target=loop, daemon=True).start()
+
+    def peer_url(self, node_id):
+        """Base URL of another node, or None if the registry does not know it."""
+        cached = self.peers.get(node_id)
+        if cached and time.monotonic() - cached[1] < PEER_CACHE_TTL:
+            return cached[0]
+        r = self.http.get(f"{self.nodes_api}/{node_id}")
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        url = r.json()["url"]
+        self.peers[node_id] = (url, time.monotonic())
+        return url
+
+
+def instrument(app):
+    """Time the transfers of a Flask app for the heartbeat latency."""
+    from flask import g, request
+
+    @app.before_request
+    def _transfer_start():
+        if request.url_rule is not None and request.url_rule.rule in TRANSFER_ROUTES:
+            g.transfer_start = time.perf_counter()
+
+    @app.after_request
+    def _transfer_finish(response):
+        # runs once the handler has returned, before a streamed body is sent
+        start = g.get("transfer_start")
+        if start is not None and 200 <= response.status_code < 300:
+            TRANSFER_WAIT.observe(time.perf_counter() - start, route=request.url_rule.rule)
+        return response
+
+
+def body_received():
+    """Called by an upload handler once the body is in: the wait is timed from here."""
+    from flask import g
+
+    if "transfer_start" in g:
+        g.transfer_start = time.perf_counter()
+
+
+def is_local(record):
+    # records from before node placement were all written by the one storage node
+    return record.get("node") in (None, NODE_ID)
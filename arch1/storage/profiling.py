@@ -0,0 +1,300 @@
+"""On-demand sampling profiler and slow-request log for the Flask services.
+
+``POST /admin/profile?seconds=N`` samples the stack of every thread in the
+process every ``interval`` milliseconds (default ``PROFILE_INTERVAL_MS``)
+for N seconds, then answers with the stacks in collapsed format, one
+``frame;frame;... count`` line per distinct stack, ready for
+``flamegraph.pl`` or speedscope. ``DELETE /admin/profile`` ends a running
+profile early, and the POST then answers with what it sampled so far. One profile runs at a
+time. Both need ``X-Admin-Token: $ADMIN_TOKEN`` and are disabled without it.
+
+Requests slower than ``SLOW_REQUEST_SECONDS`` are logged with their
+parameters, a timing breakdown (handler, sending the body, and the time in
+each ``tracing.span``, which are timed for every request, not only sampled
+ones) and their stack: a watchdog thread looks at requests still running
+past the threshold and samples their thread's stack until they finish, so
+the stack shows where the time went rather than where the request ended.
+The last ``SLOW_REQUEST_KEEP`` are at ``GET /admin/slow-requests``; each is
+also printed and, with ``SLOW_REQUEST_LOG`` set, appended to that file as a
+JSON line.
+
+No stack is sampled unless a profile is running or a request is past the
+threshold; otherwise the cost per request is a few dict operations and
+clock reads.
+"""
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+import metrics
+
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")  # empty disables the /admin endpoints
+SERVICE_NAME = os.environ.get("SERVICE_NAME", "unknown")
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))  # default sampling period
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "300"))
+SLOW_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", "2"))  # 0 disables the slow-request log
+SLOW_LOG = os.environ.get("SLOW_REQUEST_LOG", "")  # JSON lines file; empty = only printed and kept
+SLOW_KEEP = int(os.environ.get("SLOW_REQUEST_KEEP", "100"))
+SLOW_MAX_SAMPLES = 50  # stack samples kept per slow request
+MAX_TIMINGS = 200  # spans timed per request; the rest are only counted
+REDACTED = ("password", "token", "key", "secret")  # query parameters whose values are not logged
+
+SLOW_REQUESTS = metrics.counter("http_slow_requests_total", "Requests slower than SLOW_REQUEST_SECONDS", ["route"])
+PROFILES = metrics.counter("profile_runs_total", "Sampling profiles taken", ["result"])
+
+_labels = {}  # code object -> frame label
+
+
+def _label(code):
+    label = _labels.get(code)
+    if label is None:
+        label = _labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return label
+
+
+def _stack(frame):
+    """Code objects of ``frame`` and its callers, outermost first."""
+    codes = []
+    while frame is not None:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    codes.reverse()
+    return tuple(codes)
+
+
+def collapsed(counts):
+    """Collapsed-stack text of a {stack of code objects: samples} counter, busiest first."""
+    return "".join(f"{';'.join(_label(code) for code in stack)} {count}\n" for stack, count in counts.most_common())
+
+
+# ---------------- Sampling profiler ----------------
+class Profiler:
+    """Samples every thread's stack; only while ``run`` is in progress."""
+
+    def __init__(self):
+        self.lock = threading.Lock()  # one profile at a time
+        self.stop = threading.Event()
+
+    def run(self, seconds, interval):
+        """Sample for ``seconds`` (or until ``cancel``) every ``interval`` seconds. Returns (counts, samples), or None if busy."""
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            self.stop.clear()
+            counts = collections.Counter()
+            me = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            samples = 0
+            while not self.stop.is_set() and time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident != me:
+                        counts[_stack(frame)] += 1
+                frame = None  # frames keep their locals alive
+                samples += 1
+                self.stop.wait(interval)
+            return counts, samples
+        finally:
+            self.lock.release()
+
+    def cancel(self):
+        """True if a profile was running."""
+        running = self.lock.locked()
+        self.stop.set()
+        return running
+
+
+PROFILER = Profiler()
+
+
+# ---------------- Slow requests ----------------
+class _Request:
+    __slots__ = ("thread", "start", "handled", "timings", "dropped", "samples", "stack")
+
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.handled = None  # when the handler returned
+        self.timings = []  # (span name, start offset, seconds)
+        self.dropped = 0
+        self.samples = None  # Counter of stacks, once the request is past the threshold
+        self.stack = None  # first stack taken, with line numbers
+
+    def timed(self, name, start, seconds):
+        if len(self.timings) < MAX_TIMINGS:
+            self.timings.append((name, start - self.start, seconds))
+        else:
+            self.dropped += 1
+
+
+_running = {}  # id(_Request) -> _Request, for the watchdog
+_recent = collections.deque(maxlen=SLOW_KEEP)
+_watchdog = None
+_watchdog_lock = threading.Lock()
+
+
+def _ensure_watchdog():
+    global _watchdog
+    if _watchdog is None:
+        with _watchdog_lock:
+            if _watchdog is None:
+                _watchdog = threading.Thread(target=_watch, daemon=True)
+                _watchdog.start()
+
+
+def _watch():
+    # a look every quarter of the threshold, so even a request just over it gets a sample
+    interval = max(SLOW_SECONDS / 4, 0.01)
+    while True:
+        time.sleep(interval)
+        if not _running:
+            continue
+        now = time.perf_counter()
+        slow = [entry for entry in list(_running.values()) if now - entry.start >= SLOW_SECONDS]
+        if not slow:
+            continue
+        frames = sys._current_frames()
+        for entry in slow:
+            frame = frames.get(entry.thread)
+            if frame is None:
+                continue
+            if entry.samples is None:
+                entry.samples = collections.Counter()
+                entry.stack = [f"{os.path.basename(f.f_code.co_filename)}:{f.f_lineno} in {f.f_code.co_name}"
+                               for f in _frames(frame)]
+            if sum(entry.samples.values()) < SLOW_MAX_SAMPLES:
+                entry.samples[_stack(frame)] += 1
+        frames = frame = None  # frames keep their locals alive
+
+
+def _frames(frame):
+    chain = []
+    while frame is not None:
+        chain.append(frame)
+        frame = frame.f_back
+    return chain[::-1]
+
+
+def _breakdown(entry, total):
+    spans = {}
+    for name, _, seconds in entry.timings:
+        span = spans.setdefault(name, {"count": 0, "seconds": 0.0})
+        span["count"] += 1
+        span["seconds"] = round(span["seconds"] + seconds, 6)
+    handler = (entry.handled - entry.start) if entry.handled is not None else total
+    return {
+        "total": round(total, 6),
+        "handler": round(handler, 6),
+        "send": round(total - handler, 6),  # streaming the body, after the handler returned
+        "spans": spans,
+        "first_spans": [[name, round(start, 6), round(seconds, 6)] for name, start, seconds in entry.timings[:20]],
+        "spans_not_timed": entry.dropped,
+    }
+
+
+def _params(args):
+    return {key: "***" if any(word in key.lower() for word in REDACTED) else value for key, value in args.items()}
+
+
+def _log(record):
+    _recent.append(record)
+    print(f"slow request: {record['method']} {record['path']} {record['status']} "
+          f"took {record['timing']['total']:.3f}s (request {record['request_id']})")
+    if SLOW_LOG:
+        try:
+            os.makedirs(os.path.dirname(SLOW_LOG) or ".", exist_ok=True)
+            fd = os.open(SLOW_LOG, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, (json.dumps(record) + "\n").encode())
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print(f"slow request log to {SLOW_LOG} failed: {e}")
+
+
+def recent():
+    return list(_recent)
+
+
+# ---------------- Flask ----------------
+def _admin(request):
+    return bool(ADMIN_TOKEN) and request.headers.get("X-Admin-Token") == ADMIN_TOKEN
+
+
+def instrument(app):
+    """Add the slow-request log and the admin profiling endpoints to a Flask app."""
+    from flask import Response, g, jsonify, request
+
+    if SLOW_SECONDS > 0:
+        @app.before_request
+        def _slow_start():
+            entry = g.slow_request = _Request()
+            _running[id(entry)] = entry
+            _ensure_watchdog()
+
+        @app.after_request
+        def _slow_finish(response):
+            entry = g.get("slow_request")
+            if entry is None:
+                return response
+            entry.handled = time.perf_counter()
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            method, path, args = request.method, request.path, request.args
+            request_id = g.get("request_id")
+            size = request.content_length
+            status = response.status_code
+
+            def done():
+                _running.pop(id(entry), None)
+                total = time.perf_counter() - entry.start
+                if total < SLOW_SECONDS:
+                    return
+                SLOW_REQUESTS.inc(route=route)
+                _log({
+                    "time": time.time(), "service": SERVICE_NAME, "request_id": request_id,
+                    "method": method, "path": path, "route": route, "params": _params(args), "content_length": size,
+                    "status": status, "timing": _breakdown(entry, total), "stack": entry.stack,
+                    "samples": collapsed(entry.samples) if entry.samples else "",
+                })
+            response.call_on_close(done)
+            return response
+
+        @app.teardown_request
+        def _slow_teardown(exc):
+            # after_request is skipped when the handler raised
+            entry = g.get("slow_request")
+            if entry is not None and entry.handled is None:
+                _running.pop(id(entry), None)
+
+    @app.route("/admin/profile", methods=["POST", "DELETE"])
+    def admin_profile():
+        if not _admin(request):
+            return jsonify({"error": "Forbidden"}), 403
+        if request.method == "DELETE":
+            if not PROFILER.cancel():
+                return jsonify({"error": "No profile running"}), 404
+            return jsonify({"status": "stopping"}), 200
+        try:
+            seconds = float(request.args.get("seconds", "10"))
+            interval = float(request.args.get("interval", PROFILE_INTERVAL_MS)) / 1000
+        except ValueError:
+            return jsonify({"error": "seconds and interval must be numbers"}), 400
+        if not 0 < seconds <= PROFILE_MAX_SECONDS or interval <= 0:
+            return jsonify({"error": f"seconds must be in (0, {PROFILE_MAX_SECONDS:g}] and interval positive"}), 400
+        result = PROFILER.run(seconds, interval)
+        if result is None:
+            PROFILES.inc(result="busy")
+            return jsonify({"error": "A profile is already running"}), 409
+        counts, samples = result
+        PROFILES.inc(result="ok")
+        return Response(collapsed(counts), mimetype="text/plain", headers={"X-Profile-Samples": str(samples)})
+
+    @app.route("/admin/slow-requests", methods=["GET"])
+    def admin_slow_requests():
+        if not _admin(request):
+            return jsonify({"error": "Forbidden"}), 403
+        return jsonify({"threshold": SLOW_SECONDS, "requests": recent()}), 200
+
+    return app
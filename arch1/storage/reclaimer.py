@@ -0,0 +1,82 @@
+"""Background reclaimer: free the bytes of deleted files.
+
+Deletes only move the metadata record to the trash (see metadata's
+trash.py), so they return without touching the disk. Once an entry's
+restore window is over, the reclaimer of the node holding its bytes
+removes them and then purges the entry from metadata.
+
+Every ``TRASH_RECLAIM_INTERVAL`` seconds it asks metadata for this node's
+expired entries, ``TRASH_RECLAIM_BATCH`` at a time, oldest first, until
+there are none left. Removal is capped at ``TRASH_RECLAIM_BYTES_PER_SEC``
+and waits while the service is busy, like the scrubber. An entry whose
+removal fails stays in the trash and is retried on the next round.
+"""
+import os
+import threading
+import time
+
+import metrics
+import node
+import scrubber
+
+INTERVAL = float(os.environ.get("TRASH_RECLAIM_INTERVAL", "60"))  # seconds between rounds
+BATCH = int(os.environ.get("TRASH_RECLAIM_BATCH", "100"))  # entries per metadata round trip
+BYTES_PER_SEC = float(os.environ.get("TRASH_RECLAIM_BYTES_PER_SEC", str(256 * 1024 * 1024)))  # 0 = unlimited
+
+RECLAIMED = metrics.counter("storage_reclaimed_total", "Trashed objects whose bytes were freed", ["result"])
+RECLAIMED_BYTES = metrics.counter("storage_reclaimed_bytes_total", "Bytes freed by the reclaimer")
+
+
+class Reclaimer:
+    def __init__(self, http, trash_api, remove, busy=None):
+        self.http = http
+        self.trash_api = trash_api
+        self.remove = remove  # deletes one record's object
+        self.busy = busy or (lambda: False)
+        self.limiter = scrubber.RateLimiter(BYTES_PER_SEC)
+
+    def _wait_until_idle(self):
+        deadline = time.monotonic() + scrubber.MAX_BUSY_WAIT
+        while self.busy() and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+    def run_once(self):
+        """Reclaim everything that is due. Returns the number of objects freed."""
+        freed = 0
+        while True:
+            r = self.http.get(f"{self.trash_api}/due", params={"node": node.NODE_ID, "limit": BATCH})
+            r.raise_for_status()
+            entries = r.json()["files"]
+            if not entries:
+                return freed
+            purged = []
+            for entry in entries:
+                self._wait_until_idle()
+                self.limiter.take(entry.get("size") or 0)
+                try:
+                    self.remove(entry)
+                except Exception as e:
+                    RECLAIMED.inc(result="error")
+                    print(f"reclaim of {entry.get('object_id')} failed: {e}")
+                    continue
+                RECLAIMED.inc(result="ok")
+                RECLAIMED_BYTES.inc(entry.get("size") or 0)
+                purged.append(entry["trash_id"])
+            if purged:
+                r = self.http.post(f"{self.trash_api}/purge", json={"trash_ids": purged})
+                r.raise_for_status()
+                freed += len(purged)
+            if len(purged) < len(entries):
+                return freed  # the failures would come back first; try again next round
+
+    def start(self):
+        def loop():
+            while True:
+                try:
+                    freed = self.run_once()
+                    if freed:
+                        print(f"reclaimed {freed} trashed objects")
+                except Exception as e:
+                    print(f"reclaim failed: {e}")
+                time.sleep(INTERVAL)
+        threading.Thread(target=loop, daemon=True).start()
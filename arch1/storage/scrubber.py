@@ -0,0 +1,387 @@
+"""Background scrubber: verify stored bytes and reconcile them with metadata.
+
+A pass has four phases, each walked a batch at a time:
+
+  files      objects in the fan-out tree: re-hash, look the IDs up in metadata
+  cold       objects in the cold tier (see tiering.py): same, decompressing
+  segments   objects in the segment store: same
+  metadata   every metadata record, paged through ``/catalog/query`` in name
+             order: check that its bytes still exist
+
+and reports three kinds of findings:
+
+  corrupt    SHA-256 no longer matches the one recorded at upload (bit rot),
+             or an encrypted object fails authentication
+  orphan     stored object no metadata record points at (upload or delete
+             died between its two steps)
+  missing    metadata record whose object is gone
+
+The phase and cursor are saved to ``SCRUB_STATE_FILE`` after every batch,
+so a restart resumes the pass instead of starting over. Reads are capped at
+``SCRUB_BYTES_PER_SEC``, dropped from the page cache afterwards, and the
+scrubber waits while the service has more than ``SCRUB_MAX_IN_FLIGHT``
+foreground requests.
+
+Findings are logged, counted in metrics and listed by ``GET /scrub/status``.
+With ``SCRUB_REPAIR=1`` orphans are moved to ``quarantine/`` and records
+without data are deleted. Corrupt objects are only reported: there is no
+second copy to repair them from.
+"""
+import bisect
+import collections
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import crypto
+import layout
+import metadata_client
+import metrics
+import node
+import tiering
+
+ENABLED = os.environ.get("SCRUB_ENABLED", "1") == "1"
+REPAIR = os.environ.get("SCRUB_REPAIR", "0") == "1"
+BATCH = int(os.environ.get("SCRUB_BATCH", "100"))  # objects per metadata round trip and cursor save
+BYTES_PER_SEC = float(os.environ.get("SCRUB_BYTES_PER_SEC", str(16 * 1024 * 1024)))  # 0 = unlimited
+MAX_IN_FLIGHT = int(os.environ.get("SCRUB_MAX_IN_FLIGHT", "2"))  # pause while serving more requests than this
+INTERVAL = float(os.environ.get("SCRUB_INTERVAL", "3600"))  # seconds between passes
+# objects younger than this may belong to an upload that has not posted metadata yet
+ORPHAN_GRACE = float(os.environ.get("SCRUB_ORPHAN_GRACE", "3600"))
+STATE_FILE = os.environ.get("SCRUB_STATE_FILE", ".scrub-state.json")  # relative to the storage root
+QUARANTINE_DIR = "quarantine"
+READ_SIZE = 1024 * 1024
+MAX_BUSY_WAIT = 10  # seconds; a permanently busy service still gets scrubbed, just slowly
+
+PHASES = ("files", "cold", "segments", "metadata")
+
+SCRUB_OBJECTS = metrics.counter("storage_scrub_objects_total", "Objects and records checked by the scrubber", ["result"])
+SCRUB_BYTES = metrics.counter("storage_scrub_bytes_total", "Bytes read and hashed by the scrubber")
+SCRUB_REPAIRS = metrics.counter("storage_scrub_repairs_total", "Repairs made by the scrubber", ["action"])
+SCRUB_PASSES = metrics.counter("storage_scrub_passes_total", "Completed scrub passes")
+SCRUB_LAST_PASS = metrics.gauge("storage_scrub_last_pass_timestamp_seconds", "When the last scrub pass finished")
+
+
+class RateLimiter:
+    """Token bucket over bytes; ``take`` sleeps until the bytes are allowed."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+
+    def take(self, n):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        # at most one second of burst
+        self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate) - n
+        self.last = now
+        if self.allowance < 0:
+            time.sleep(-self.allowance / self.rate)
+
+
+class Scrubber:
+    def __init__(self, root, segment_store, http, catalog_api, busy=None, held=None, tiers=None):
+        self.root = root
+        self.segments = segment_store
+        self.http = http
+        self.catalog_api = catalog_api
+        self.busy = busy or (lambda: False)
+        self.held = held or (lambda: False)  # true while a backup hold is active: nothing is moved
+        self.tiers = tiers  # objects missing from the fan-out tree may be in the cold tier
+        self.state_path = os.path.join(root, STATE_FILE)
+        self.limiter = RateLimiter(BYTES_PER_SEC)
+        self.findings = collections.deque(maxlen=100)  # most recent, for /scrub/status
+        self.suspects = {}  # object_id -> first time it was seen without metadata
+        self.running = False
+        self.state = self._load_state()
+        self._listing = None  # sorted snapshot walked by the segments and metadata phases
+
+    # ---------------- state ----------------
+    def _new_state(self, passes=0, last_pass=None):
+        return {"pass": passes + 1, "phase": PHASES[0], "cursor": None, "started": time.time(),
+                "counts": {}, "last_pass": last_pass}
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return self._new_state()
+
+    def _save_state(self):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_path)
+
+    def status(self):
+        return {
+            "running": self.running,
+            "repair": REPAIR,
+            "state": self.state,
+            "recent_findings": list(self.findings),
+        }
+
+    # ---------------- bookkeeping ----------------
+    def _count(self, result):
+        counts = self.state["counts"]
+        counts[result] = counts.get(result, 0) + 1
+        SCRUB_OBJECTS.inc(result=result)
+
+    def _report(self, kind, **details):
+        finding = dict(kind=kind, at=time.time(), **details)
+        self.findings.append(finding)
+        self._count(kind)
+        print(f"scrub: {kind}: {details}")
+
+    def _wait_until_idle(self):
+        deadline = time.monotonic() + MAX_BUSY_WAIT
+        while self.busy() and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+    # ---------------- reading ----------------
+    def _hash_file(self, path, encrypted=False):
+        # encrypted objects are hashed as plaintext, which also checks every chunk's tag
+        with open(path, "rb", buffering=0) as f:
+            chunks = crypto.read_range(f) if encrypted else iter(lambda: f.read(READ_SIZE), b"")
+            actual = self._hash_chunks(chunks)
+            # a full scan would otherwise push the hot objects out of the page cache
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        return actual
+
+    def _hash_cold(self, path, encrypted=False):
+        if not path.endswith(".gz"):
+            return self._hash_file(path, encrypted)
+        f = open(path, "rb")
+        if encrypted:
+            # sealed chunks are read by offset, which a gzip stream cannot seek to
+            with self.tiers.decompressed_copy(f) as plain:
+                return self._hash_chunks(crypto.read_range(plain))
+        with f:
+            return self._hash_chunks(self.tiers.chunks(f, compressed=True))
+
+    def _hash_chunks(self, chunks):
+        digest = hashlib.sha256()
+        for chunk in chunks:
+            self.limiter.take(len(chunk))
+            digest.update(chunk)
+            SCRUB_BYTES.inc(len(chunk))
+        return digest.hexdigest()
+
+    def _hash_segment(self, object_id, encrypted=False):
+        data = self.segments.get(object_id)
+        if data is None:
+            return None
+        if encrypted:
+            data = crypto.unseal(data)
+        self.limiter.take(len(data))
+        SCRUB_BYTES.inc(len(data))
+        return hashlib.sha256(data).hexdigest()
+
+    # ---------------- metadata ----------------
+    def _lookup(self, object_ids):
+        r = self.http.post(f"{self.catalog_api}/by-object", json={"object_ids": object_ids})
+        r.raise_for_status()
+        return r.json()["files"]
+
+    def _object_exists(self, record):
+        if record.get("store") == "segment":
+            return self.segments is not None and record.get("object_id") in self.segments
+        path = record.get("path")
+        if path and os.path.exists(path):
+            return True
+        return self.tiers is not None and bool(record.get("object_id")) and self.tiers.locate(record["object_id"]) is not None
+
+    # ---------------- phases ----------------
+    def _next_batch(self):
+        """The next batch of the current phase, or an empty list when the phase is done."""
+        phase, cursor = self.state["phase"], self.state["cursor"]
+        if phase in ("files", "cold"):
+            if phase == "cold" and self.tiers is None:
+                return []
+            # cold objects are walked by file name, ".gz" included, and the cursor keeps it
+            root = self.root if phase == "files" else self.tiers.cold_root
+            batch = []
+            for item in layout.walk_objects(root, after=cursor):
+                batch.append(item)
+                if len(batch) >= BATCH:
+                    break
+            return batch
+        if phase == "metadata":
+            return self._next_records(cursor)
+        # segment keys are listed once when the phase starts (or resumes);
+        # objects added later are picked up by the next pass
+        if self._listing is None:
+            keys = list(self.segments.index) if self.segments is not None else []
+            self._listing = [(oid, None) for oid in sorted(keys)]
+        start = bisect.bisect_right(self._listing, cursor, key=lambda item: item[0]) if cursor else 0
+        return self._listing[start:start + BATCH]
+
+    def _next_records(self, after):
+        # a page of records at a time, in name order, so the catalog is never held whole
+        while True:
+            params = {"sort": "name", "limit": BATCH}
+            if after:
+                params["after"] = after
+            r = self.http.get(f"{self.catalog_api}/query", params=params)
+            r.raise_for_status()
+            page = r.json()["files"]
+            # records of objects on other storage nodes are their scrubbers' business
+            batch = [(rec["filename"], rec) for rec in page if node.is_local(rec)]
+            if batch or len(page) < BATCH:
+                return batch
+            after = page[-1]["filename"]
+
+    def _check_objects(self, batch, store):
+        records = self._lookup([oid for oid, _ in batch])
+        now = time.time()
+        for object_id, path in batch:
+            record = records.get(object_id)
+            try:
+                if record is None:
+                    if store == "segment" and object_id not in self.segments:
+                        continue  # deleted since the listing
+                    self._check_orphan(object_id, path, now)
+                    continue
+                self.suspects.pop(object_id, None)
+                expected = record.get("sha256")
+                if not expected:
+                    self._count("unverified")
+                    continue
+                encrypted = record.get("encrypted", False)
+                try:
+                    if store == "file":
+                        actual = self._hash_file(path, encrypted)
+                    elif store == "cold":
+                        actual = self._hash_cold(path, encrypted)
+                    else:
+                        actual = self._hash_segment(object_id, encrypted)
+                except crypto.DecryptionError as e:
+                    actual = f"undecryptable: {e}"
+                except tiering.TierError as e:
+                    actual = f"unreadable: {e}"
+                if actual is None:
+                    continue  # deleted while we looked
+                if actual != expected:
+                    self._report("corrupt", object_id=object_id, filename=record.get("filename"),
+                                 path=path, expected=expected, actual=actual)
+                else:
+                    self._count("ok")
+            except FileNotFoundError:
+                continue  # deleted while we looked
+
+    def _check_orphan(self, object_id, path, now):
+        # new uploads write their bytes before metadata; only old objects count
+        first_seen = self.suspects.setdefault(object_id, os.path.getmtime(path) if path else now)
+        if now - first_seen < ORPHAN_GRACE:
+            self._count("young")
+            return
+        self.suspects.pop(object_id, None)
+        self._report("orphan", object_id=object_id, path=path)
+        if REPAIR and not self.held():
+            self._quarantine(object_id, path)
+
+    def _quarantine(self, object_id, path):
+        directory = os.path.join(self.root, QUARANTINE_DIR)
+        os.makedirs(directory, exist_ok=True)
+        target = os.path.join(directory, os.path.basename(path) if path else object_id)  # a cold object keeps ".gz"
+        if path:
+            shutil.move(path, target)  # the cold tier may be another volume
+        else:
+            data = self.segments.get(object_id)
+            if data is None:
+                return
+            with open(target, "wb") as f:
+                f.write(data)
+            self.segments.delete(object_id)
+        SCRUB_REPAIRS.inc(action="quarantine")
+
+    def _check_records(self, batch):
+        candidates = []
+        for filename, record in batch:
+            if self._object_exists(record):
+                self._count("ok")
+            else:
+                candidates.append(record)
+        if not candidates:
+            return
+
+        # the listing is a snapshot; re-read the records in case they were
+        # overwritten or deleted since
+        _, results, _ = metadata_client.batch(self.http, self.catalog_api,
+                                              metadata_client.get_ops([rec["filename"] for rec in candidates]))
+        stale = []
+        for record, result in zip(candidates, results):
+            current = result.get("file")
+            if current is None or current.get("object_id") != record.get("object_id") or self._object_exists(current):
+                continue
+            self._report("missing", filename=record["filename"], object_id=record.get("object_id"),
+                         path=record.get("path"))
+            stale.append(record)
+
+        if REPAIR and stale:
+            _, results, _ = metadata_client.batch(self.http, self.catalog_api, metadata_client.delete_ops(
+                [rec["filename"] for rec in stale], [rec.get("object_id") for rec in stale]))
+            SCRUB_REPAIRS.inc(sum(r["status"] == 200 for r in results), action="delete_record")
+
+    # ---------------- driver ----------------
+    def step(self):
+        """Scrub one batch. Returns False once the pass is complete."""
+        batch = self._next_batch()
+        phase = self.state["phase"]
+        if not batch:
+            index = PHASES.index(phase)
+            if index + 1 < len(PHASES):
+                self.state.update(phase=PHASES[index + 1], cursor=None)
+                self._listing = None
+                self._save_state()
+                return True
+            self._finish_pass()
+            return False
+        if phase == "metadata":
+            self._check_records(batch)
+        elif phase == "cold":
+            self._check_objects([(name[:-3] if name.endswith(".gz") else name, path) for name, path in batch], "cold")
+        else:
+            self._check_objects(batch, "file" if phase == "files" else "segment")
+        self.state["cursor"] = batch[-1][0]
+        self._save_state()
+        return True
+
+    def _finish_pass(self):
+        finished = time.time()
+        summary = {"pass": self.state["pass"], "started": self.state["started"], "finished": finished,
+                   "counts": self.state["counts"]}
+        self.state = self._new_state(self.state["pass"], summary)
+        self._listing = None
+        self._save_state()
+        SCRUB_PASSES.inc()
+        SCRUB_LAST_PASS.set(finished)
+        print(f"scrub: pass {summary['pass']} done: {summary['counts']}")
+
+    def run_pass(self):
+        self._listing = None
+        while True:
+            self._wait_until_idle()
+            if not self.step():
+                return
+
+    def start(self):
+        def loop():
+            self.running = True
+            while True:
+                try:
+                    self.run_pass()
+                except Exception as e:
+                    # cursor is unchanged, so the failed batch is retried
+                    print(f"scrub failed: {e}")
+                    time.sleep(60)
+                    continue
+                time.sleep(INTERVAL)
+        threading.Thread(target=loop, daemon=True).start()
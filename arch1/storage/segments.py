@@ -0,0 +1,200 @@
+"""Packed segment store for small objects (Haystack-style).
+
+Small uploads are appended to large segment files instead of getting their
+own inode. An in-memory index maps object ID -> (segment, offset, length),
+so a read is a single ``os.pread``. Deletes append a tombstone. A background
+compactor rewrites sealed segments whose live ratio falls below
+``SEGMENT_COMPACT_RATIO`` and then removes them.
+
+On-disk record: header (magic, flags, key length, data length, crc32), then
+the object ID, then the data. The index is rebuilt by scanning segments in
+order at startup; a torn record at the tail of a segment ends that scan.
+"""
+import os
+import struct
+import threading
+import time
+import zlib
+
+SEGMENT_DIR = "segments"
+SEGMENT_MAX_BYTES = int(os.environ.get("SEGMENT_MAX_BYTES", str(256 * 1024 * 1024)))
+COMPACT_RATIO = float(os.environ.get("SEGMENT_COMPACT_RATIO", "0.5"))  # live/total below this gets rewritten
+COMPACT_INTERVAL = float(os.environ.get("SEGMENT_COMPACT_INTERVAL", "60"))
+
+HEADER = struct.Struct("<4sBHII")  # magic, flags, key length, data length, crc32
+MAGIC = b"SEG1"
+PUT, TOMBSTONE = 0, 1
+
+
+class SegmentStore:
+    def __init__(self, root, fsync=True):
+        self.dir = os.path.join(root, SEGMENT_DIR)
+        os.makedirs(self.dir, exist_ok=True)
+        self.fsync = fsync
+        self.index = {}  # object_id -> (segment, offset of data, length)
+        self.files = {}  # segment -> unbuffered file object, used for appends and pread
+        self.sizes = {}  # segment -> bytes on disk
+        self.live = {}  # segment -> bytes of records still referenced by the index
+        self.lock = threading.Lock()  # serializes appends and index changes; reads only take it briefly
+        self._load()
+        self.active = max(self.files) if self.files else self._new_segment(1)
+
+    # ---------------- public API ----------------
+    def put(self, object_id, data):
+        with self.lock:
+            self._append(PUT, object_id, data)
+
+    def put_many(self, items):
+        """Append several ``(object_id, data)`` pairs with one fsync per segment written."""
+        with self.lock:
+            written = {self._append(PUT, object_id, data, sync=False) for object_id, data in items}
+            if self.fsync:
+                for segment in written:
+                    os.fsync(self.files[segment].fileno())
+
+    def get(self, object_id):
+        """Object bytes, or None if unknown."""
+        with self.lock:
+            loc = self.index.get(object_id)
+            if loc is None:
+                return None
+            # holding a reference keeps the fd open even if compaction drops the segment
+            f = self.files[loc[0]]
+        return os.pread(f.fileno(), loc[2], loc[1])
+
+    def __contains__(self, object_id):
+        return object_id in self.index
+
+    def delete(self, object_id):
+        with self.lock:
+            if object_id not in self.index:
+                return False
+            self._append(TOMBSTONE, object_id, b"")
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "segments": len(self.files),
+                "objects": len(self.index),
+                "bytes": sum(self.sizes.values()),
+                "live_bytes": sum(self.live.values()),
+            }
+
+    # ---------------- writing ----------------
+    def _path(self, segment):
+        return os.path.join(self.dir, f"{segment:08d}.seg")
+
+    def _new_segment(self, segment):
+        self.files[segment] = open(self._path(segment), "a+b", buffering=0)
+        self.sizes[segment] = 0
+        self.live[segment] = 0
+        return segment
+
+    def _append(self, flags, object_id, data, sync=True):
+        # caller holds self.lock; returns the segment written to
+        if self.sizes[self.active] >= SEGMENT_MAX_BYTES:
+            self.active = self._new_segment(self.active + 1)
+        segment = self.active
+        key = object_id.encode()
+        crc = zlib.crc32(data, zlib.crc32(key))
+        record = HEADER.pack(MAGIC, flags, len(key), len(data), crc) + key + data
+        f = self.files[segment]
+        offset = self.sizes[segment]
+        f.write(record)
+        if self.fsync and sync:
+            os.fsync(f.fileno())
+        self.sizes[segment] = offset + len(record)
+        self._apply(flags, object_id, segment, offset + HEADER.size + len(key), len(data), len(record))
+        return segment
+
+    def _apply(self, flags, object_id, segment, data_offset, length, record_len):
+        old = self.index.pop(object_id, None)
+        if old is not None:
+            self.live[old[0]] -= HEADER.size + len(object_id.encode()) + old[2]
+        if flags == PUT:
+            self.index[object_id] = (segment, data_offset, length)
+            self.live[segment] += record_len
+
+    # ---------------- startup ----------------
+    def _load(self):
+        segments = sorted(int(n[:-4]) for n in os.listdir(self.dir) if n.endswith(".seg"))
+        for segment in segments:
+            f = open(self._path(segment), "a+b", buffering=0)
+            self.files[segment] = f
+            self.live[segment] = 0
+            end = os.fstat(f.fileno()).st_size
+            offset = 0
+            fd = f.fileno()
+            while offset + HEADER.size <= end:
+                magic, flags, key_len, length, crc = HEADER.unpack(os.pread(fd, HEADER.size, offset))
+                if magic != MAGIC or offset + HEADER.size + key_len + length > end:
+                    break
+                body = os.pread(fd, key_len + length, offset + HEADER.size)
+                if zlib.crc32(body) != crc:
+                    break
+                object_id = body[:key_len].decode()
+                record_len = HEADER.size + key_len + length
+                self._apply(flags, object_id, segment, offset + HEADER.size + key_len, length, record_len)
+                offset += record_len
+            if offset < end:
+                # torn write from a crash: drop the tail so appends start clean
+                os.truncate(self._path(segment), offset)
+            self.sizes[segment] = offset
+
+    # ---------------- compaction ----------------
+    def _records(self, segment):
+        f = self.files[segment]
+        fd = f.fileno()
+        offset, end = 0, self.sizes[segment]
+        while offset < end:
+            magic, flags, key_len, length, crc = HEADER.unpack(os.pread(fd, HEADER.size, offset))
+            object_id = os.pread(fd, key_len, offset + HEADER.size).decode()
+            yield flags, object_id, offset + HEADER.size + key_len, length
+            offset += HEADER.size + key_len + length
+
+    def compact_once(self):
+        """Rewrite sealed segments below the live ratio. Returns the number of segments removed."""
+        with self.lock:
+            candidates = [s for s in self.files
+                          if s != self.active and self.sizes[s]
+                          and self.live[s] / self.sizes[s] < COMPACT_RATIO]
+        removed = 0
+        for segment in sorted(candidates):
+            # a tombstone must outlive every older segment that may hold the object
+            with self.lock:
+                keep_tombstones = any(s < segment for s in self.files)
+            for flags, object_id, data_offset, length in self._records(segment):
+                if flags == TOMBSTONE:
+                    if keep_tombstones:
+                        with self.lock:
+                            if object_id not in self.index:
+                                self._append(TOMBSTONE, object_id, b"")
+                    continue
+                if self.index.get(object_id) != (segment, data_offset, length):
+                    continue  # overwritten or deleted since
+                data = os.pread(self.files[segment].fileno(), length, data_offset)
+                with self.lock:
+                    # re-check: a delete may have raced with the copy
+                    if self.index.get(object_id) == (segment, data_offset, length):
+                        self._append(PUT, object_id, data)
+            with self.lock:
+                self.files.pop(segment)
+                self.sizes.pop(segment)
+                self.live.pop(segment)
+            os.remove(self._path(segment))
+            removed += 1
+        return removed
+
+    def start_compactor(self, interval=COMPACT_INTERVAL, paused=None):
+        """``paused()`` true skips a round (while a backup copies the segments)."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                if paused and paused():
+                    continue
+                try:
+                    self.compact_once()
+                except Exception as e:
+                    print(f"segment compaction failed: {e}")
+        threading.Thread(target=loop, daemon=True).start()
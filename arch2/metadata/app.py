@@ -1,57 +1,576 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, redirect, request, jsonify, send_file
+import atexit
+import json
+import math
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+import catalog
+import changelog
+import indexes
+import metrics
+import nodes
+import profiling
+import replica
+import tracing
+import trash
+import usage
 
 app = Flask(__name__)
+metrics.instrument(app)
+tracing.instrument(app)
+profiling.instrument(app)
+
+# followers use it to read the leader's snapshot and log (see replica.py)
+http = metrics.instrument_session(tracing.TracedSession())
+
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")  # empty disables /snapshot
 
 # In-memory metadata store
-FILES = {}
+FILES = catalog.Catalog()  # filename -> record, stored by column (see catalog.py)
 USERS = {}
+INDEXES = indexes.Indexes()  # owner, name prefix, size, mtime and MIME lookups for /catalog/query
+USAGE = usage.Ledger()  # bytes and files per owner, quotas, upload reservations
+NODES = nodes.Registry()  # storage nodes and their load, from heartbeats
+TRASH = trash.Trash()  # deleted records within their restore window, and expired ones awaiting reclaim
+LOCK = threading.Lock()  # makes read-modify-write of FILES atomic
+CHANGES = changelog.ChangeLog()  # every record change, for /changes
+CHANGED = threading.Condition(LOCK)  # notified when CHANGES grows
+CHANGES_MAX_WAIT = 60  # seconds a /changes long-poll may block
+RECONCILE_INTERVAL = float(os.environ.get("USAGE_RECONCILE_INTERVAL", "300"))  # seconds between usage recounts
+SNAPSHOT_PATH = os.environ.get("CATALOG_SNAPSHOT", "")  # where the leader saves its state; empty = not saved
+SNAPSHOT_INTERVAL = float(os.environ.get("CATALOG_SNAPSHOT_INTERVAL", "300"))  # seconds between saves, if anything changed
+SNAPSHOT_LOCK = threading.Lock()  # one save at a time
+# write snapshots from a forked child, which sees memory as of the fork (copy-on-write);
+# otherwise the columns are copied while writers wait
+SNAPSHOT_FORK = hasattr(os, "fork") and os.environ.get("CATALOG_SNAPSHOT_FORK", "1") == "1"
 
-# ---------------- Add / Upload Metadata ----------------
-@app.route("/files", methods=["POST"])
-def add_file():
-    data = request.get_json()
-    if not data:
-        return jsonify({"error": "JSON body required"}), 400
+QUOTA_REJECTIONS = metrics.counter("metadata_quota_rejections_total", "Uploads refused at admission for exceeding a quota")
+USAGE_DRIFT = metrics.counter("metadata_usage_drift_total", "Usage counter corrections made by reconciliation", ["kind"])
+SNAPSHOT_SECONDS = metrics.histogram("metadata_catalog_snapshot_seconds", "Time to save or load the catalog snapshot",
+                                     ["op"], buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+SNAPSHOT_PAUSE = metrics.histogram("metadata_catalog_snapshot_pause_seconds", "Time writers waited while a snapshot was taken",
+                                   buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+metrics.gauge("metadata_catalog", "File records, allocated rows, interned strings and column bytes of the catalog", ["kind"],
+              fn=lambda: [((kind,), value) for kind, value in FILES.stats().items()])
+metrics.gauge("metadata_changelog", "Change log entries retained, last sequence number and tracked consumers", ["kind"],
+              fn=lambda: [((kind,), value) for kind, value in CHANGES.stats().items()])
+
+def _node_states():
+    with LOCK:
+        states = [node["state"] for node in NODES.list()]
+    return [((state,), states.count(state)) for state in ("up", "draining", "down")]
+
+metrics.gauge("metadata_storage_nodes", "Registered storage nodes by state", ["state"], fn=_node_states)
+
+def _trash_stats():
+    with LOCK:
+        return [((kind,), value) for kind, value in TRASH.stats().items()]
+
+metrics.gauge("metadata_trash", "Trashed files and bytes, and those expired and waiting for storage to reclaim them",
+              ["kind"], fn=_trash_stats)
 
+def _replication_state():
+    if not replica.is_follower() or not FOLLOWER.synced:
+        return []
+    return [(("lag_events",), FOLLOWER.lag()), (("seconds_since_contact",), time.monotonic() - FOLLOWER.contact)]
+
+metrics.gauge("metadata_replication", "Follower lag behind the leader's log", ["kind"], fn=_replication_state)
+
+# ---------------- Record Operations ----------------
+# Shared by the single-file routes and /catalog/batch. Callers hold LOCK.
+# Each returns (status, body); body has "file" on success, "error" otherwise.
+
+def _set_record(filename, record, log=True):
+    # replace (or with None, remove) a record, keeping INDEXES and USAGE in step;
+    # the indexes go first, as they refuse a record they cannot order
+    previous = FILES.get(filename)
+    if previous is None and record is None:
+        return None
+    INDEXES.update(filename, previous, record)
+    try:
+        if record is None:
+            del FILES[filename]
+        else:
+            FILES[filename] = record
+    except BaseException:
+        INDEXES.update(filename, record, previous)
+        raise
+    USAGE.update(previous, record)
+    if log:
+        CHANGES.append(filename, previous, record)
+        CHANGED.notify_all()
+    return previous
+
+# Trashed files keep their bytes on disk until the reclaimer frees them, so
+# they count toward their owner's usage until the entry is purged or restored.
+def _trash(record):
+    entry = TRASH.add(record)
+    USAGE.update(None, entry)
+    return entry
+
+def _untrash(trash_id):
+    entry = TRASH.remove(trash_id)
+    USAGE.update(entry, None)
+    return entry
+
+def _usage_totals(users, sizes, trashed):
+    # usage from scratch, for reconciliation and snapshot loads
+    return usage.totals_of(users + [e.get("user") for e in trashed], sizes + [e.get("size") for e in trashed])
+
+def _put(data):
     filename = data.get("filename")
     if not filename:
-        return jsonify({"error": "Filename is required"}), 400
+        return 400, {"error": "Filename is required"}
+
+    # Optional compare-and-swap: only replace the record if it still points at if_path
+    previous = FILES.get(filename)
+    if "if_path" in data and (previous or {}).get("path") != data["if_path"]:
+        return 409, {"error": "File changed concurrently"}
+    # files are named per catalog, not per user: nobody overwrites another user's file
+    if previous and previous.get("user") is not None and previous.get("user") != data.get("user"):
+        return 403, {"error": "File belongs to another user"}
+
+    try:
+        size = _record_size(data.get("size"))
+        modified = _record_time(data.get("modified"))
+    except ValueError as e:
+        return 400, {"error": str(e)}
 
     # Store metadata including password
-    FILES[filename] = {
+    _set_record(filename, {
         "filename": filename,
+        "object_id": data.get("object_id"),
+        "store": data.get("store", "file"),
         "path": data.get("path"),
-        "size": data.get("size"),
+        "size": size,
         "version": data.get("version", 1),
+        "sha256": data.get("sha256"),
+        "crc32": data.get("crc32"),
+        "encrypted": data.get("encrypted", False),
+        "mime": data.get("mime"),
+        "modified": modified or time.time(),
         "user": data.get("user"),
+        "node": data.get("node"),
         "password": data.get("password", "")
-    }
+    })
+    body = {"file": FILES[filename]}
+    # tell the caller which object this record used to point at
+    if previous:
+        body["replaced"] = {k: previous.get(k) for k in ("object_id", "store", "path", "node")}
+    return 201, body
+
+def _record_size(value):
+    if type(value) is str:
+        value = _parse_int("size", value)
+    if value is not None and (type(value) is not int or value < 0):
+        raise ValueError("size must be a non-negative integer")
+    return value
+
+def _record_time(value):
+    if type(value) is str:
+        value = _parse_time("modified", value)
+    if type(value) is int:
+        value = float(value)
+    if value is not None and (type(value) is not float or not math.isfinite(value)):
+        raise ValueError("modified must be epoch seconds or ISO 8601")
+    return value
+
+def _get(filename):
+    if filename not in FILES:
+        return 404, {"error": "File not found"}
+    return 200, {"file": FILES[filename]}
+
+def _delete(filename, if_object_id=None, to_trash=False, if_user=None):
+    # with if_user, another user's file is reported missing, as it is to them
+    if filename not in FILES or (if_user is not None and FILES[filename].get("user") != if_user):
+        return 404, {"error": "File not found"}
+
+    # Optional compare-and-swap: only delete if the record still points at if_object_id
+    if if_object_id is not None and (FILES[filename].get("object_id") or "") != if_object_id:
+        return 409, {"error": "File changed concurrently"}
+
+    previous = _set_record(filename, None)
+    if not to_trash:
+        return 200, {"file": previous}
+    # the bytes stay until the restore window is over (see trash.py)
+    return 200, {"file": previous, "trash_id": _trash(previous)["trash_id"]}
+
+
+# ---------------- Add / Upload Metadata ----------------
+@app.route("/files", methods=["POST"])
+def add_file():
+    data = request.get_json()
+    if not data:
+        return jsonify({"error": "JSON body required"}), 400
+
+    with LOCK:
+        status, body = _put(data)
+    if status != 201:
+        return jsonify(body), status
+    result = body["file"]
+    if "replaced" in body:
+        result["replaced"] = body["replaced"]
+    return jsonify(result), 201
+
+
+# ---------------- Batch ----------------
+# Body: {"ops": [{"op": "put", "file": {...}}, {"op": "get", "filename": ...},
+#                {"op": "delete", "filename": ..., "if_object_id": ..., "if_user": ..., "trash": bool}],
+#         "atomic": false}
+# All ops run under one lock acquisition, so no other request sees a half-applied
+# batch. With "atomic": true any failed op rolls the whole batch back (409).
+# Results come back in op order: {"applied": bool, "results": [...]}, or one JSON
+# line per result when the client accepts application/x-ndjson.
+BATCH_OPS = {
+    "put": lambda op: _put(op.get("file") or {}),
+    "get": lambda op: _get(op.get("filename")),
+    "delete": lambda op: _delete(op.get("filename"), op.get("if_object_id"), bool(op.get("trash")), op.get("if_user")),
+}
+
+@app.route("/catalog/batch", methods=["POST"])
+def batch():
+    data = request.get_json()
+    ops = data.get("ops") if data else None
+    if not isinstance(ops, list):
+        return jsonify({"error": "ops list is required"}), 400
+    atomic = bool(data.get("atomic"))
+
+    results = []
+    undo = []  # (filename, record before the op), to roll back an atomic batch
+    with LOCK:
+        mark = CHANGES.last_seq
+        for op in ops:
+            handler = BATCH_OPS.get(op.get("op")) if isinstance(op, dict) else None
+            if handler is None:
+                results.append({"op": None, "status": 400, "error": "Unknown op"})
+                continue
+            filename = (op.get("file") or {}).get("filename") if op["op"] == "put" else op.get("filename")
+            if op["op"] != "get":
+                undo.append((filename, FILES.get(filename)))
+            status, body = handler(op)
+            results.append({"op": op["op"], "filename": filename, "status": status, **body})
+
+        applied = not (atomic and any(r["status"] >= 400 for r in results))
+        if not applied:
+            # readers wait on LOCK, so none has seen the events being dropped
+            for filename, record in reversed(undo):
+                _set_record(filename, record, log=False)
+            for r in results:
+                if "trash_id" in r:
+                    _untrash(r["trash_id"])
+            CHANGES.truncate(mark)
+
+    status = 200 if applied else 409
+    if "application/x-ndjson" in request.headers.get("Accept", ""):
+        # large batches: don't build the whole response document in memory
+        lines = (json.dumps(r) + "\n" for r in results)
+        return Response(lines, status=status, mimetype="application/x-ndjson")
+    return jsonify({"applied": applied, "results": results}), status
+
+
+# ---------------- Look Up By Object ID ----------------
+# Body: {"object_ids": [...]}. Answers {"files": {object_id: record}} for the
+# IDs some record points at; unknown IDs are left out.
+@app.route("/catalog/by-object", methods=["POST"])
+def files_by_object():
+    data = request.get_json()
+    if not data or not isinstance(data.get("object_ids"), list):
+        return jsonify({"error": "object_ids list is required"}), 400
 
-    return jsonify(FILES[filename]), 201
+    found = {}
+    with LOCK:
+        for object_id in data["object_ids"]:
+            record = FILES.find_object(object_id)
+            if record is not None:
+                found[object_id] = record
+            elif TRASH.find_object(object_id) is not None:
+                found[object_id] = dict(TRASH.find_object(object_id))  # still stored until reclaimed
+    return jsonify({"files": found}), 200
+
+
+# ---------------- Query ----------------
+# The routes over many records live under /catalog, where no filename can
+# shadow them as it would under /files/<path:filename>.
+#
+# GET /catalog/query?owner=&prefix=&min_size=&max_size=&modified_after=&modified_before=&mime=&sort=&limit=&after=
+# Times are epoch seconds or ISO 8601, mime may be "type/*", sort is name, size
+# or modified with "-" for descending; after= keeps names that sort after it, to
+# page through a sort by name. Answered from INDEXES, not a full scan.
+QUERY_MAX_LIMIT = 10000
+
+def _parse_time(name, value):
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError(f"{name} must be epoch seconds or ISO 8601") from None
+
+def _parse_int(name, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer") from None
+
+def _query_arg(args, name, parse):
+    return parse(name, args[name]) if name in args else None
+
+@app.route("/catalog/query", methods=["GET"])
+def query_files():
+    args = request.args
+    try:
+        filters = {
+            "owner": args.get("owner"),
+            "prefix": args.get("prefix"),
+            "min_size": _query_arg(args, "min_size", _parse_int),
+            "max_size": _query_arg(args, "max_size", _parse_int),
+            "modified_after": _query_arg(args, "modified_after", _parse_time),
+            "modified_before": _query_arg(args, "modified_before", _parse_time),
+            "mime": args.get("mime"),
+            "after": args.get("after"),
+        }
+        limit = _query_arg(args, "limit", _parse_int)
+        if limit is None:
+            limit = QUERY_MAX_LIMIT
+        elif limit < 0:
+            raise ValueError("limit must not be negative")
+        limit = min(limit, QUERY_MAX_LIMIT)
+        with LOCK:
+            results = INDEXES.query(FILES, sort=args.get("sort", "name"), limit=limit, **filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"files": results, "count": len(results)}), 200
 
 
 # ---------------- Get Metadata ----------------
-@app.route("/files/<filename>", methods=["GET"])
+@app.route("/files/<path:filename>", methods=["GET"])
 def get_file(filename):
-    if filename not in FILES:
-        return jsonify({"error": "File not found"}), 404
-    return jsonify(FILES[filename])
+    with LOCK:
+        status, body = _get(filename)
+    return jsonify(body.get("file", body)), status
 
 
 # ---------------- Delete Metadata ----------------
-@app.route("/files/<filename>", methods=["DELETE"])
+@app.route("/files/<path:filename>", methods=["DELETE"])
 def delete_file(filename):
-    if filename not in FILES:
-        return jsonify({"error": "File not found"}), 404
+    with LOCK:
+        status, body = _delete(filename, request.args.get("if_object_id"), request.args.get("trash") == "1",
+                               request.args.get("if_user"))
+    if status != 200:
+        return jsonify(body), status
+    return jsonify({"status": "deleted", **({"trash_id": body["trash_id"]} if "trash_id" in body else {})}), 200
+
+
+# ---------------- Trash ----------------
+# Deleted files that can still be restored, newest first; ?user= for one owner's
+@app.route("/trash", methods=["GET"])
+def list_trash():
+    with LOCK:
+        entries = TRASH.list(request.args.get("user"))
+    return jsonify({"files": entries, "retention": trash.RETENTION}), 200
+
+# Expired entries whose bytes are on ?node=, oldest first, for that node's reclaimer
+@app.route("/trash/due", methods=["GET"])
+def trash_due():
+    limit = max(1, min(request.args.get("limit", 100, type=int), QUERY_MAX_LIMIT))
+    with LOCK:
+        entries = TRASH.due(request.args.get("node"), limit)
+    return jsonify({"files": entries}), 200
+
+@app.route("/trash/<trash_id>/restore", methods=["POST"])
+def restore(trash_id):
+    with LOCK:
+        entry = TRASH.get(trash_id)
+        if entry is None:
+            return jsonify({"error": "Not in trash"}), 404
+        if TRASH.expired(entry):
+            return jsonify({"error": "Restore window is over"}), 410
+        if entry["filename"] in FILES:
+            return jsonify({"error": "A file with this name exists"}), 409
+        _untrash(trash_id)
+        record = {k: v for k, v in entry.items() if k not in ("trash_id", "deleted_at")}
+        _set_record(entry["filename"], record)
+    return jsonify(record), 201
 
-    del FILES[filename]
-    return jsonify({"status": "deleted"}), 200
+# Body: {"trash_ids": [...]}; the reclaimer has freed their bytes
+@app.route("/trash/purge", methods=["POST"])
+def purge_trash():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data.get("trash_ids"), list):
+        return jsonify({"error": "trash_ids list is required"}), 400
+    with LOCK:
+        purged = sum(_untrash(trash_id) is not None for trash_id in data["trash_ids"])
+    return jsonify({"purged": purged}), 200
 
 
 # ---------------- List All Files (Optional) ----------------
 @app.route("/files", methods=["GET"])
 def list_files():
-    return jsonify(list(FILES.values())), 200
+    with LOCK:
+        files = FILES.freeze()
+        cursor = CHANGES.cursor()
+    # a client that syncs from this listing polls /changes?since=<cursor> afterwards
+    return Response(_json_list(files.values()), mimetype="application/json", headers={"X-Change-Cursor": cursor})
+
+# a JSON array sent a thousand records at a time, never as one string
+def _json_list(records):
+    chunk, first = [], True
+    for record in records:
+        chunk.append(json.dumps(record))
+        if len(chunk) == 1000:
+            yield ("[" if first else ",") + ",".join(chunk)
+            chunk, first = [], False
+    if chunk or first:
+        yield ("[" if first else ",") + ",".join(chunk)
+    yield "]"
+
+
+# ---------------- Change Feed ----------------
+# Long-poll: answers as soon as there are changes after `since`, or with an
+# empty list after `timeout` seconds. An unknown or expired cursor gets 410
+# with the current cursor; the client re-lists /files and continues from it.
+# A `consumer` name keeps the log from being compacted past what it has read.
+@app.route("/changes", methods=["GET"])
+def changes():
+    return _follow(changelog.FILE_EVENTS)
+
+# kinds: the event types to return; the cursor moves past the others
+def _follow(kinds=None):
+    since = request.args.get("since", "")
+    consumer = request.args.get("consumer")
+    timeout = min(max(request.args.get("timeout", 30, type=float), 0), CHANGES_MAX_WAIT)
+    limit = max(1, min(request.args.get("limit", 1000, type=int), QUERY_MAX_LIMIT))
+    deadline = time.monotonic() + timeout
+    events = []
+    with CHANGED:
+        try:
+            seq = CHANGES.parse(since)
+            if consumer:
+                CHANGES.ack(consumer, seq)
+            while True:
+                remaining = deadline - time.monotonic()
+                if CHANGES.last_seq <= seq:
+                    if remaining <= 0:
+                        break
+                    CHANGED.wait(remaining)
+                    # the log may have been rolled back or compacted while waiting
+                    seq = CHANGES.parse(CHANGES.cursor(seq))
+                    continue
+                read = CHANGES.read(seq, limit)
+                seq = read[-1]["seq"]
+                events = [e for e in read if kinds is None or e["type"] in kinds]
+                if events or remaining <= 0:
+                    break
+        except changelog.CursorExpired as e:
+            return jsonify({"error": str(e), "cursor": CHANGES.cursor()}), 410
+        cursor, head = CHANGES.cursor(seq), CHANGES.cursor()
+    return jsonify({"changes": events, "cursor": cursor, "head": head}), 200
+
+
+# ---------------- Replication ----------------
+# The leader hands followers a snapshot and then its change log, unfiltered;
+# followers answer reads and send everything else to the leader (replica.py).
+@app.route("/replication/snapshot", methods=["GET"])
+def replication_snapshot():
+    with LOCK:
+        files = FILES.freeze()
+        snapshot = {
+            "cursor": CHANGES.cursor(),
+            "users": dict(USERS),
+            "quotas": {user: dict(quota) for user, quota in USAGE.quotas.items()},
+        }
+    snapshot["files"] = list(files.values())
+    return jsonify(snapshot), 200
+
+@app.route("/replication/log", methods=["GET"])
+def replication_log():
+    return _follow()
+
+@app.route("/replication/status", methods=["GET"])
+def replication_status():
+    with LOCK:
+        status = {"role": replica.ROLE, "cursor": CHANGES.cursor()}
+    if replica.is_follower():
+        status.update(leader=replica.LEADER_URL, synced=FOLLOWER.synced, lag=FOLLOWER.lag())
+    return jsonify(status), 200
+
+def _load_snapshot(snapshot):
+    with LOCK:
+        for filename in list(FILES):
+            _set_record(filename, None, log=False)
+        for record in snapshot["files"]:
+            _set_record(record["filename"], record, log=False)
+        USERS.clear()
+        USERS.update(snapshot["users"])
+        USAGE.quotas = snapshot["quotas"]
+        CHANGES.reset(snapshot["cursor"])
+        CHANGED.notify_all()
+
+def _apply_events(events):
+    with LOCK:
+        for event in events:
+            CHANGES.replay(event)  # raises on a gap, before anything is applied
+            kind = event["type"]
+            if kind in changelog.FILE_EVENTS:
+                _set_record(event["filename"], dict(event["file"]) if event["file"] else None, log=False)
+            elif kind == "user":
+                USERS[event["username"]] = event["password"]
+            elif kind == "quota":
+                USAGE.set_quota(event["user"], event["bytes"], event["files"])
+        CHANGED.notify_all()
+
+FOLLOWER = replica.Follower(http, _load_snapshot, _apply_events)
+
+def _to_leader():
+    return redirect(replica.LEADER_URL + request.full_path.rstrip("?"), code=307)
+
+# read-your-writes: has this follower applied the log up to token?
+def _caught_up(token):
+    parsed = replica.parse_token(token)
+    if parsed is None:
+        return False
+    epoch, seq = parsed
+    deadline = time.monotonic() + replica.READ_WAIT
+    with CHANGED:
+        while CHANGES.epoch == epoch and CHANGES.last_seq < seq:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            CHANGED.wait(remaining)
+        return CHANGES.epoch == epoch and CHANGES.last_seq >= seq
+
+@app.before_request
+def _replica_route():
+    if not replica.is_follower():
+        return None
+    rule = request.url_rule.rule if request.url_rule else None
+    if rule in ("/metrics", "/replication/status", "/admin/profile", "/admin/slow-requests"):
+        return None  # about this process, not the data
+    if request.method != "GET" or rule not in replica.READ_ROUTES or not FOLLOWER.synced:
+        return _to_leader()
+    token = request.args.get("min_seq") or request.headers.get("X-Metadata-Seq")
+    if token and not _caught_up(token):
+        return _to_leader()
+    return None
+
+@app.after_request
+def _replica_headers(response):
+    if replica.is_follower():
+        # possibly created since the last event this follower applied
+        rule = request.url_rule.rule if request.url_rule else None
+        if response.status_code == 404 and request.method == "GET" and rule in replica.LOOKUP_ROUTES:
+            return _to_leader()
+    elif request.method != "GET" and response.status_code < 400:
+        # the log position after this write, for read-your-writes on a follower
+        response.headers["X-Metadata-Seq"] = CHANGES.cursor()
+    return response
 
 # ---------------- User Registration ----------------
 @app.route("/users", methods=["POST"])
@@ -62,10 +581,13 @@ def add_user():
     if not username or not password:
         return jsonify({"error": "Missing username or password"}), 400
 
-    if username in USERS:
-        return jsonify({"error": "Username already exists"}), 409
+    with LOCK:
+        if username in USERS:
+            return jsonify({"error": "Username already exists"}), 409
 
-    USERS[username] = password
+        USERS[username] = password
+        CHANGES.append_event("user", username=username, password=password)  # for followers
+        CHANGED.notify_all()
     return jsonify({"message": "User created"}), 201
 
 # ---------------- Get User for Login ----------------
@@ -77,8 +599,247 @@ def get_user(username):
         "username": username,
         "password": USERS[username]
     }), 200
+
+# ---------------- Usage & Quotas ----------------
+@app.route("/users/<username>/usage", methods=["GET"])
+def get_usage(username):
+    with LOCK:
+        return jsonify(USAGE.report(username)), 200
+
+# Body: {"bytes": limit, "files": limit}; 0 means unlimited
+@app.route("/users/<username>/quota", methods=["PUT"])
+def set_quota(username):
+    data = request.get_json(silent=True) or {}
+    try:
+        limits = int(data.get("bytes", 0)), int(data.get("files", 0))
+    except (TypeError, ValueError):
+        return jsonify({"error": "bytes and files must be integers"}), 400
+    with LOCK:
+        USAGE.set_quota(username, *limits)
+        CHANGES.append_event("quota", user=username, bytes=limits[0], files=limits[1])
+        CHANGED.notify_all()
+        return jsonify(USAGE.report(username)), 200
+
+# Upload admission: the gateway reserves the request size before reading the
+# body and releases the reservation once storage has answered. The answer
+# carries the headroom left beyond it, for uploads of unknown size
+@app.route("/users/<username>/reservations", methods=["POST"])
+def reserve(username):
+    data = request.get_json(silent=True) or {}
+    with LOCK:
+        reservation = USAGE.reserve(username, int(data.get("bytes") or 0), int(data.get("files", 1)))
+        report = USAGE.report(username)
+        headroom = USAGE.headroom(username)
+    if reservation is None:
+        QUOTA_REJECTIONS.inc()
+        return jsonify({"error": "Quota exceeded", **report}), 413
+    return jsonify({"reservation": reservation, "headroom": headroom}), 201
+
+@app.route("/users/<username>/reservations/<reservation>", methods=["DELETE"])
+def release(username, reservation):
+    with LOCK:
+        released = USAGE.release(reservation)
+    if not released:
+        return jsonify({"error": "Reservation not found"}), 404
+    return jsonify({"status": "released"}), 200
+
+# ---------------- Storage Nodes ----------------
+# Body: {"url", "free_bytes", "total_bytes", "in_flight", "latency_ms"}
+@app.route("/nodes/<node_id>/heartbeat", methods=["POST"])
+def node_heartbeat(node_id):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data.get("url"):
+        return jsonify({"error": "JSON object with url required"}), 400
+    with LOCK:
+        node = NODES.heartbeat(node_id, data)
+    return jsonify(node), 200
+
+@app.route("/nodes", methods=["GET"])
+def list_nodes():
+    with LOCK:
+        return jsonify({"nodes": NODES.list()}), 200
+
+@app.route("/nodes/<node_id>", methods=["GET"])
+def get_node(node_id):
+    with LOCK:
+        node = NODES.get(node_id)
+    if node is None:
+        return jsonify({"error": "Node not found"}), 404
+    return jsonify(node), 200
+
+# a decommissioned node; it re-registers if it sends another heartbeat
+@app.route("/nodes/<node_id>", methods=["DELETE"])
+def remove_node(node_id):
+    with LOCK:
+        removed = NODES.remove(node_id)
+    if not removed:
+        return jsonify({"error": "Node not found"}), 404
+    return jsonify({"status": "removed"}), 200
+
+# Recount usage from the records and fix counters that drifted. The scan runs
+# on a snapshot outside the lock; writes during the scan are carried over.
+def reconcile_usage():
+    with LOCK:
+        records = FILES.freeze()
+        trashed = list(TRASH.entries.values())
+        USAGE.begin_reconcile()
+    totals = _usage_totals(records.column("user"), records.column("size"), trashed)
+    with LOCK:
+        drift = USAGE.finish_reconcile(totals)
+    for user, off in drift.items():
+        USAGE_DRIFT.inc(abs(off["bytes"]), kind="bytes")
+        USAGE_DRIFT.inc(abs(off["files"]), kind="files")
+        print(f"usage drift corrected for {user}: {off}")
+    return drift
+
+def _reconcile_loop():
+    while True:
+        time.sleep(RECONCILE_INTERVAL)
+        try:
+            reconcile_usage()
+        except Exception as e:
+            print(f"usage reconciliation failed: {e}")
+
+# ---------------- Catalog Snapshots ----------------
+# The leader saves its records, users, quotas and trash to SNAPSHOT_PATH every
+# SNAPSHOT_INTERVAL seconds and when it stops, and loads them when it starts.
+# A snapshot is of one instant, the change log position it records: writers
+# wait only for the fork (or the column copy) and the file is written after.
+# Changes made after the last save are lost if the process dies.
+_saved_seq = None
+
+def write_snapshot(path, unless_seq=None):
+    """Write the catalog, users, quotas and trash as of now to ``path``; callers hold SNAPSHOT_LOCK.
+
+    Returns {"seq", "cursor", "files", "pause", "seconds"}, or None if the
+    change log is still at ``unless_seq``.
+    """
+    start = time.perf_counter()
+    with LOCK:
+        if unless_seq is not None and CHANGES.last_seq == unless_seq:
+            return None
+        state = {
+            "seq": CHANGES.last_seq,
+            "cursor": CHANGES.cursor(),
+            "users": dict(USERS),
+            "quotas": {user: dict(quota) for user, quota in USAGE.quotas.items()},
+            "trash": list(TRASH.entries.values()),
+        }
+        count = len(FILES)
+        if SNAPSHOT_FORK:
+            pid = os.fork()
+            if pid == 0:
+                _write_in_child(path, state)
+        else:
+            files, names = FILES.freeze(), INDEXES.names()
+        pause = time.perf_counter() - start
+    if SNAPSHOT_FORK:
+        _, status = os.waitpid(pid, 0)
+        if status != 0:
+            raise RuntimeError(f"snapshot writer failed (wait status {status})")
+    else:
+        files.save(path, names, state)
+    seconds = time.perf_counter() - start
+    SNAPSHOT_PAUSE.observe(pause)
+    SNAPSHOT_SECONDS.observe(seconds, op="save")
+    return {"seq": state["seq"], "cursor": state["cursor"], "files": count, "pause": pause, "seconds": seconds}
+
+def _write_in_child(path, state):
+    # only this thread exists in the child and nothing changes its memory, so
+    # the catalog is read as it was at the fork; never returns
+    code = 0
+    try:
+        FILES.save(path, INDEXES.names(), state)
+    except BaseException as e:
+        os.write(2, f"catalog snapshot failed: {e}\n".encode())
+        code = 1
+    os._exit(code)
+
+def save_catalog():
+    global _saved_seq
+    if not SNAPSHOT_PATH or replica.is_follower():
+        return
+    with SNAPSHOT_LOCK:
+        saved = write_snapshot(SNAPSHOT_PATH, unless_seq=_saved_seq)
+        if saved is not None:
+            _saved_seq = saved["seq"]
+
+# A snapshot for a backup: the file (restored by placing it at CATALOG_SNAPSHOT)
+# is the response body, and the X-Snapshot-* headers give the change log
+# position it was taken at and how long it took.
+@app.route("/snapshot", methods=["POST"])
+def snapshot():
+    # the whole catalog, users and password hashes included
+    if not ADMIN_TOKEN or request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        return jsonify({"error": "Forbidden"}), 403
+    fd, path = tempfile.mkstemp(prefix="catalog-", suffix=".snapshot", dir=os.path.dirname(SNAPSHOT_PATH) or None)
+    os.close(fd)
+    try:
+        with SNAPSHOT_LOCK:
+            saved = write_snapshot(path)
+        f = open(path, "rb")
+    finally:
+        os.remove(path)  # the open file can still be read
+    response = send_file(f, mimetype="application/octet-stream", as_attachment=True,
+                         download_name=f"catalog-{saved['seq']}.snapshot")
+    response.headers.update({
+        "X-Snapshot-Seq": str(saved["seq"]),
+        "X-Snapshot-Cursor": saved["cursor"],
+        "X-Snapshot-Files": str(saved["files"]),
+        "X-Snapshot-Pause": f"{saved['pause']:.6f}",
+        "X-Snapshot-Seconds": f"{saved['seconds']:.6f}",
+    })
+    return response
+
+def restore_catalog():
+    global _saved_seq
+    if not SNAPSHOT_PATH or replica.is_follower() or not os.path.exists(SNAPSHOT_PATH):
+        return
+    start = time.perf_counter()
+    try:
+        names, state = FILES.load(SNAPSHOT_PATH)
+    except (OSError, ValueError, KeyError) as e:
+        # kept for inspection; the next save starts a new one
+        print(f"catalog snapshot not loaded: {e}")
+        os.replace(SNAPSHOT_PATH, SNAPSHOT_PATH + ".bad")
+        return
+    with LOCK:
+        INDEXES.load(names, *(FILES.column(field, names) for field in ("size", "modified", "user", "mime")))
+        TRASH.load(state["trash"])
+        USAGE.usage = _usage_totals(FILES.column("user", names), FILES.column("size", names), state["trash"])
+        USAGE.quotas = state["quotas"]
+        USERS.update(state["users"])
+        CHANGES.resume(state["seq"])
+        _saved_seq = state["seq"]
+    elapsed = time.perf_counter() - start
+    SNAPSHOT_SECONDS.observe(elapsed, op="load")
+    print(f"catalog: {len(FILES)} files loaded from {SNAPSHOT_PATH} in {elapsed:.2f} s")
+
+def _snapshot_loop():
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        try:
+            save_catalog()
+        except Exception as e:
+            print(f"catalog snapshot failed: {e}")
+
+def start_snapshots():
+    # load the last snapshot, then keep saving; also on exit, including docker stop's SIGTERM
+    if not SNAPSHOT_PATH or replica.is_follower():
+        return
+    restore_catalog()
+    threading.Thread(target=_snapshot_loop, daemon=True).start()
+    atexit.register(save_catalog)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
 # ---------------- Main ----------------
 if __name__ == "__main__":
-    import sys
     sys.stdout.reconfigure(line_buffering=True)  # flush prints immediately
+    # debug mode re-runs this file in a reloader child; only that child holds the data
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_snapshots()
+        threading.Thread(target=_reconcile_loop, daemon=True).start()
+        if replica.is_follower():
+            FOLLOWER.start()
     app.run(host="0.0.0.0", port=5005, debug=True)
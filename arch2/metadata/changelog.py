@@ -0,0 +1,125 @@
+"""Append-only log of metadata changes, read by ``GET /changes``.
+
+Every create, update and delete of a record appends an event with the next
+sequence number. User registrations and quota changes are logged too, for
+metadata followers (see replica.py); ``/changes`` leaves them out. Cursors handed to clients are ``<epoch>:<seq>``; the epoch
+changes when the service restarts (the in-memory log starts over), so an
+old cursor is detected instead of silently missing events.
+
+Consumers that identify themselves are remembered with the position they
+have read up to. Entries every known consumer has moved past are dropped,
+and the log never keeps more than ``CHANGELOG_MAX_ENTRIES``. A cursor older
+than what is left gets ``CursorExpired`` and the client re-lists.
+
+Callers hold the metadata lock.
+"""
+import collections
+import os
+import time
+import uuid
+
+MAX_ENTRIES = int(os.environ.get("CHANGELOG_MAX_ENTRIES", "100000"))
+CONSUMER_TTL = float(os.environ.get("CHANGELOG_CONSUMER_TTL", "86400"))  # seconds; idle consumers stop holding the log
+
+
+FILE_EVENTS = ("create", "update", "delete")  # the ones /changes shows
+
+
+class CursorExpired(Exception):
+    pass
+
+
+class ChangeLog:
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.entries = collections.deque()  # events, oldest first
+        self.last_seq = 0
+        self.consumers = {}  # consumer id -> (seq read up to, last seen)
+
+    def append(self, filename, old, new):
+        kind = "create" if old is None else "delete" if new is None else "update"
+        self.append_event(kind, filename=filename, file=dict(new) if new is not None else None)
+
+    def append_event(self, kind, **fields):
+        self.last_seq += 1
+        self._push({"seq": self.last_seq, "type": kind, **fields, "at": time.time()})
+
+    def replay(self, event):
+        """Append an event read from the leader's log, keeping its sequence number."""
+        if event["seq"] != self.last_seq + 1:
+            raise CursorExpired(f"expected event {self.last_seq + 1}, got {event['seq']}")
+        self.last_seq = event["seq"]
+        self._push(event)
+
+    def reset(self, cursor):
+        """Start over at the leader's ``cursor`` (a follower that loaded a snapshot)."""
+        self.epoch, _, seq = cursor.partition(":")
+        self.last_seq = int(seq)
+        self.entries.clear()
+        self.consumers.clear()  # their cursors are from the old epoch
+
+    def resume(self, seq):
+        """Number the next event after ``seq`` (state restored from a catalog snapshot).
+
+        The epoch stays new: events after the snapshot were lost with the old
+        process, so cursors from before the restart are still refused.
+        """
+        self.last_seq = seq
+
+    def _push(self, event):
+        self.entries.append(event)
+        if len(self.entries) > MAX_ENTRIES:
+            self.entries.popleft()
+
+    def truncate(self, seq):
+        """Forget events after ``seq`` (a rolled-back batch)."""
+        while self.entries and self.entries[-1]["seq"] > seq:
+            self.entries.pop()
+        self.last_seq = seq
+
+    # ---------------- cursors ----------------
+    def cursor(self, seq=None):
+        return f"{self.epoch}:{self.last_seq if seq is None else seq}"
+
+    def parse(self, cursor):
+        """Sequence number of ``cursor``; an empty cursor means "from now"."""
+        if not cursor:
+            return self.last_seq
+        epoch, _, seq = cursor.partition(":")
+        try:
+            seq = int(seq)
+        except ValueError:
+            raise CursorExpired("malformed cursor")
+        if epoch != self.epoch:
+            raise CursorExpired("cursor is from an earlier run of the metadata service")
+        if seq > self.last_seq:
+            raise CursorExpired("cursor is ahead of the change log")
+        first = self.entries[0]["seq"] if self.entries else self.last_seq + 1
+        if seq < first - 1:
+            raise CursorExpired("cursor is older than the retained change log")
+        return seq
+
+    def read(self, seq, limit):
+        # entries are contiguous, so the position of seq + 1 is computed, not searched
+        if not self.entries:
+            return []
+        start = seq + 1 - self.entries[0]["seq"]
+        return [self.entries[i] for i in range(max(0, start), min(len(self.entries), start + limit))]
+
+    # ---------------- consumers & compaction ----------------
+    def ack(self, consumer, seq):
+        self.consumers[consumer] = (seq, time.monotonic())
+        self.compact()
+
+    def compact(self):
+        now = time.monotonic()
+        for consumer in [c for c, (_, seen) in self.consumers.items() if now - seen > CONSUMER_TTL]:
+            del self.consumers[consumer]
+        if not self.consumers:
+            return  # nobody to wait for; anonymous readers get the retained tail
+        oldest = min(seq for seq, _ in self.consumers.values())
+        while self.entries and self.entries[0]["seq"] <= oldest:
+            self.entries.popleft()
+
+    def stats(self):
+        return {"entries": len(self.entries), "last_seq": self.last_seq, "consumers": len(self.consumers)}
@@ -0,0 +1,254 @@
+"""Secondary indexes over the metadata records, and the query planner that uses them.
+
+Sorted indexes keep ``(key, filename)`` tuples ordered with ``bisect``, so
+a range (size between, modified since, filename prefix) is two binary
+searches and a scan of the entries in it. Owner and MIME type are hash
+indexes of sets. Every change to a record goes through ``Indexes.update``.
+
+A query is driven by whichever index yields the fewest candidates for its
+filters; the other filters are checked on each candidate. When the result
+is sorted on an indexed field and limited, walking that index in order and
+stopping at the limit is used instead if it is expected to be cheaper. So
+the cost follows the size of the result, not the number of files.
+"""
+import bisect
+import heapq
+import itertools
+
+SORTED_FIELDS = {"name": "filename", "size": "size", "modified": "modified"}
+MAX_KEY = "\U0010ffff"
+
+
+class SortedIndex:
+    """(key, filename) entries in sorted order, kept in chunks of about LOAD.
+
+    One flat list would make every insert move O(n) entries; with chunks an
+    insert or remove only touches one short list. Positions are (chunk, offset).
+    """
+    LOAD = 1000
+
+    def __init__(self, entries=()):
+        # entries, if given, must already be in order
+        entries = list(entries)
+        # sorted lists; all entries of chunk i sort before chunk i + 1
+        self.chunks = [entries[i:i + self.LOAD] for i in range(0, len(entries), self.LOAD)]
+        self.maxes = [chunk[-1] for chunk in self.chunks]  # last entry of each chunk
+
+    def add(self, key, filename):
+        entry = (key, filename)
+        if not self.chunks:
+            self.chunks.append([entry])
+            self.maxes.append(entry)
+            return
+        i = min(bisect.bisect_left(self.maxes, entry), len(self.chunks) - 1)
+        chunk = self.chunks[i]
+        bisect.insort(chunk, entry)
+        self.maxes[i] = chunk[-1]
+        if len(chunk) > 2 * self.LOAD:
+            self.chunks[i:i + 1] = [chunk[:self.LOAD], chunk[self.LOAD:]]
+            self.maxes[i:i + 1] = [chunk[self.LOAD - 1], chunk[-1]]
+
+    def remove(self, key, filename):
+        entry = (key, filename)
+        i = bisect.bisect_left(self.maxes, entry)
+        if i == len(self.chunks):
+            return
+        chunk = self.chunks[i]
+        j = bisect.bisect_left(chunk, entry)
+        if chunk[j] != entry:
+            return
+        del chunk[j]
+        if not chunk:
+            del self.chunks[i], self.maxes[i]
+        else:
+            self.maxes[i] = chunk[-1]
+
+    def _position(self, entry, right):
+        find = bisect.bisect_right if right else bisect.bisect_left
+        i = find(self.maxes, entry)
+        if i == len(self.chunks):
+            return i, 0
+        return i, find(self.chunks[i], entry)
+
+    def bounds(self, lo=None, hi=None):
+        """Positions around the entries with lo <= key <= hi (None = open end)."""
+        start = (0, 0) if lo is None else self._position((lo,), right=False)
+        end = (len(self.chunks), 0) if hi is None else self._position((hi, MAX_KEY), right=True)
+        return start, max(start, end)
+
+    def count(self, start, end):
+        (si, sj), (ei, ej) = start, end
+        if si == ei:
+            return ej - sj
+        return len(self.chunks[si]) - sj + sum(len(c) for c in self.chunks[si + 1:ei]) + ej
+
+    def scan(self, start, end, reverse=False):
+        (si, sj), (ei, ej) = start, end
+        last = min(ei, len(self.chunks) - 1)
+        chunks = range(last, si - 1, -1) if reverse else range(si, last + 1)
+        for i in chunks:
+            chunk = self.chunks[i]
+            lo = sj if i == si else 0
+            hi = ej if i == ei else len(chunk)
+            part = chunk[lo:hi]
+            if reverse:
+                part.reverse()
+            for _, filename in part:
+                yield filename
+
+
+class Indexes:
+    def __init__(self):
+        self.sorted = {field: SortedIndex() for field in SORTED_FIELDS}
+        self.owner = {}  # owner -> set of filenames
+        self.mime = {}  # mime -> set of filenames
+
+    @staticmethod
+    def _keys(record):
+        return {
+            "name": record["filename"],
+            "size": record.get("size") or 0,
+            "modified": record.get("modified") or 0,
+        }
+
+    def update(self, filename, old, new):
+        """Move ``filename`` from record ``old`` to record ``new`` (either may be None).
+
+        Raises ValueError, with nothing changed, if ``new`` has a size or
+        modification time that is not a number and so cannot be ordered.
+        """
+        if new is not None:
+            keys = self._keys(new)
+            for field in ("size", "modified"):
+                if type(keys[field]) not in (int, float):
+                    raise ValueError(f"{SORTED_FIELDS[field]} must be a number")
+        if old is not None:
+            for field, key in self._keys(old).items():
+                self.sorted[field].remove(key, filename)
+            _discard(self.owner, old.get("user"), filename)
+            _discard(self.mime, old.get("mime"), filename)
+        if new is not None:
+            for field, key in keys.items():
+                self.sorted[field].add(key, filename)
+            self.owner.setdefault(new.get("user"), set()).add(filename)
+            self.mime.setdefault(new.get("mime"), set()).add(filename)
+
+    def load(self, names, sizes, modified, owners, mimes):
+        """Index a whole catalog at once, replacing what is indexed; much faster than ``update`` per record.
+
+        ``names`` is every filename in order; the other lists hold the same records' fields.
+        """
+        self.sorted["name"] = SortedIndex(zip(names, names))
+        for field, keys in (("size", sizes), ("modified", modified)):
+            keys = [key or 0 for key in keys]
+            # sorting is stable, so equal keys stay in filename order, as (key, filename) sorts
+            order = sorted(range(len(names)), key=keys.__getitem__)
+            self.sorted[field] = SortedIndex((keys[i], names[i]) for i in order)
+        self.owner, self.mime = {}, {}
+        for filename, owner, mime in zip(names, owners, mimes):
+            self.owner.setdefault(owner, set()).add(filename)
+            self.mime.setdefault(mime, set()).add(filename)
+
+    def names(self):
+        """Every filename, in order. The index is copied now, so this can be read after the lock is released."""
+        chunks = [list(chunk) for chunk in self.sorted["name"].chunks]
+        return (filename for chunk in chunks for filename, _ in chunk)
+
+    # ---------------- querying ----------------
+    def query(self, files, owner=None, prefix=None, min_size=None, max_size=None,
+              modified_after=None, modified_before=None, mime=None, sort="name", limit=None, after=None):
+        """Records matching every given filter, sorted by ``sort`` ("-size" = descending).
+
+        ``after`` keeps only names that sort after it, to page through a name-sorted result.
+        """
+        name_range = (prefix, prefix + MAX_KEY) if prefix else (None, None)
+        if after is not None and (name_range[0] is None or after >= name_range[0]):
+            name_range = (after + "\0", name_range[1])  # the first name after it
+        ranges = {
+            "name": name_range,
+            "size": (min_size, max_size),
+            "modified": (modified_after, modified_before),
+        }
+        # candidate sources: (count, iterator factory)
+        sources = []
+        for field, (lo, hi) in ranges.items():
+            if lo is not None or hi is not None:
+                index = self.sorted[field]
+                start, end = index.bounds(lo, hi)
+                sources.append((index.count(start, end), lambda i=index, s=start, e=end: i.scan(s, e)))
+        if owner is not None:
+            names = self.owner.get(owner, ())
+            sources.append((len(names), lambda n=names: iter(list(n))))
+        if mime is not None:
+            names = self._mime_set(mime)
+            sources.append((len(names), lambda n=names: iter(n)))
+
+        def matches(record):
+            size = record.get("size") or 0
+            modified = record.get("modified") or 0
+            return ((owner is None or record.get("user") == owner)
+                    and (not prefix or record["filename"].startswith(prefix))
+                    and (after is None or record["filename"] > after)
+                    and (min_size is None or size >= min_size)
+                    and (max_size is None or size <= max_size)
+                    and (modified_after is None or modified >= modified_after)
+                    and (modified_before is None or modified <= modified_before)
+                    and (mime is None or _mime_matches(record.get("mime"), mime)))
+
+        reverse = sort.startswith("-")
+        sort_field = sort.lstrip("-")
+        if sort_field not in SORTED_FIELDS:
+            raise ValueError(f"cannot sort by {sort_field}")
+        sort_index = self.sorted[sort_field]
+        sort_start, sort_end = sort_index.bounds(*ranges[sort_field])
+
+        best = min(sources, key=lambda s: s[0]) if sources else None
+        # walk the sort index in order and stop at the limit, if that beats
+        # collecting and sorting the smallest candidate set
+        walk_sorted = best is None or (
+            limit is not None
+            and limit * sort_index.count(sort_start, sort_end) / max(1, best[0]) < best[0])
+
+        if walk_sorted:
+            hits = (r for r in (files[n] for n in sort_index.scan(sort_start, sort_end, reverse)) if matches(r))
+            return [dict(r) for r in itertools.islice(hits, limit)]
+
+        hits = [files[n] for n in best[1]() if matches(files[n])]
+        key = _sort_key(SORTED_FIELDS[sort_field])
+        if limit is not None:
+            pick = heapq.nlargest if reverse else heapq.nsmallest
+            hits = pick(limit, hits, key=key)
+        else:
+            hits.sort(key=key, reverse=reverse)
+        return [dict(r) for r in hits]
+
+    def _mime_set(self, mime):
+        # "image/*" matches every image type
+        if mime.endswith("/*"):
+            names = set()
+            for value, members in self.mime.items():
+                if _mime_matches(value, mime):
+                    names |= members
+            return names
+        return self.mime.get(mime, ())
+
+
+def _discard(index, key, filename):
+    members = index.get(key)
+    if members is not None:
+        members.discard(filename)
+        if not members:
+            del index[key]
+
+
+def _mime_matches(value, wanted):
+    if wanted.endswith("/*"):
+        return bool(value) and value.startswith(wanted[:-1])
+    return value == wanted
+
+
+def _sort_key(field):
+    # ties broken by filename, like the sorted indexes
+    if field == "filename":
+        return lambda r: r["filename"]
+    return lambda r: (r.get(field) or 0, r["filename"])
@@ -0,0 +1,74 @@
+"""Registry of storage nodes, kept current by their heartbeats.
+
+Every few seconds each storage node reports its URL, free and total disk
+space, transfers in progress and recent request latency. The gateways read
+the list to place new uploads, and storage nodes use it to find the node
+that holds an object.
+
+A node is ``up``, ``draining`` or ``down``. It drains when its disk is
+nearly full or its latency is well above normal, and comes back once it
+has recovered by a margin, so it does not flap on the threshold. A node
+that misses heartbeats for ``NODE_TIMEOUT`` seconds is down. Draining and
+down nodes get no new uploads but still serve the objects they hold.
+
+Callers hold the metadata lock.
+"""
+import os
+import time
+
+NODE_TIMEOUT = float(os.environ.get("NODE_TIMEOUT", "15"))  # seconds without a heartbeat before a node is down
+DRAIN_FREE_RATIO = float(os.environ.get("NODE_DRAIN_FREE_RATIO", "0.05"))  # drain below this fraction of disk free
+RESUME_FREE_RATIO = float(os.environ.get("NODE_RESUME_FREE_RATIO", "0.10"))
+DRAIN_LATENCY_MS = float(os.environ.get("NODE_DRAIN_LATENCY_MS", "2000"))  # drain above this recent latency
+RESUME_LATENCY_MS = float(os.environ.get("NODE_RESUME_LATENCY_MS", "1000"))
+
+REPORT_FIELDS = ("url", "free_bytes", "total_bytes", "in_flight", "latency_ms")
+
+
+class Registry:
+    def __init__(self):
+        self.nodes = {}  # node id -> last report, plus "last_seen" and "drain" reasons
+
+    def heartbeat(self, node_id, report):
+        node = self.nodes.setdefault(node_id, {"id": node_id, "drain": []})
+        for field in REPORT_FIELDS:
+            if field in report:
+                node[field] = report[field]
+        node["last_seen"] = time.time()
+        node["drain"] = self._drain_reasons(node)
+        return self.view(node)
+
+    @staticmethod
+    def _drain_reasons(node):
+        reasons = set(node["drain"])
+        total = node.get("total_bytes") or 0
+        if total:
+            free = (node.get("free_bytes") or 0) / total
+            if free < DRAIN_FREE_RATIO:
+                reasons.add("disk_full")
+            elif free >= RESUME_FREE_RATIO:
+                reasons.discard("disk_full")
+        latency = node.get("latency_ms") or 0
+        if latency > DRAIN_LATENCY_MS:
+            reasons.add("slow")
+        elif latency <= RESUME_LATENCY_MS:
+            reasons.discard("slow")
+        return sorted(reasons)
+
+    def view(self, node):
+        view = dict(node)
+        if time.time() - node["last_seen"] > NODE_TIMEOUT:
+            view["state"] = "down"
+        else:
+            view["state"] = "draining" if node["drain"] else "up"
+        return view
+
+    def get(self, node_id):
+        node = self.nodes.get(node_id)
+        return self.view(node) if node is not None else None
+
+    def list(self):
+        return [self.view(node) for node in self.nodes.values()]
+
+    def remove(self, node_id):
+        return self.nodes.pop(node_id, None) is not None
@@ -0,0 +1,90 @@
+"""Deleted records, kept for a restore window until storage frees their bytes.
+
+A delete with ``trash`` moves the record here instead of dropping it: the
+file disappears from listings and queries at once, and its bytes stay
+where they are, still counted in the owner's usage until they are freed.
+Until ``TRASH_RETENTION`` seconds have passed the owner can restore it.
+After that the entry is expired: the reclaimer on the storage node that
+holds the bytes removes them, a batch at a time, and then purges the
+entry. Expired entries cannot be restored, so a restore never races the
+reclaimer.
+
+Entries are kept in deletion order, so the expired ones are always a prefix.
+Callers hold the metadata lock.
+"""
+import os
+import time
+import uuid
+
+RETENTION = float(os.environ.get("TRASH_RETENTION", str(7 * 86400)))  # seconds a deleted file can be restored
+
+
+class Trash:
+    def __init__(self):
+        self.entries = {}  # trash id -> record plus "trash_id" and "deleted_at", oldest first
+        self.by_object = {}  # object id -> trash id, so the scrubber does not take trashed objects for orphans
+        self.bytes = 0
+
+    def add(self, record):
+        entry = dict(record, trash_id=uuid.uuid4().hex, deleted_at=time.time())
+        self.entries[entry["trash_id"]] = entry
+        if entry.get("object_id"):
+            self.by_object[entry["object_id"]] = entry["trash_id"]
+        self.bytes += entry.get("size") or 0
+        return entry
+
+    def load(self, entries):
+        """Put back entries saved with the catalog, oldest first."""
+        for entry in entries:
+            self.entries[entry["trash_id"]] = entry
+            if entry.get("object_id"):
+                self.by_object[entry["object_id"]] = entry["trash_id"]
+            self.bytes += entry.get("size") or 0
+
+    def get(self, trash_id):
+        return self.entries.get(trash_id)
+
+    def find_object(self, object_id):
+        trash_id = self.by_object.get(object_id)
+        return self.entries[trash_id] if trash_id is not None else None
+
+    def remove(self, trash_id):
+        entry = self.entries.pop(trash_id, None)
+        if entry is None:
+            return None
+        if entry.get("object_id"):
+            self.by_object.pop(entry["object_id"], None)
+        self.bytes -= entry.get("size") or 0
+        return entry
+
+    @staticmethod
+    def expired(entry, now=None):
+        return (now or time.time()) - entry["deleted_at"] >= RETENTION
+
+    def list(self, user=None):
+        """Restorable entries, newest first."""
+        now = time.time()
+        return [e for e in reversed(self.entries.values())
+                if not self.expired(e, now) and (user is None or e.get("user") == user)]
+
+    def due(self, node=None, limit=100):
+        """Expired entries for the reclaimer, oldest first; records without a node belong to every node."""
+        now = time.time()
+        found = []
+        for entry in self.entries.values():
+            if not self.expired(entry, now) or len(found) >= limit:
+                break
+            if node is None or entry.get("node") in (None, node):
+                found.append(entry)
+        return found
+
+    def stats(self):
+        now = time.time()
+        backlog = backlog_bytes = 0
+        for entry in self.entries.values():
+            if not self.expired(entry, now):
+                break
+            backlog += 1
+            backlog_bytes += entry.get("size") or 0
+        return {"entries": len(self.entries), "bytes": self.bytes,
+                "reclaim_backlog": backlog, "reclaim_backlog_bytes": backlog_bytes}
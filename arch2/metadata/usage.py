@@ -0,0 +1,142 @@
+"""Per-user usage counters, quotas and upload reservations.
+
+``Ledger.update`` is called with the old and new version of every record
+that changes, so bytes and file counts per owner are always current and
+reading them is a dict lookup. Trashed files count until the reclaimer
+frees their bytes, or a user could trash files and keep uploading past
+the quota. Callers hold the metadata lock.
+
+Quotas are enforced when an upload is admitted: the gateway reserves the
+request's size before reading it, and the reservation counts against the
+quota until the gateway releases it (or it expires). The size of a
+streamed archive is not known up front, so its admission also returns the
+headroom left, and storage stops unpacking once the archive outgrows it. Reconciliation
+recomputes the counters from a snapshot of the records and corrects any
+drift, without holding the lock for the scan.
+"""
+import os
+import time
+import uuid
+
+DEFAULT_QUOTA_BYTES = int(os.environ.get("QUOTA_BYTES", "0"))  # per user; 0 = unlimited
+DEFAULT_QUOTA_FILES = int(os.environ.get("QUOTA_FILES", "0"))
+RESERVATION_TTL = float(os.environ.get("QUOTA_RESERVATION_TTL", "3600"))  # seconds before an unreleased reservation lapses
+
+
+def _zero():
+    return {"bytes": 0, "files": 0}
+
+
+def _add(table, user, nbytes, nfiles):
+    entry = table.get(user)
+    if entry is None:
+        entry = table[user] = _zero()
+    entry["bytes"] += nbytes
+    entry["files"] += nfiles
+    if not entry["bytes"] and not entry["files"]:
+        del table[user]
+
+
+class Ledger:
+    def __init__(self):
+        self.usage = {}  # user -> {"bytes", "files"} of stored records
+        self.reserved = {}  # user -> {"bytes", "files"} of admitted, unfinished uploads
+        self.reservations = {}  # id -> (user, bytes, files, expires)
+        self.quotas = {}  # user -> {"bytes", "files"}; missing users get the defaults
+        self._delta = None  # changes made while a reconciliation is scanning
+
+    def update(self, old, new):
+        for record, sign in ((old, -1), (new, 1)):
+            if record is None or record.get("user") is None:
+                continue
+            nbytes = sign * (record.get("size") or 0)
+            _add(self.usage, record["user"], nbytes, sign)
+            if self._delta is not None:
+                _add(self._delta, record["user"], nbytes, sign)
+
+    def quota(self, user):
+        return self.quotas.get(user, {"bytes": DEFAULT_QUOTA_BYTES, "files": DEFAULT_QUOTA_FILES})
+
+    def set_quota(self, user, nbytes, nfiles):
+        self.quotas[user] = {"bytes": nbytes, "files": nfiles}
+
+    def report(self, user):
+        used = self.usage.get(user, _zero())
+        reserved = self.reserved.get(user, _zero())
+        quota = self.quota(user)
+        return {
+            "user": user,
+            "bytes": used["bytes"],
+            "files": used["files"],
+            "reserved_bytes": reserved["bytes"],
+            "reserved_files": reserved["files"],
+            "quota_bytes": quota["bytes"],
+            "quota_files": quota["files"],
+        }
+
+    # ---------------- admission ----------------
+    def reserve(self, user, nbytes, nfiles=1):
+        """Reservation ID, or None if the upload would go over the user's quota."""
+        self._expire()
+        used = self.usage.get(user, _zero())
+        reserved = self.reserved.get(user, _zero())
+        quota = self.quota(user)
+        if quota["bytes"] and used["bytes"] + reserved["bytes"] + nbytes > quota["bytes"]:
+            return None
+        if quota["files"] and used["files"] + reserved["files"] + nfiles > quota["files"]:
+            return None
+        reservation = uuid.uuid4().hex
+        self.reservations[reservation] = (user, nbytes, nfiles, time.monotonic() + RESERVATION_TTL)
+        _add(self.reserved, user, nbytes, nfiles)
+        return reservation
+
+    def headroom(self, user):
+        """{"bytes", "files"} the user can still add beyond usage and reservations; None where unlimited."""
+        used = self.usage.get(user, _zero())
+        reserved = self.reserved.get(user, _zero())
+        quota = self.quota(user)
+        return {kind: max(quota[kind] - used[kind] - reserved[kind], 0) if quota[kind] else None
+                for kind in ("bytes", "files")}
+
+    def release(self, reservation):
+        entry = self.reservations.pop(reservation, None)
+        if entry is None:
+            return False
+        user, nbytes, nfiles, _ = entry
+        _add(self.reserved, user, -nbytes, -nfiles)
+        return True
+
+    def _expire(self):
+        now = time.monotonic()
+        for reservation in [r for r, entry in self.reservations.items() if entry[3] <= now]:
+            self.release(reservation)
+
+    # ---------------- reconciliation ----------------
+    def begin_reconcile(self):
+        # caller takes a snapshot of the records under the same lock
+        self._delta = {}
+
+    def finish_reconcile(self, totals):
+        """Replace the counters with ``totals`` (from the snapshot) plus changes since.
+
+        Returns {user: {"bytes": drift, "files": drift}} for the users that were off.
+        """
+        for user, change in self._delta.items():
+            _add(totals, user, change["bytes"], change["files"])
+        self._delta = None
+        drift = {}
+        for user in set(totals) | set(self.usage):
+            want, have = totals.get(user, _zero()), self.usage.get(user, _zero())
+            if want != have:
+                drift[user] = {"bytes": want["bytes"] - have["bytes"], "files": want["files"] - have["files"]}
+        self.usage = totals
+        return drift
+
+
+def totals_of(users, sizes):
+    """Usage computed from scratch from the owner and size of every record, for reconciliation."""
+    totals = {}
+    for user, size in zip(users, sizes):
+        if user is not None:
+            _add(totals, user, size or 0, 1)
+    return totals
@@ -0,0 +1,161 @@
+"""Zip archives written while they are sent.
+
+``GET /files/download/archive`` answers with a zip of several files that
+is produced entry by entry as the files are read from storage: nothing is
+buffered beyond the chunk in flight, whatever the size of the archive. Only
+the central directory, a few dozen bytes per entry, is kept until the end.
+
+Files whose type is already compressed (images, audio, video, archives)
+are stored as they are; everything else is deflated. A stored entry's
+CRC-32 and size go in its local header, from the ``crc32`` storage computed
+at upload, so a client can unpack the archive as it arrives. Deflated
+entries, and stored ones uploaded before CRCs were recorded (which are
+deflated instead), have a data descriptor after their data; a deflate
+stream ends on its own, so they can be unpacked as they arrive too.
+
+Entries, sizes and offsets past the classic zip limits use Zip64.
+"""
+import os
+import struct
+import time
+import zlib
+
+import metrics
+
+LEVEL = int(os.environ.get("ZIP_COMPRESS_LEVEL", "6"))  # deflate level for compressible files
+
+# deflate can grow incompressible data slightly, so entries this large get
+# 64-bit size fields whether or not they end up needing them
+ZIP64_THRESHOLD = 1 << 31
+MAX_32 = 0xFFFFFFFF
+MAX_16 = 0xFFFF
+
+STORED_PREFIXES = ("image/", "audio/", "video/")
+STORED_TYPES = {
+    "application/zip", "application/gzip", "application/x-gzip", "application/x-bzip2", "application/x-xz",
+    "application/x-7z-compressed", "application/x-rar-compressed", "application/vnd.rar", "application/zstd",
+    "application/pdf", "application/epub+zip", "application/java-archive",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+}
+UNCOMPRESSED_MEDIA = {"image/bmp", "image/svg+xml", "image/x-icon", "audio/wav", "audio/x-wav"}
+
+STORED, DEFLATED = 0, 8
+FLAG_DESCRIPTOR = 0x08  # CRC and sizes follow the data
+FLAG_UTF8 = 0x800
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+
+ENTRIES = metrics.counter("gateway_zip_entries_total", "Files sent in zip downloads", ["method"])
+ZIP_BYTES = metrics.counter("gateway_zip_bytes_total", "Zip download bytes, before and after compression", ["kind"])
+
+
+class ZipError(Exception):
+    pass
+
+
+def is_compressed(mime):
+    mime = (mime or "").split(";")[0].strip().lower()
+    if mime in UNCOMPRESSED_MEDIA:
+        return False
+    return mime in STORED_TYPES or mime.startswith(STORED_PREFIXES)
+
+
+def _dos_time(timestamp):
+    t = time.localtime(timestamp or time.time())
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1  # 1980-01-01, the earliest a zip can say
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def _zip64_extra(*values):
+    return struct.pack("<HH", 0x0001, 8 * len(values)) + struct.pack(f"<{len(values)}Q", *values)
+
+
+class ZipWriter:
+    """Produces a zip as a sequence of byte chunks, one entry at a time."""
+
+    def __init__(self):
+        self.offset = 0
+        self.central = []  # central directory records, written by finish()
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def entry(self, name, chunks, size, modified=None, crc32=None, mime=None):
+        """Yield one entry for ``name`` with the bytes from ``chunks`` (``size`` of them)."""
+        stored = crc32 is not None and is_compressed(mime)
+        method = STORED if stored else DEFLATED
+        flags = FLAG_UTF8 | (0 if stored else FLAG_DESCRIPTOR)
+        zip64 = size >= ZIP64_THRESHOLD
+        version = 45 if zip64 else 20
+        dos_time, dos_date = _dos_time(modified)
+        encoded = name.encode("utf-8")
+        header_offset = self.offset
+
+        if stored:
+            header_sizes = (MAX_32, MAX_32) if zip64 else (size, size)
+            extra = _zip64_extra(size, size) if zip64 else b""
+            header_crc = crc32
+        else:
+            header_sizes = (0, 0)
+            extra = _zip64_extra(0, 0) if zip64 else b""  # marks the descriptor as 64-bit
+            header_crc = 0
+        yield self._emit(LOCAL_HEADER.pack(0x04034B50, version, flags, method, dos_time, dos_date, header_crc,
+                                           *header_sizes, len(encoded), len(extra)) + encoded + extra)
+
+        crc, read, written = 0, 0, 0
+        compressor = None if stored else zlib.compressobj(LEVEL, zlib.DEFLATED, -15)
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            read += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                written += len(chunk)
+                yield self._emit(chunk)
+        if compressor is not None:
+            tail = compressor.flush()
+            written += len(tail)
+            yield self._emit(tail)
+        if read != size:
+            raise ZipError(f"{name}: expected {size} bytes, read {read}")
+        if stored and crc != crc32:
+            raise ZipError(f"{name}: CRC-32 does not match the one recorded at upload")
+        if not stored:
+            fmt = "<IIQQ" if zip64 else "<IIII"
+            yield self._emit(struct.pack(fmt, 0x08074B50, crc, written, read))
+
+        ENTRIES.inc(method="stored" if stored else "deflated")
+        ZIP_BYTES.inc(read, kind="in")
+        ZIP_BYTES.inc(written, kind="out")
+        self.central.append((encoded, version, flags, method, dos_time, dos_date, crc, written, read, header_offset))
+
+    def finish(self):
+        """Yield the central directory and the end records."""
+        start = self.offset
+        for encoded, version, flags, method, dos_time, dos_date, crc, written, read, header_offset in self.central:
+            # Zip64 fields appear in this order, only for the values that overflow
+            overflow = [value for value in (read, written, header_offset) if value >= MAX_32]
+            extra = _zip64_extra(*overflow) if overflow else b""
+            if overflow:
+                version = 45
+            yield self._emit(CENTRAL_HEADER.pack(
+                0x02014B50, (3 << 8) | version, version, flags, method, dos_time, dos_date, crc,
+                min(written, MAX_32), min(read, MAX_32), len(encoded), len(extra), 0, 0, 0,
+                0o100644 << 16, min(header_offset, MAX_32)) + encoded + extra)
+        size = self.offset - start
+        count = len(self.central)
+        if count >= MAX_16 or size >= MAX_32 or start >= MAX_32:
+            zip64_end = self.offset
+            yield self._emit(ZIP64_END_RECORD.pack(0x06064B50, ZIP64_END_RECORD.size - 12, (3 << 8) | 45, 45,
+                                                   0, 0, count, count, size, start))
+            yield self._emit(ZIP64_LOCATOR.pack(0x07064B50, 0, zip64_end, 1))
+        yield self._emit(END_RECORD.pack(0x06054B50, 0, 0, min(count, MAX_16), min(count, MAX_16),
+                                         min(size, MAX_32), min(start, MAX_32), 0))
@@ -3,14 +3,41 @@ import jwt
 import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask import Flask, request, jsonify, Response
-import requests, os
+import uuid
+import metrics
+import tracing
+import profiling
+import admission
+import placement
 
 app = Flask(__name__)
+metrics.instrument(app)
+tracing.instrument(app, edge=True)  # clients call this service: it decides sampling
+profiling.instrument(app)
+admission.instrument(app)
 
 METADATA_API = "http://metadata:5005" # metadata service URL
+METADATA_READ_API = os.environ.get("METADATA_READ_API", METADATA_API)  # may be a metadata follower
 STORAGE_API = "http://storage:5006" # storage service URL
 SECRET_KEY = os.environ.get("SECRET_KEY", "supersecretkey") # secret key for JWT - in more secure setup, use env variable
 
+# shared session: keep-alive to storage/metadata, request ID forwarded, upstream latency recorded
+http = metrics.instrument_session(tracing.TracedSession())
+
+# read-your-writes: writes answer with the metadata log position they reached,
+# and a client that sends it back on reads sees at least that state even when
+# reads go to a metadata follower
+SEQ_HEADER = "X-Metadata-Seq"
+
+def seq_of(resp):
+    return {SEQ_HEADER: resp.headers.get(SEQ_HEADER, "")}
+
+def read_headers():
+    return {SEQ_HEADER: request.headers[SEQ_HEADER]} if SEQ_HEADER in request.headers else None
+
+# picks the storage node for each upload from the node registry (see placement.py)
+PLACEMENT = placement.Placement(http, f"{METADATA_API}/nodes", STORAGE_API)
+
 
 # --- JWT Helpers ---
 def encode_token(username):
@@ -46,14 +73,14 @@ def signup():
     hashed_password = generate_password_hash(password)
     try:
         # send to metadata service
-        resp = requests.post(f"{METADATA_API}/users", json={
+        resp = http.post(f"{METADATA_API}/users", json={
             "username": username,
             "password": hashed_password
         })
 
         # check response from metadata service
         if resp.status_code == 201:
-            return jsonify({"message": "Signup successful!"}), 201
+            return jsonify({"message": "Signup successful!"}), 201, seq_of(resp)
         elif resp.status_code == 409:
             return jsonify({"error": "Username already exists"}), 409
         else:
@@ -74,7 +101,7 @@ def login():
 
     try:
         # fetch user from metadata service
-        resp = requests.get(f"{METADATA_API}/users/{username}")
+        resp = http.get(f"{METADATA_READ_API}/users/{username}")
 
         # check the response
         if resp.status_code != 200:
@@ -93,6 +120,20 @@ def login():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# stream uploaded files back out as a multipart body without buffering them
+def multipart_body(files, boundary):
+    for file in files:
+        name = file.filename.replace('"', "%22")
+        yield (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+               f'Content-Type: {file.mimetype or "application/octet-stream"}\r\n\r\n').encode()
+        while True:
+            chunk = file.stream.read(1024 * 1024)
+            if not chunk:
+                break
+            yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
 # auth decorator
 def require_auth(f):
     def wrapper(*args, **kwargs):
@@ -109,6 +150,11 @@ def require_auth(f):
         if not username:
             return jsonify({"error": "Invalid or expired token"}), 401
         request.username = username
+
+        # per-user rate and concurrency limits (429 with Retry-After)
+        rejected = admission.admit(username)
+        if rejected is not None:
+            return rejected
         return f(*args, **kwargs)
     wrapper.__name__ = f.__name__
     return wrapper
@@ -117,37 +163,149 @@ def require_auth(f):
 @app.route("/files/upload", methods=["POST"])
 @require_auth
 def upload():
+    # admission: reserve quota for the whole request before reading its body,
+    # so an upload over quota is refused without being transferred
+    if request.content_length is None:
+        # a chunked body would reserve nothing; archives of unknown size go to /files/upload/archive
+        return jsonify({"error": "Content-Length is required"}), 411
+    try:
+        resp = http.post(f"{METADATA_API}/users/{request.username}/reservations",
+                         json={"bytes": request.content_length})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if resp.status_code == 413:
+        return resp.json(), 413
+    if resp.status_code != 201:
+        return jsonify({"error": "Metadata error - " + resp.text}), 500
+    reservation = resp.json()["reservation"]
+
+    try:
+        return forward_upload()
+    finally:
+        # the stored files now count towards usage themselves
+        try:
+            http.delete(f"{METADATA_API}/users/{request.username}/reservations/{reservation}")
+        except Exception:
+            pass  # it expires on its own
+
+def forward_upload():
     if "file" not in request.files:
         return jsonify({"error": "No file part"}), 400
     
-    # get the file
-    file = request.files["file"]
-    files = {'file': (file.filename, file.stream, file.mimetype)}
+    # get the file(s)
+    files = request.files.getlist("file")
 
-    # forward the file to the storage service via POST
-    resp = requests.post(f"{STORAGE_API}/upload", files=files)
+    # the least loaded of two storage nodes gets the upload; it stays on that node
+    with PLACEMENT.place() as storage_api:
+        if len(files) == 1:
+            # forward the file body as-is; storage ingests it in a single pass
+            file = files[0]
+            resp = http.post(f"{storage_api}/upload", params={"filename": file.filename, "user": request.username},
+                             data=file.stream, headers={"Content-Type": file.mimetype or "application/octet-stream"})
+        else:
+            # several files go to storage in one streamed multipart request,
+            # which it records in metadata with a single batch
+            boundary = uuid.uuid4().hex
+            resp = http.post(f"{storage_api}/upload", params={"user": request.username},
+                             data=multipart_body(files, boundary),
+                             headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
 
-    # check response from storage service
+    # check response from storage service; 403 if the name is another user's file
+    if resp.status_code == 403:
+        return resp.json(), 403
     if resp.status_code != 200:
         return jsonify({"error": "Storage error"}), 500
 
     try:
-        return resp.json(), resp.status_code
+        return resp.json(), resp.status_code, seq_of(resp)
     except Exception:
         return jsonify({"error": "Non-JSON response from storage", "raw": resp.text}), resp.status_code
 
+# upload a whole tree as one tar stream (optionally compressed); storage
+# unpacks it as it arrives and records every file in one metadata batch
+@app.route("/files/upload/archive", methods=["POST"])
+@require_auth
+def upload_archive():
+    # the size of a streamed archive is usually not known up front, so storage
+    # is told the quota headroom and refuses an archive that outgrows it
+    reserved = request.content_length or 0
+    try:
+        resp = http.post(f"{METADATA_API}/users/{request.username}/reservations", json={"bytes": reserved})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if resp.status_code == 413:
+        return resp.json(), 413
+    if resp.status_code != 201:
+        return jsonify({"error": "Metadata error - " + resp.text}), 500
+    reservation = resp.json()["reservation"]
+    headroom = resp.json().get("headroom") or {}
+    params = {"user": request.username, "prefix": request.args.get("prefix", "")}
+    if headroom.get("bytes") is not None:
+        params["max_bytes"] = headroom["bytes"] + reserved
+    if headroom.get("files") is not None:
+        params["max_files"] = headroom["files"] + 1  # the reservation holds one file
+
+    try:
+        with PLACEMENT.place() as storage_api:
+            resp = http.post(f"{storage_api}/upload/archive", params=params,
+                             data=request.stream,
+                             headers={"Content-Type": request.content_type or "application/x-tar"})
+        try:
+            return resp.json(), resp.status_code, seq_of(resp)
+        except Exception:
+            return jsonify({"error": "Non-JSON response from storage", "raw": resp.text}), 502
+    finally:
+        try:
+            http.delete(f"{METADATA_API}/users/{request.username}/reservations/{reservation}")
+        except Exception:
+            pass  # it expires on its own
+
 # list files endpoint
 @app.route("/files", methods=["GET"])
 @require_auth
 def list_files():
     # forward request to metadata service via GET
-    resp = requests.get(f"{METADATA_API}/files")
+    resp = http.get(f"{METADATA_READ_API}/files", headers=read_headers())
 
     # check response from metadata service
     if resp.status_code == 200:
-        return resp.json(), resp.status_code
+        # the cursor to follow /changes from, so clients need not re-list to sync
+        return resp.json(), resp.status_code, {"X-Change-Cursor": resp.headers.get("X-Change-Cursor", "")}
     else:
         return jsonify({"error": "Metadata error - " + resp.text}), 500
 
+# storage used by the caller, with their quota
+@app.route("/usage", methods=["GET"])
+@require_auth
+def get_usage():
+    resp = http.get(f"{METADATA_API}/users/{request.username}/usage")  # the trash is only on the leader
+    if resp.status_code == 200:
+        return resp.json(), 200
+    return jsonify({"error": "Metadata error - " + resp.text}), 500
+
+# search the caller's files by name prefix, size, modification time and MIME type
+@app.route("/files/query", methods=["GET"])
+@require_auth
+def query_files():
+    # forward the filters to the metadata service, which answers from its indexes;
+    # only the caller's own files are searched, whatever owner= says
+    params = {**request.args.to_dict(), "owner": request.username}
+    resp = http.get(f"{METADATA_READ_API}/catalog/query", params=params, headers=read_headers())
+    try:
+        return resp.json(), resp.status_code
+    except Exception:
+        return jsonify({"error": "Metadata error - " + resp.text}), 500
+
+# changes to files since a cursor; long-polls until there are some or the timeout passes
+@app.route("/changes", methods=["GET"])
+@require_auth
+def list_changes():
+    resp = http.get(f"{METADATA_READ_API}/changes", params=request.args, headers=read_headers())
+    try:
+        # 410 carries the current cursor to resync from
+        return resp.json(), resp.status_code
+    except Exception:
+        return jsonify({"error": "Metadata error - " + resp.text}), 500
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5003)
\ No newline at end of file
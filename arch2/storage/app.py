@@ -1,20 +1,266 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, Response, request, jsonify, redirect, send_file
+import io
 import os
-import requests
+import shutil
+import time
+from urllib.parse import quote
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+import archive
+import crypto
+import hold
+import ingest
+import layout
+import metadata_client
+import metrics
+import node
+import profiling
+import reclaimer
+import scrubber
+import segments
+import tiering
+import tracing
+
+STORAGE_PATH = os.environ.get("STORAGE_PATH", "/storage")
+CATALOG_API = "http://metadata:5005/catalog"  # routes over many records: batch, by-object, query
+# record lookups for downloads; may be a metadata follower (see metadata/replica.py)
+METADATA_READ_API = os.environ.get("METADATA_READ_API", "http://metadata:5005") + "/files"
+NODES_API = "http://metadata:5005/nodes"  # storage node registry (see node.py)
+TRASH_API = "http://metadata:5005/trash"  # deleted files awaiting reclaim (see reclaimer.py)
+SCAN_INTERVAL = float(os.environ.get("STORAGE_SCAN_INTERVAL", "30"))  # seconds between file count rescans
+SMALL_OBJECT_MAX = int(os.environ.get("SMALL_OBJECT_MAX", str(64 * 1024)))  # uploads up to this size are packed into segments; 0 disables
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")  # empty disables backup holds
+
+os.makedirs(STORAGE_PATH, exist_ok=True)
+
+# small objects share large segment files; the store is owned by this (single) process
+SEGMENTS = segments.SegmentStore(STORAGE_PATH, fsync=ingest.FSYNC != "none") if SMALL_OBJECT_MAX else None
+
+# every upload becomes a new object in the hashed fan-out tree (see layout.py),
+# unless it turns out to be small enough for the segment store; with a master
+# key configured it is encrypted on the way in (see crypto.py)
+def new_object_writer(filename, content_type):
+    object_id = layout.new_object_id()
+    writer = ingest.IngestWriter(layout.object_path(STORAGE_PATH, object_id, create=True), filename, content_type,
+                                 memory_limit=SMALL_OBJECT_MAX, encrypt=crypto.ENABLED)
+    writer.object_id = object_id
+    return writer
+
+# multipart file parts are written straight into their object path as they are parsed
+class IngestRequest(Request):
+    form_data_parser_class = ingest.FormDataParser
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return new_object_writer(filename, content_type)
 
 app = Flask(__name__)
+app.request_class = IngestRequest
+metrics.instrument(app)
+tracing.instrument(app)
+profiling.instrument(app)
+node.instrument(app)
 
-STORAGE_PATH = "/storage"
-METADATA_API = "http://metadata:5005/files"
+# shared session: keep-alive to metadata, request ID forwarded, upstream latency recorded
+http = metrics.instrument_session(tracing.TracedSession())
 
-os.makedirs(STORAGE_PATH, exist_ok=True)
+# removals wait while a backup copies the volume (see hold.py)
+HOLD = hold.RemovalHold(lambda record: _remove_local(record))
+
+# objects nobody reads move to a compressed cold tier and back (see tiering.py)
+TIERS = tiering.Tiers(STORAGE_PATH, os.environ.get("TIER_COLD_PATH") or None, fsync=ingest.FSYNC != "none",
+                      busy=lambda: metrics.in_flight() > scrubber.MAX_IN_FLIGHT, paused=HOLD.active)
+
+# background check of stored bytes against metadata (see scrubber.py)
+SCRUBBER = scrubber.Scrubber(STORAGE_PATH, SEGMENTS, http, CATALOG_API,
+                             busy=lambda: metrics.in_flight() > scrubber.MAX_IN_FLIGHT, held=HOLD.active, tiers=TIERS)
+
+# frees the bytes of deleted files once they can no longer be restored
+RECLAIMER = reclaimer.Reclaimer(http, TRASH_API, lambda record: remove_object(record),
+                                busy=lambda: metrics.in_flight() > scrubber.MAX_IN_FLIGHT)
+
+# load reports to the node registry, which the gateways place uploads from
+HEARTBEAT = node.Heartbeat(STORAGE_PATH, http, NODES_API)
+
+def start_background():
+    # compaction, scrubbing and reclaiming write to the volume, so only the serving process runs them
+    HEARTBEAT.start()
+    RECLAIMER.start()
+    HOLD.start()
+    TIERS.start()
+    if SEGMENTS:
+        SEGMENTS.start_compactor(paused=HOLD.active)
+    if scrubber.ENABLED:
+        SCRUBBER.start()
+
+# URL of the storage node that holds a record's object, or None if it is this one
+def owner_url(record):
+    if node.is_local(record):
+        return None
+    url = HEARTBEAT.peer_url(record["node"])
+    if url is None:
+        raise LookupError(f"unknown storage node {record['node']}")
+    return None if url == node.NODE_URL else url
+
+# remove the bytes behind a metadata record, wherever they are stored;
+# objects on another storage node are removed by that node, and local ones
+# wait while a backup hold is active
+def remove_object(record):
+    url = owner_url(record)
+    if url is not None:
+        with tracing.span("peer.delete", node=record["node"], object_id=record.get("object_id")):
+            r = http.delete(f"{url}/objects/{record['object_id']}", params={"store": record.get("store", "file")})
+            if r.status_code not in (200, 404):
+                r.raise_for_status()
+        return
+    if not HOLD.defer(record):
+        _remove_local(record)
+
+def _remove_local(record):
+    if record.get("store") == "segment":
+        with tracing.span("segment.delete", object_id=record.get("object_id")):
+            if SEGMENTS:
+                SEGMENTS.delete(record["object_id"])
+        return
+    path = record.get("path")
+    with tracing.span("disk.remove", path=path):
+        if record.get("object_id"):
+            TIERS.remove(record["object_id"], path)
+        elif path and os.path.exists(path):
+            os.remove(path)
+
+# ---------------- Disk metrics ----------------
+_scan_cache = {"at": 0.0, "files": 0, "bytes": 0}
+
+def _scan_storage():
+    # walking a large volume is expensive, so reuse the result for SCAN_INTERVAL
+    now = time.monotonic()
+    if now - _scan_cache["at"] >= SCAN_INTERVAL:
+        files = used = 0
+        for root, dirs, names in os.walk(STORAGE_PATH):
+            if root == STORAGE_PATH and segments.SEGMENT_DIR in dirs:
+                dirs.remove(segments.SEGMENT_DIR)  # counted from the segment index below
+            for name in names:
+                try:
+                    used += os.path.getsize(os.path.join(root, name))
+                    files += 1
+                except OSError:
+                    pass  # removed while walking
+        if SEGMENTS:
+            stats = SEGMENTS.stats()
+            files += stats["objects"]
+            used += stats["live_bytes"]
+        _scan_cache.update(at=now, files=files, bytes=used)
+    return _scan_cache
+
+def _disk_usage():
+    usage = shutil.disk_usage(STORAGE_PATH)
+    return [(("total",), usage.total), (("used",), usage.used), (("free",), usage.free)]
+
+metrics.gauge("storage_disk_bytes", "Storage volume capacity", ["kind"], fn=_disk_usage)
+metrics.gauge("storage_files", "Number of stored files", fn=lambda: [((), _scan_storage()["files"])])
+metrics.gauge("storage_file_bytes", "Total size of stored files", fn=lambda: [((), _scan_storage()["bytes"])])
+
+def _segment_stats():
+    if not SEGMENTS:
+        return []
+    stats = SEGMENTS.stats()
+    return [(("segments",), stats["segments"]), (("objects",), stats["objects"]),
+            (("bytes",), stats["bytes"]), (("live_bytes",), stats["live_bytes"])]
+
+metrics.gauge("storage_segment_store", "Small-object segment store size", ["kind"], fn=_segment_stats)
+
+# Put an ingested upload in its place and build its metadata record. Small
+# bodies never left memory: they are appended to a segment (or, with a
+# segment_batch list, left there for the caller to append with others).
+# Others move into place.
+def store_upload(filename, writer, owner, segment_batch=None):
+    if writer.in_memory:
+        store, save_path = "segment", None
+        data = writer.getvalue()
+        if crypto.ENABLED:
+            data = crypto.seal(data)
+        if segment_batch is not None:
+            segment_batch.append((writer.object_id, data))
+        else:
+            with tracing.span("segment.put", object_id=writer.object_id):
+                SEGMENTS.put(writer.object_id, data)
+        saved = writer.summary()
+    else:
+        store, save_path = "file", writer.path
+        with tracing.span("disk.commit", path=save_path):
+            saved = writer.commit()
+
+    return {
+        "filename": filename,
+        "object_id": writer.object_id,
+        "store": store,
+        "path": save_path,
+        "size": saved["size"],
+        "version": 1,
+        "sha256": saved["sha256"],
+        "crc32": saved["crc32"],
+        "mime": saved["mime"],
+        "user": owner,
+        "encrypted": crypto.ENABLED,
+        "node": node.NODE_ID,
+        # "user": username,
+        # "password": password
+    }
+
+# Send the records of stored objects to metadata in one batch. Objects whose
+# record was not saved are removed, and so are the objects that saved records
+# replaced. Returns (applied, one result per record, metadata log position);
+# if metadata cannot be reached, every object is removed and the error raised.
+def register(records, atomic=False):
+    try:
+        applied, results, seq = metadata_client.batch(http, CATALOG_API, metadata_client.put_ops(records), atomic)
+    except Exception:
+        for record in records:
+            remove_object(record)
+        raise
+
+    saved_files = []
+    for record, result in zip(records, results):
+        if not applied or result["status"] != 201:
+            remove_object(record)
+            error = result.get("error") or "Batch rolled back"
+            saved_files.append({"filename": record["filename"], "status": "failed", "error": error,
+                                "code": result["status"] if applied else 409})
+            continue
+        # An overwrite leaves the previous object unreferenced
+        replaced = result.get("replaced")
+        if replaced and replaced.get("object_id") != record["object_id"]:
+            remove_object(replaced)
+        saved_files.append({"filename": record["filename"], "path": record["path"],
+                            "object_id": record["object_id"], "status": "saved"})
+    return applied, saved_files, seq
 
 # ---------------- Upload ----------------
+# Accepts either a multipart form with one or more "file" parts, or a raw body
+# with ?filename=. Both are read once and written to a temp file next to the
+# target; all the metadata records go to metadata in one batch. ?user= is the
+# owner the gateway authenticated, and is what usage is charged to.
 @app.route("/upload", methods=["POST"])
 def upload_file():
-    if "file" not in request.files:
-        return jsonify({"error": "No file part"}), 400
-    f = request.files["file"]
+    owner = request.args.get("user")
+    if request.mimetype == "multipart/form-data":
+        with tracing.span("disk.ingest"):
+            files = request.files
+        if "file" not in files:
+            return jsonify({"error": "No file part"}), 400
+        uploads = [(f.filename, f.stream) for f in files.getlist("file")]
+    else:
+        filename = request.args.get("filename")
+        if not filename:
+            return jsonify({"error": "No filename provided"}), 400
+        writer = new_object_writer(filename, request.mimetype)
+        try:
+            with tracing.span("disk.ingest"):
+                ingest.copy_stream(request.stream, writer)
+        except Exception as e:
+            writer.abort()
+            return jsonify({"error": f"Failed to receive file: {e}"}), 500
+        uploads = [(filename, writer)]
+    node.body_received()
 
     # Get username/password
     # username = request.form.get("user") or request.values.get("user")
@@ -22,41 +268,103 @@ def upload_file():
     # if not username or not password:
     #     return jsonify({"error": "Username and password are required"}), 400
 
-    print("request.form:", request.form)
-    print("request.files:", request.files)
-    print("request.values:", request.values)
-
-    # Save file
-    save_path = os.path.join(STORAGE_PATH, f.filename)
+    records = []
     try:
-        f.save(save_path)
+        for filename, writer in uploads:
+            records.append(store_upload(filename, writer, owner))
     except Exception as e:
+        for _, writer in uploads:
+            writer.abort()
+        for record in records:
+            remove_object(record)
         return jsonify({"error": f"Failed to save file: {e}"}), 500
 
-    # Build metadata
-    size = os.path.getsize(save_path)
-    metadata = {
-        "filename": f.filename,
-        "path": save_path,
-        "size": size,
-        "version": 1,
-        # "user": username,
-        # "password": password
-    }
-
-    # Send metadata to metadata container
     try:
-        r = requests.post(METADATA_API, json=metadata)
-        r.raise_for_status()
+        _, saved_files, seq = register(records)
     except Exception as e:
         return jsonify({"error": f"Failed to save metadata: {e}"}), 500
 
-    return jsonify({"path": save_path, "status": "saved"}), 200
+    if len(saved_files) == 1:
+        saved = saved_files[0]
+        if saved["status"] != "saved":
+            if saved["code"] == 403:  # the name is taken by another user's file
+                return jsonify({"error": saved["error"]}), 403
+            return jsonify({"error": f"Failed to save metadata: {saved['error']}"}), 500
+        body = {"path": saved["path"], "object_id": saved["object_id"], "status": "saved"}
+    else:
+        body = {"files": saved_files}
+    # passed back on reads, so they see this upload even on a metadata follower
+    return jsonify(body), 200, {metadata_client.SEQ_HEADER: seq or ""}
+
+# ---------------- Archive Upload ----------------
+# The body is a tar stream of a whole tree, optionally compressed, with
+# ?prefix= put in front of every member's path (see archive.py). Members are
+# stored as they are read, so the tree is never held whole: small ones are
+# appended to segments in groups of ARCHIVE_SEGMENT_BATCH bytes with one
+# fsync. All records then go to metadata in one atomic batch, so the tree
+# appears at once or, if any record fails, not at all.
+ARCHIVE_SEGMENT_BATCH = int(os.environ.get("ARCHIVE_SEGMENT_BATCH", str(4 * 1024 * 1024)))
+
+@app.route("/upload/archive", methods=["POST"])
+def upload_archive():
+    owner = request.args.get("user")
+    # the owner's quota headroom, from the gateway's admission
+    max_bytes = request.args.get("max_bytes", type=int)
+    max_files = request.args.get("max_files", type=int)
+    records = []
+    pending, pending_bytes = [], 0  # small members not yet appended to a segment
+
+    def flush_segments():
+        nonlocal pending_bytes
+        if pending:
+            with tracing.span("segment.put_many", objects=len(pending)):
+                SEGMENTS.put_many(pending)
+            pending.clear()
+            pending_bytes = 0
+
+    try:
+        with tracing.span("archive.ingest"):
+            for filename, member in archive.entries(request.stream, request.args.get("prefix", ""),
+                                                    max_bytes=max_bytes, max_files=max_files):
+                writer = new_object_writer(filename, None)
+                try:
+                    ingest.copy_stream(member, writer)
+                    record = store_upload(filename, writer, owner, pending)
+                except Exception:
+                    writer.abort()
+                    raise
+                records.append(record)
+                if record["store"] == "segment":
+                    pending_bytes += record["size"]
+                    if pending_bytes >= ARCHIVE_SEGMENT_BATCH:
+                        flush_segments()
+            flush_segments()
+    except Exception as e:
+        for record in records:
+            remove_object(record)
+        if isinstance(e, archive.QuotaExceeded):
+            return jsonify({"error": str(e)}), 413
+        if isinstance(e, archive.ArchiveError):
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"error": f"Failed to save file: {e}"}), 500
+    if not records:
+        return jsonify({"error": "No files in archive"}), 400
+
+    try:
+        applied, saved_files, seq = register(records, atomic=True)
+    except Exception as e:
+        return jsonify({"error": f"Failed to save metadata: {e}"}), 500
+    if not applied:
+        failed = [f for f in saved_files if f["error"] != "Batch rolled back"]
+        return jsonify({"error": "Failed to save metadata; nothing was stored", "files": failed}), 409
+    body = {"status": "saved", "files": len(records), "bytes": sum(r["size"] for r in records)}
+    return jsonify(body), 200, {metadata_client.SEQ_HEADER: seq or ""}
 
 # ---------------- Download ----------------
 @app.route("/download", methods=["GET"])
 def download_file():
     filename = request.args.get("filename")
+    owner = request.args.get("user")  # the gateway's caller; someone else's file is not found
     # username = request.args.get("user")
     # password = request.args.get("password")
 
@@ -65,64 +373,233 @@ def download_file():
 
     # Fetch metadata
     try:
-        r = requests.get(f"{METADATA_API}/{filename}")
+        seq = request.headers.get(metadata_client.SEQ_HEADER)
+        r = http.get(f"{METADATA_READ_API}/{quote(filename)}",
+                     headers={metadata_client.SEQ_HEADER: seq} if seq else None)
         r.raise_for_status()
         metadata = r.json()
     except Exception as e:
         return jsonify({"error": f"Failed to fetch metadata: {e}"}), 404
+    if owner is not None and metadata.get("user") != owner:
+        return jsonify({"error": "File not found"}), 404
 
     # Validate username/password
     # if username.strip() != metadata["user"].strip() or password.strip() != metadata["password"].strip():
     #     return jsonify({"error": "Invalid username or password"}), 403
 
+    # Objects stay on the node that received the upload; send the client there
+    try:
+        url = owner_url(metadata)
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 503
+    if url is not None:
+        return redirect(f"{url}/download?{request.query_string.decode()}", code=307)
+
     # Check if file exists
+    if metadata.get("store") == "segment":
+        with tracing.span("segment.get", object_id=metadata["object_id"]):
+            data = SEGMENTS.get(metadata["object_id"]) if SEGMENTS else None
+        if data is None:
+            return jsonify({"error": "File not found"}), 404
+        if metadata.get("encrypted"):
+            try:
+                data = crypto.unseal(data)
+            except crypto.DecryptionError as e:
+                return jsonify({"error": f"Failed to decrypt file: {e}"}), 500
+        return send_file(io.BytesIO(data), as_attachment=True, download_name=filename, mimetype=metadata.get("mime"))
+
     file_path = metadata["path"]
-    if not os.path.exists(file_path):
-        return jsonify({"error": "File not found"}), 404
+    object_id = metadata.get("object_id")
+    encrypted = metadata.get("encrypted")
+    start = time.perf_counter()
+    with tracing.span("disk.open", path=file_path):
+        # opened once, from whichever tier has it: a move in between cannot take it away
+        opened = TIERS.open(object_id, file_path, buffering=0 if encrypted else -1)
+        if opened is None:
+            return jsonify({"error": "File not found"}), 404
+        f, tier, compressed = opened
+        if tier == "hot":
+            if object_id:
+                TIERS.access(object_id)
+        else:
+            TIERS.read_cold(object_id, file_path)
+        if compressed and encrypted:
+            # sealed chunks are decrypted by offset, which a gzip stream cannot seek to
+            with tracing.span("tier.decompress", object_id=object_id):
+                f = TIERS.decompressed_copy(f)
+        if compressed and not encrypted:
+            resp = send_compressed(f, filename, metadata.get("mime"), metadata["size"])
+        elif encrypted:
+            resp = send_encrypted(f, filename, metadata.get("mime"))
+        else:
+            resp = send_opened(f, filename, metadata.get("mime"))
+        return _timed_read(resp, tier, start)
+
+# record how long a download's disk part took, until its last byte was sent, by tier
+def _timed_read(resp, tier, start):
+    if isinstance(resp, Response) and resp.status_code < 300:
+        sent = resp.content_length or 0
+        def done():
+            tiering.TIER_READ_SECONDS.observe(time.perf_counter() - start, tier=tier)
+            tiering.TIER_READS.inc(sent, tier=tier)
+        resp.call_on_close(done)
+    return resp
 
-    return send_file(file_path, as_attachment=True)
+# Stream an object file as it is, with Range and conditional requests answered as send_file does for a path
+def send_opened(f, filename, mimetype):
+    st = os.fstat(f.fileno())
+    resp = send_file(f, as_attachment=True, download_name=filename, mimetype=mimetype, conditional=False,
+                     last_modified=st.st_mtime, etag=f"{st.st_mtime}-{st.st_size}-{st.st_ino}")
+    resp.content_length = st.st_size
+    try:
+        return resp.make_conditional(request, accept_ranges=True, complete_length=st.st_size)
+    except RequestedRangeNotSatisfiable:
+        f.close()
+        return jsonify({"error": "Requested range not satisfiable"}), 416, {"Content-Range": f"bytes */{st.st_size}"}
+
+# Stream a compressed cold object, decompressing only as far as a Range request reaches
+def send_compressed(f, filename, mimetype, size):
+    start, stop, status = 0, size, 200
+    if request.range:
+        span = request.range.range_for_length(size)
+        if span is None:
+            f.close()
+            return jsonify({"error": "Requested range not satisfiable"}), 416, {"Content-Range": f"bytes */{size}"}
+        (start, stop), status = span, 206
+    resp = Response(tiering.read_compressed(f, start, stop), status, mimetype=mimetype, direct_passthrough=True)
+    resp.call_on_close(f.close)
+    resp.content_length = stop - start
+    resp.headers["Accept-Ranges"] = "bytes"
+    resp.headers.set("Content-Disposition", "attachment", filename=filename)
+    if status == 206:
+        resp.headers["Content-Range"] = request.range.to_content_range_header(size)
+    return resp
+
+# Stream an encrypted object, decrypting only the chunks a Range request covers
+def send_encrypted(f, filename, mimetype):
+    try:
+        size = crypto.plaintext_size(f)
+    except crypto.DecryptionError as e:
+        f.close()
+        return jsonify({"error": f"Failed to decrypt file: {e}"}), 500
+    start, stop, status = 0, size, 200
+    if request.range:
+        span = request.range.range_for_length(size)
+        if span is None:
+            f.close()
+            return jsonify({"error": "Requested range not satisfiable"}), 416, {"Content-Range": f"bytes */{size}"}
+        (start, stop), status = span, 206
+    resp = Response(crypto.read_range(f, start, stop), status, mimetype=mimetype, direct_passthrough=True)
+    resp.call_on_close(f.close)
+    resp.content_length = stop - start
+    resp.headers["Accept-Ranges"] = "bytes"
+    resp.headers.set("Content-Disposition", "attachment", filename=filename)
+    if status == 206:
+        resp.headers["Content-Range"] = request.range.to_content_range_header(size)
+    return resp
 
 # ---------------- Delete ----------------
+# ?filename= may be repeated to delete several files with one metadata batch.
 @app.route("/delete", methods=["DELETE"])
 def delete_file():
-    filename = request.args.get("filename")
+    filenames = request.args.getlist("filename")
+    owner = request.args.get("user")  # the gateway's caller; only their files are deleted
     # username = request.args.get("user")
     # password = request.args.get("password")
 
     # if not filename or not username or not password:
     #     return jsonify({"error": "Filename, username, and password required"}), 400
 
-    # Fetch metadata
+    if not filenames:
+        return jsonify({"error": "No filename provided"}), 400
+
+    # Only the metadata records change here: they move to the trash, and the
+    # bytes stay until the reclaimer frees them after the restore window
     try:
-        r = requests.get(f"{METADATA_API}/{filename}")
-        r.raise_for_status()
-        metadata = r.json()
+        _, results, seq = metadata_client.batch(http, CATALOG_API, metadata_client.delete_ops(filenames, trash=True, if_user=owner))
     except Exception as e:
-        return jsonify({"error": f"Failed to fetch metadata: {e}"}), 404
+        return jsonify({"error": f"Failed to delete metadata: {e}"}), 500
 
     # # Validate username/password
     # if username.strip() != metadata["user"].strip() or password.strip() != metadata["password"].strip():
     #     return jsonify({"error": "Invalid username or password"}), 403
 
-    # Delete file
-    try:
-        file_path = metadata["path"]
-        if os.path.exists(file_path):
-            os.remove(file_path)
-    except Exception as e:
-        return jsonify({"error": f"Failed to delete file: {e}"}), 500
+    deleted = []
+    for filename, result in zip(filenames, results):
+        if result["status"] != 200:
+            deleted.append({"filename": filename, "status": "failed", "error": result.get("error")})
+            continue
+        deleted.append({"filename": filename, "status": "deleted", "trash_id": result["trash_id"]})
 
-    # Delete metadata
-    try:
-        r = requests.delete(f"{METADATA_API}/{filename}")
-        r.raise_for_status()
-    except Exception as e:
-        return jsonify({"error": f"Failed to delete metadata: {e}"}), 500
+    if len(filenames) == 1:
+        if deleted[0]["status"] != "deleted":
+            code = 404 if results[0]["status"] == 404 else 500
+            return jsonify({"error": deleted[0]["error"]}), code
+        body = {"status": "deleted", "trash_id": deleted[0]["trash_id"]}
+    else:
+        body = {"files": deleted}
+    return jsonify(body), 200, {metadata_client.SEQ_HEADER: seq or ""}
 
+# Removes one of this node's objects for a peer that handled the delete
+@app.route("/objects/<object_id>", methods=["DELETE"])
+def delete_object(object_id):
+    if not all(c in "0123456789abcdef" for c in object_id):
+        return jsonify({"error": "Invalid object ID"}), 400
+    store = request.args.get("store", "file")
+    if store == "segment":
+        path = None
+        found = SEGMENTS is not None and object_id in SEGMENTS
+    else:
+        path = layout.object_path(STORAGE_PATH, object_id)
+        found = os.path.exists(path) or TIERS.locate(object_id) is not None
+    if not found:
+        return jsonify({"error": "Object not found"}), 404
+    remove_object({"object_id": object_id, "store": store, "path": path})
     return jsonify({"status": "deleted"}), 200
 
+# ---------------- Backup Holds ----------------
+# The backup holds removals on every registered node before it snapshots
+# metadata and releases them once the volume is copied (see hold.py). JSON
+# {"ttl": seconds} is optional. Taking and releasing a hold need
+# X-Admin-Token: a hold stops removals.
+@app.route("/backup/hold", methods=["POST"])
+def acquire_hold():
+    if not ADMIN_TOKEN or request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        return jsonify({"error": "Forbidden"}), 403
+    body = request.get_json(silent=True)
+    if body is None:
+        body = {}
+    if not isinstance(body, dict):
+        return jsonify({"error": "Body must be a JSON object"}), 400
+    ttl = body.get("ttl", hold.TTL)
+    try:
+        ttl = float(ttl)
+    except (TypeError, ValueError):
+        return jsonify({"error": "ttl must be a number of seconds"}), 400
+    return jsonify({"hold_id": HOLD.acquire(ttl), "node": node.NODE_ID}), 201
+
+@app.route("/backup/hold/<hold_id>", methods=["DELETE"])
+def release_hold(hold_id):
+    if not ADMIN_TOKEN or request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        return jsonify({"error": "Forbidden"}), 403
+    if not HOLD.release(hold_id):
+        return jsonify({"error": "Hold not found or expired"}), 404
+    return jsonify({"status": "released"}), 200
+
+@app.route("/backup/hold", methods=["GET"])
+def hold_status():
+    return jsonify(HOLD.status()), 200
+
+# ---------------- Scrubber ----------------
+@app.route("/scrub/status", methods=["GET"])
+def scrub_status():
+    return jsonify(SCRUBBER.status()), 200
+
 # ---------------- Main ----------------
 if __name__ == "__main__":
     import sys
     sys.stdout.reconfigure(line_buffering=True)  # ensure prints appear immediately
+    # debug mode re-runs this file in a reloader child; only that child serves requests
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background()
     app.run(host="0.0.0.0", port=5006, debug=True)
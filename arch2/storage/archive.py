@@ -0,0 +1,74 @@
+"""Unpacking an uploaded tar archive while it is still arriving.
+
+``POST /upload/archive`` takes a whole tree as one tar stream, plain or
+compressed with gzip, bzip2 or xz (detected from the stream). ``entries``
+reads it strictly forwards, one member at a time, so each file goes into
+storage as soon as its bytes have arrived and nothing is buffered beyond
+the current member.
+
+Only regular files are stored. Directories, links and devices are
+skipped, as are names that would leave the upload's prefix (absolute
+paths, ``..``). The file name recorded is the member's path, with the
+request's ``prefix`` in front.
+
+An upload can be limited to ``max_bytes`` of member data and ``max_files``
+members (the owner's quota headroom). Member sizes are in the tar headers,
+so a member that would go over is refused before its bytes are read.
+"""
+import os
+import posixpath
+import tarfile
+
+import metrics
+
+MAX_ENTRIES = int(os.environ.get("ARCHIVE_MAX_ENTRIES", "100000"))  # files per archive upload
+
+ENTRIES = metrics.counter("storage_archive_entries_total", "Tar members read from archive uploads", ["result"])
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class QuotaExceeded(ArchiveError):
+    pass
+
+
+def safe_name(name, prefix=""):
+    """The filename to record for member ``name``, or None if it would escape the prefix."""
+    name = posixpath.normpath(name.replace("\\", "/"))
+    if name.startswith("/") or name in (".", "..") or name.startswith("../"):
+        return None
+    return prefix + name
+
+
+def entries(stream, prefix="", max_bytes=None, max_files=None):
+    """Yield ``(filename, member)`` for every regular file in the tar ``stream``, in order.
+
+    ``member`` is a file-like object for the member's bytes; it is only valid
+    until the next entry is requested. Raises QuotaExceeded once the members
+    would add up to more than ``max_bytes`` or ``max_files`` (None = no limit).
+    """
+    try:
+        tar = tarfile.open(fileobj=stream, mode="r|*")
+    except tarfile.TarError as e:
+        raise ArchiveError(f"not a tar archive: {e}") from None
+    count = total = 0
+    with tar:
+        try:
+            for info in tar:
+                name = safe_name(info.name, prefix) if info.isfile() else None
+                if name is None:
+                    ENTRIES.inc(result="skipped")
+                    continue
+                count += 1
+                if count > MAX_ENTRIES:
+                    raise ArchiveError(f"more than {MAX_ENTRIES} files in one archive")
+                total += info.size
+                if (max_files is not None and count > max_files) or (max_bytes is not None and total > max_bytes):
+                    ENTRIES.inc(result="over_quota")
+                    raise QuotaExceeded("Quota exceeded")
+                ENTRIES.inc(result="stored")
+                yield name, tar.extractfile(info)
+        except (tarfile.TarError, EOFError, OSError) as e:
+            raise ArchiveError(f"broken archive: {e}") from None
@@ -0,0 +1,215 @@
+"""Single-pass streaming ingest for the storage service.
+
+Bytes are read from the request once, in ``INGEST_BUFFER_SIZE`` chunks, and
+written to a temp file in the target directory. Size, SHA-256, CRC-32 (for
+zip downloads) and the MIME type are computed in the same pass; the temp file is then fsynced (per
+``INGEST_FSYNC``) and atomically renamed over the final path, so readers and
+concurrent uploads of the same name never see a partial file.
+
+With a ``memory_limit`` the writer keeps small bodies in memory and only
+creates the temp file once the limit is crossed, so objects headed for the
+segment store never touch the filesystem on their own.
+
+With ``encrypt`` the temp file receives the object's encrypted form (see
+crypto.py) while size, hash and type still describe the plaintext.
+"""
+import hashlib
+import io
+import mimetypes
+import os
+import tempfile
+import zlib
+
+from werkzeug import formparser
+
+import crypto
+
+BUFFER_SIZE = int(os.environ.get("INGEST_BUFFER_SIZE", str(1024 * 1024)))
+# none: leave it to the page cache, file: fsync the file, full: fsync the file and its directory
+FSYNC = os.environ.get("INGEST_FSYNC", "file")
+SNIFF_BYTES = 64
+# werkzeug's multipart decoder rescans its whole buffer for the boundary on
+# every event, so feeding it more than this per read makes parsing slower
+MULTIPART_READ_SIZE = min(BUFFER_SIZE, 256 * 1024)
+
+# leading bytes of common formats, checked in order
+_MAGIC = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF-", "application/pdf"),
+    (b"PK\x03\x04", "application/zip"),
+    (b"\x1f\x8b", "application/gzip"),
+    (b"BZh", "application/x-bzip2"),
+    (b"\xfd7zXZ\x00", "application/x-xz"),
+    (b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+    (b"\x28\xb5\x2f\xfd", "application/zstd"),
+    (b"ID3", "audio/mpeg"),
+    (b"OggS", "audio/ogg"),
+    (b"fLaC", "audio/flac"),
+]
+
+
+def sniff_mime(head, filename=None, declared=None):
+    """Best guess at a MIME type from the first bytes, the filename, then the client's claim."""
+    sniffed = None
+    for magic, mime in _MAGIC:
+        if head.startswith(magic):
+            sniffed = mime
+            break
+    if sniffed is None and head[:4] == b"RIFF" and head[8:12] in (b"WEBP", b"WAVE"):
+        sniffed = "image/webp" if head[8:12] == b"WEBP" else "audio/wav"
+    if sniffed is None and head[4:8] == b"ftyp":
+        sniffed = "video/mp4"
+
+    guessed = mimetypes.guess_type(filename)[0] if filename else None
+    # docx, jar, epub... are zip containers; the extension is more specific
+    if sniffed == "application/zip" and guessed:
+        return guessed
+    if sniffed:
+        return sniffed
+    if guessed:
+        return guessed
+    if declared and declared != "application/octet-stream":
+        return declared
+    return "application/octet-stream"
+
+
+class IngestWriter:
+    """File-like sink that spools next to ``path`` and hashes while writing."""
+
+    def __init__(self, path, filename=None, declared_mime=None, memory_limit=0, encrypt=False):
+        self.path = path
+        self.tmp_path = None
+        self._file = None
+        self._out = None  # _file, or the encrypting writer in front of it
+        self.encrypt = encrypt
+        self._memory = io.BytesIO() if memory_limit else None
+        self._memory_limit = memory_limit
+        self._sha256 = hashlib.sha256()
+        self._crc32 = 0
+        self._head = b""
+        self.size = 0
+        self.filename = filename
+        self.declared_mime = declared_mime
+        self.committed = False
+        if not memory_limit:
+            self._spill()
+
+    @property
+    def in_memory(self):
+        return self._file is None
+
+    def _spill(self):
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".ingest-")
+        self._file = os.fdopen(fd, "w+b", buffering=BUFFER_SIZE)
+        self._out = crypto.EncryptingWriter(self._file) if self.encrypt else self._file
+        if self._memory is not None:
+            self._out.write(self._memory.getbuffer())
+            self._memory = None
+
+    def write(self, data):
+        if len(self._head) < SNIFF_BYTES:
+            self._head += bytes(data[:SNIFF_BYTES - len(self._head)])
+        self._sha256.update(data)
+        self._crc32 = zlib.crc32(data, self._crc32)
+        self.size += len(data)
+        if self._file is None and self.size > self._memory_limit:
+            self._spill()
+        return (self._out or self._memory).write(data)
+
+    # werkzeug rewinds the part and may read it back; keep that working
+    def seek(self, offset, whence=0):
+        if self._file is None:
+            return self._memory.seek(offset, whence)
+        self._file.flush()
+        return self._file.seek(offset, whence)
+
+    def read(self, size=-1):
+        return (self._file or self._memory).read(size)
+
+    def getvalue(self):
+        """The whole body, for writers that stayed in memory."""
+        return self._memory.getvalue()
+
+    def summary(self):
+        return {
+            "size": self.size,
+            "sha256": self._sha256.hexdigest(),
+            "crc32": self._crc32,
+            "mime": sniff_mime(self._head, self.filename, self.declared_mime),
+        }
+
+    def commit(self):
+        """fsync per policy and atomically move to ``path``. Returns size, sha256, crc32 and mime."""
+        if self._file is None:
+            self._spill()
+        if self.encrypt:
+            # werkzeug seeks parts back to 0 when they end; the last chunk goes at the end
+            self._file.seek(0, os.SEEK_END)
+            self._out.finish()
+        self._file.flush()
+        if FSYNC in ("file", "full"):
+            os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+        self.committed = True
+        if FSYNC == "full":
+            fsync_dir(os.path.dirname(self.path))
+        return self.summary()
+
+    def close(self):
+        # anything not committed is an aborted upload
+        if self.committed or self._file is None:
+            self._memory = None
+            return
+        self._file.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+    abort = close
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_stream(stream, writer):
+    """Read a raw request body into ``writer`` in BUFFER_SIZE chunks."""
+    read = stream.read
+    while True:
+        chunk = read(BUFFER_SIZE)
+        if not chunk:
+            break
+        writer.write(chunk)
+    return writer
+
+
+class FormDataParser(formparser.FormDataParser):
+    """Form parser that reads multipart bodies in MULTIPART_READ_SIZE chunks instead of 64 KiB."""
+
+    def _parse_multipart(self, stream, mimetype, content_length, options):
+        # the decoder applies the form memory limit to each chunk it is fed,
+        # so it has to allow at least one full read buffer
+        limit = self.max_form_memory_size
+        if limit is not None:
+            limit = max(limit, 2 * MULTIPART_READ_SIZE)
+        parser = formparser.MultiPartParser(
+            stream_factory=self.stream_factory,
+            max_form_memory_size=limit,
+            max_form_parts=self.max_form_parts,
+            cls=self.cls,
+            buffer_size=MULTIPART_READ_SIZE,
+        )
+        boundary = options.get("boundary", "").encode("ascii")
+        if not boundary:
+            raise ValueError("Missing boundary")
+        form, files = parser.parse(stream, boundary, content_length)
+        return stream, form, files
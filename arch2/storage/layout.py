@@ -0,0 +1,65 @@
+"""On-disk layout of stored objects.
+
+Every upload gets an internal object ID, and its bytes live at
+``<root>/objects/ab/cd/<object_id>`` where ``ab/cd`` come from a hash of the
+ID. With two levels of 256 directories, even 100 million objects leave only
+~1500 entries per leaf directory, and names never collide across users
+because the user's filename is only kept in metadata.
+"""
+import hashlib
+import os
+import uuid
+
+OBJECTS_DIR = "objects"
+FANOUT_LEVELS = int(os.environ.get("STORAGE_FANOUT_LEVELS", "2"))  # hex byte pairs per path
+
+_made_dirs = set()
+
+
+def new_object_id():
+    return uuid.uuid4().hex
+
+
+def object_dir(root, object_id):
+    digest = hashlib.md5(object_id.encode()).hexdigest()
+    parts = [digest[2 * i:2 * i + 2] for i in range(FANOUT_LEVELS)]
+    return os.path.join(root, OBJECTS_DIR, *parts)
+
+
+def object_path(root, object_id, create=False):
+    """Path of an object; with ``create`` its parent directory is made if needed."""
+    directory = object_dir(root, object_id)
+    if create and directory not in _made_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _made_dirs.add(directory)
+    return os.path.join(directory, object_id)
+
+
+def walk_objects(root, after=None):
+    """Yield (object_id, path) for every object in the fan-out tree, in a stable order.
+
+    With ``after`` (an object ID, or a file name such as the cold tier's
+    ``<object_id>.gz``) the walk resumes just past that file, so a long scan
+    can be continued from a saved cursor.
+    """
+    cursor = None
+    if after:
+        # the directory comes from the object ID; the file name may carry a suffix
+        directory = object_dir(root, after.partition(".")[0])
+        cursor = os.path.relpath(directory, os.path.join(root, OBJECTS_DIR)).split(os.sep) + [after]
+
+    def walk(directory, depth, cursor):
+        try:
+            names = sorted(os.listdir(directory))
+        except FileNotFoundError:
+            return
+        for name in names:
+            if depth < FANOUT_LEVELS:
+                if cursor and name < cursor[depth]:
+                    continue
+                rest = cursor if cursor and name == cursor[depth] else None
+                yield from walk(os.path.join(directory, name), depth + 1, rest)
+            elif not name.startswith(".") and not (cursor and name <= cursor[depth]):
+                yield name, os.path.join(directory, name)
+
+    yield from walk(os.path.join(root, OBJECTS_DIR), 0, cursor)
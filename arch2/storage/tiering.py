@@ -0,0 +1,387 @@
+"""Hot and cold tiers for objects in the fan-out tree.
+
+Every read of an object is noted: when it was last read and a read count
+that halves every ``TIER_HIT_HALF_LIFE_DAYS``. Every ``TIER_INTERVAL``
+seconds the tierer walks the hot tree and moves objects of at least
+``TIER_MIN_SIZE`` bytes that have not been read or written for
+``TIER_COLD_AFTER_DAYS`` to the cold tier, ``TIER_COLD_PATH`` (by default
+``cold/`` on the storage volume; it can be another, cheaper volume). Cold
+objects are gzip-compressed unless their first bytes show that compression
+would not pay (media, archives, encrypted objects), in which case they are
+moved as they are. Moves are capped at ``TIER_BYTES_PER_SEC``, wait while
+the service is busy, and stop while a backup hold is active.
+
+Metadata is not told: a record keeps its hot path, and a download that
+does not find the object there reads it from the cold tier, decompressing
+as it streams (Range requests included). A cold object read
+``TIER_PROMOTE_HITS`` times within about a half-life is moved back to the
+hot tier in the background; a one-off read does not move it.
+
+Read times and counts survive restarts in ``.tier-state.json`` on the
+storage volume, saved after every pass. Segment objects are small and
+never tiered.
+"""
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+import zlib
+
+import layout
+import metrics
+import scrubber
+
+ENABLED = os.environ.get("TIERING_ENABLED", "1") == "1"
+COLD_AFTER = float(os.environ.get("TIER_COLD_AFTER_DAYS", "30")) * 86400  # unread this long = cold
+MIN_SIZE = int(os.environ.get("TIER_MIN_SIZE", str(1024 * 1024)))  # smaller objects stay hot
+INTERVAL = float(os.environ.get("TIER_INTERVAL", "3600"))  # seconds between tiering passes
+PROMOTE_HITS = float(os.environ.get("TIER_PROMOTE_HITS", "2"))  # decayed reads that bring a cold object back
+HALF_LIFE = float(os.environ.get("TIER_HIT_HALF_LIFE_DAYS", "7")) * 86400
+BYTES_PER_SEC = float(os.environ.get("TIER_BYTES_PER_SEC", str(32 * 1024 * 1024)))  # 0 = unlimited
+LEVEL = int(os.environ.get("TIER_COMPRESS_LEVEL", "6"))
+STATE_FILE = ".tier-state.json"  # relative to the storage root
+COLD_DIR = "cold"
+CHUNK_SIZE = 256 * 1024
+MIN_SAVING = 0.9  # compress only if a sample shrinks below this fraction
+
+TIER_OBJECTS = metrics.gauge("storage_tier_objects", "Objects per tier, as of the last pass plus moves since", ["tier"])
+TIER_BYTES = metrics.gauge("storage_tier_bytes", "Bytes on disk per tier, as of the last pass plus moves since", ["tier"])
+TIER_MOVES = metrics.counter("storage_tier_moves_total", "Objects moved between tiers", ["direction", "result"])
+TIER_MOVED_BYTES = metrics.counter("storage_tier_moved_bytes_total", "Bytes moved between tiers, before and after compression",
+                                   ["direction", "kind"])
+TIER_READS = metrics.counter("storage_tier_read_bytes_total", "Bytes sent by downloads, per tier", ["tier"])
+TIER_READ_SECONDS = metrics.histogram("storage_tier_read_seconds", "Time to send a download from disk, per tier",
+                                      ["tier"], buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 120))
+
+
+class TierError(Exception):
+    pass
+
+
+def read_compressed(f, start=0, stop=None):
+    """Bytes ``start`` to ``stop`` of the gzip object open as ``f``, decompressed a chunk at a time."""
+    inflater = zlib.decompressobj(31)
+    pos = 0
+    while not inflater.eof and (stop is None or pos < stop):
+        data = inflater.unconsumed_tail or f.read(CHUNK_SIZE)
+        if not data:
+            raise TierError("cold object is truncated")
+        try:
+            data = inflater.decompress(data, CHUNK_SIZE)  # bounded output, whatever the ratio
+        except zlib.error as e:
+            raise TierError(f"cold object is not valid gzip: {e}") from e
+        end = pos + len(data)
+        if end > start:
+            yield data[max(start - pos, 0):len(data) if stop is None else stop - pos]
+        pos = end
+    if stop is not None and pos < stop:
+        raise TierError("cold object is shorter than its record")
+
+
+class Tiers:
+    def __init__(self, root, cold_root=None, fsync=True, busy=None, paused=None):
+        self.root = root
+        self.cold_root = cold_root or os.path.join(root, COLD_DIR)
+        self.fsync = fsync
+        self.busy = busy or (lambda: False)
+        self.paused = paused or (lambda: False)  # true while a backup hold is active
+        self.limiter = scrubber.RateLimiter(BYTES_PER_SEC)
+        self.state_path = os.path.join(root, STATE_FILE)
+        self.lock = threading.Lock()
+        self.reads = self._load_state()  # object_id -> [last read (unix time), decayed read count]
+        self.moving = {}  # object_id -> True once removed during the move
+        self.sizes = {"hot": [0, 0], "cold": [0, 0]}  # tier -> [objects, bytes]
+        self.promotions = queue.Queue()
+        for tier in self.sizes:
+            self._gauge(tier)
+
+    # ---------------- access tracking ----------------
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)["reads"]
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def _save_state(self):
+        cutoff = time.time() - COLD_AFTER
+        with self.lock:
+            # older reads no longer keep anything hot, and their counts have decayed away
+            self.reads = {oid: read for oid, read in self.reads.items() if read[0] >= cutoff}
+            state = {"reads": dict(self.reads)}
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+
+    def access(self, object_id):
+        """Note a read of ``object_id``; returns its decayed read count."""
+        now = time.time()
+        with self.lock:
+            read = self.reads.get(object_id)
+            hits = 1.0 if read is None else read[1] * 0.5 ** ((now - read[0]) / HALF_LIFE) + 1
+            self.reads[object_id] = [now, hits]
+        return hits
+
+    # ---------------- locating ----------------
+    def cold_paths(self, object_id):
+        """(compressed, as-is) paths an object can have in the cold tier."""
+        path = layout.object_path(self.cold_root, object_id)
+        return path + ".gz", path
+
+    def locate(self, object_id):
+        """(path, compressed) of a cold object, or None if it is not in the cold tier."""
+        compressed, plain = self.cold_paths(object_id)
+        if os.path.exists(compressed):
+            return compressed, True
+        if os.path.exists(plain):
+            return plain, False
+        return None
+
+    def open(self, object_id, hot_path, buffering=-1):
+        """(file, tier, compressed) for reading an object from whichever tier holds it, or None.
+
+        A move can take the object from a tier between looking and opening, so
+        the tiers are tried by opening them; an open file stays readable after
+        the move removes its path.
+        """
+        for _ in range(3):  # a move in each direction in between is already unlikely
+            candidates = [(hot_path, "hot", False)]
+            if object_id:
+                compressed, plain = self.cold_paths(object_id)
+                candidates += [(compressed, "cold", True), (plain, "cold", False)]
+            for path, tier, is_compressed in candidates:
+                try:
+                    return open(path, "rb", buffering=buffering), tier, is_compressed
+                except FileNotFoundError:
+                    pass
+        return None
+
+    @staticmethod
+    def chunks(f, compressed):
+        """The original bytes of a cold object open as ``f``, a chunk at a time."""
+        return read_compressed(f) if compressed else iter(lambda: f.read(CHUNK_SIZE), b"")
+
+    def decompressed_copy(self, f):
+        """The compressed cold object open as ``f``, decompressed into an unnamed temporary file.
+
+        For reads that need to seek, such as decrypting sealed chunks by
+        offset. ``f`` is closed; the copy is returned open at its start.
+        """
+        out = tempfile.TemporaryFile(dir=self.cold_root)
+        try:
+            for chunk in read_compressed(f):
+                out.write(chunk)
+            out.seek(0)
+        except BaseException:
+            out.close()
+            raise
+        finally:
+            f.close()
+        return out
+
+    # ---------------- moves ----------------
+    def _begin(self, object_id):
+        with self.lock:
+            if object_id in self.moving:
+                return False
+            self.moving[object_id] = False
+            return True
+
+    def _account(self, tier, objects, size):
+        with self.lock:
+            self.sizes[tier][0] += objects
+            self.sizes[tier][1] += size
+            self._gauge(tier)
+
+    def _gauge(self, tier):
+        TIER_OBJECTS.set(self.sizes[tier][0], tier=tier)
+        TIER_BYTES.set(self.sizes[tier][1], tier=tier)
+
+    def _copy(self, chunks, tmp):
+        written = 0
+        with open(tmp, "wb") as out:
+            for chunk in chunks:
+                self.limiter.take(len(chunk))
+                out.write(chunk)
+                written += len(chunk)
+            if self.fsync:
+                out.flush()
+                os.fsync(out.fileno())
+        return written
+
+    def _finish(self, object_id, tmp, target, source):
+        # the object may have been deleted or overwritten while it was copied
+        with self.lock:
+            removed = self.moving.pop(object_id)
+            if removed:
+                os.remove(tmp)
+                return False
+            os.replace(tmp, target)
+            try:
+                os.remove(source)
+            except FileNotFoundError:
+                pass
+            return True
+
+    def demote(self, object_id, hot_path):
+        """Move a hot object to the cold tier. False if it is being moved or was removed meanwhile."""
+        if not self._begin(object_id):
+            return False
+        cold = layout.object_path(self.cold_root, object_id, create=True)
+        tmp = os.path.join(os.path.dirname(cold), f".{object_id}.demote")
+        try:
+            with open(hot_path, "rb") as src:
+                size = os.fstat(src.fileno()).st_size
+                head = src.read(CHUNK_SIZE)
+                compress = len(zlib.compress(head, 1)) < len(head) * MIN_SAVING
+                rest = iter(lambda: src.read(CHUNK_SIZE), b"")
+                if compress:
+                    deflater = zlib.compressobj(LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip framing
+                    chunks = (deflater.compress(chunk) for chunk in _chain(head, rest))
+                    stored = self._copy(_chain_tail(chunks, deflater.flush), tmp)
+                else:
+                    stored = self._copy(_chain(head, rest), tmp)
+        except BaseException:
+            with self.lock:
+                self.moving.pop(object_id, None)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if not self._finish(object_id, tmp, cold + ".gz" if compress else cold, hot_path):
+            return False
+        self._account("hot", -1, -size)
+        self._account("cold", 1, stored)
+        TIER_MOVES.inc(direction="demote", result="ok")
+        TIER_MOVED_BYTES.inc(size, direction="demote", kind="original")
+        TIER_MOVED_BYTES.inc(stored, direction="demote", kind="stored")
+        return True
+
+    def promote(self, object_id, hot_path):
+        """Move a cold object back to ``hot_path``. False if it is not cold, is being moved, or moves are paused."""
+        if self.paused():
+            return False
+        located = self.locate(object_id)
+        if located is None or not self._begin(object_id):
+            return False
+        cold, compressed = located
+        tmp = os.path.join(os.path.dirname(hot_path), f".{object_id}.promote")
+        try:
+            os.makedirs(os.path.dirname(hot_path), exist_ok=True)
+            stored = os.path.getsize(cold)
+            with open(cold, "rb") as src:
+                size = self._copy(self.chunks(src, compressed), tmp)
+        except BaseException:
+            with self.lock:
+                self.moving.pop(object_id, None)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if not self._finish(object_id, tmp, hot_path, cold):
+            return False
+        self._account("cold", -1, -stored)
+        self._account("hot", 1, size)
+        TIER_MOVES.inc(direction="promote", result="ok")
+        TIER_MOVED_BYTES.inc(size, direction="promote", kind="original")
+        TIER_MOVED_BYTES.inc(stored, direction="promote", kind="stored")
+        return True
+
+    def read_cold(self, object_id, hot_path):
+        """Note a read of a cold object and promote it in the background if it is read often enough."""
+        if self.access(object_id) >= PROMOTE_HITS and not self.paused():
+            self.promotions.put((object_id, hot_path))
+
+    def remove(self, object_id, hot_path):
+        """Remove an object from whichever tier holds it, including one being moved."""
+        with self.lock:
+            if object_id in self.moving:
+                self.moving[object_id] = True
+            self.reads.pop(object_id, None)
+        for path in (hot_path, *self.cold_paths(object_id)):
+            try:
+                if path:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    # ---------------- background ----------------
+    def _wait_until_idle(self):
+        deadline = time.monotonic() + scrubber.MAX_BUSY_WAIT
+        while self.busy() and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+    def run_once(self):
+        """Demote every cold object in the hot tier and recount both tiers. Returns the number demoted."""
+        now = time.time()
+        hot, demoted = [0, 0], 0
+        for object_id, path in layout.walk_objects(self.root):
+            if self.paused():
+                return demoted  # resumes with the next pass; the counts stay as they were
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            with self.lock:
+                read = self.reads.get(object_id)
+            last = max(read[0] if read else 0, st.st_mtime)
+            if now - last >= COLD_AFTER and st.st_size >= MIN_SIZE:
+                self._wait_until_idle()
+                try:
+                    if self.demote(object_id, path):
+                        demoted += 1
+                        continue
+                except OSError as e:
+                    TIER_MOVES.inc(direction="demote", result="error")
+                    print(f"demoting {object_id} failed: {e}")
+            hot[0] += 1
+            hot[1] += st.st_size
+        cold = [0, 0]
+        for _, path in layout.walk_objects(self.cold_root):
+            try:
+                cold[1] += os.path.getsize(path)
+                cold[0] += 1
+            except FileNotFoundError:
+                pass
+        with self.lock:
+            self.sizes = {"hot": hot, "cold": cold}
+            for tier in self.sizes:
+                self._gauge(tier)
+        self._save_state()
+        return demoted
+
+    def start(self):
+        def tier_loop():
+            while True:
+                try:
+                    demoted = self.run_once()
+                    if demoted:
+                        print(f"moved {demoted} cold objects to the cold tier")
+                except Exception as e:
+                    print(f"tiering pass failed: {e}")
+                time.sleep(INTERVAL)
+
+        def promote_loop():
+            while True:
+                object_id, hot_path = self.promotions.get()
+                try:
+                    self.promote(object_id, hot_path)
+                except Exception as e:
+                    TIER_MOVES.inc(direction="promote", result="error")
+                    print(f"promoting {object_id} failed: {e}")
+
+        # promotions go on with TIERING_ENABLED=0, so objects already cold come back as they are read
+        if ENABLED:
+            threading.Thread(target=tier_loop, daemon=True).start()
+        threading.Thread(target=promote_loop, daemon=True).start()
+
+
+def _chain(head, rest):
+    yield head
+    yield from rest
+
+
+def _chain_tail(chunks, tail):
+    yield from chunks
+    yield tail()
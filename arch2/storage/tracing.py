@@ -0,0 +1,255 @@
+"""Request-ID propagation and per-hop timing spans for the mini-dropbox services.
+
+The first service a request reaches (the edge) takes ``X-Request-ID`` from
+the client or generates one, and decides whether the request is sampled.
+Both travel on every internal call made through ``TracedSession``, so all
+hops of one request share an ID and the same sampling decision.
+
+The sampling decision and parent span are only taken from an internal hop:
+a request carrying ``X-Internal-Token: $INTERNAL_TOKEN``, which
+``TracedSession`` sends. Without ``INTERNAL_TOKEN`` every hop but the edge
+counts as internal. At the edge a client cannot force sampling, and so
+defeat the sample rate, unless it sends ``X-Admin-Token: $ADMIN_TOKEN``.
+
+Sampled spans are buffered in memory and written by a background thread as
+JSON lines to ``TRACE_FILE`` (a volume shared by all containers) and/or
+POSTed to ``TRACE_COLLECTOR_URL``. ``python cli.py trace <request-id>``
+renders them as a waterfall.
+"""
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+import requests
+from flask import g, has_request_context, request
+
+SERVICE_NAME = os.environ.get("SERVICE_NAME", "unknown")
+SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.01"))  # fraction of edge requests traced
+TRACE_FILE = os.environ.get("TRACE_FILE", "/traces/spans.jsonl")  # empty string disables the file
+TRACE_COLLECTOR_URL = os.environ.get("TRACE_COLLECTOR_URL")  # optional HTTP collector
+FLUSH_INTERVAL = float(os.environ.get("TRACE_FLUSH_INTERVAL", "1"))
+INTERNAL_TOKEN = os.environ.get("INTERNAL_TOKEN", "")  # sent between services; empty trusts all but the edge
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")  # lets a client force sampling at the edge
+MAX_BUFFER = 10000  # spans kept while the exporter is behind; extra spans are dropped
+
+REQUEST_ID_HEADER = "X-Request-ID"
+SAMPLED_HEADER = "X-Trace-Sampled"
+PARENT_HEADER = "X-Parent-Span"
+INTERNAL_HEADER = "X-Internal-Token"
+
+_buffer = []
+_buffer_lock = threading.Lock()
+_exporter = None
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attrs", "start", "_t0", "_done")
+
+    def __init__(self, trace_id, parent_id, name, attrs):
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self._done = False
+
+    def finish(self):
+        if self._done:
+            return
+        self._done = True
+        record = {
+            "trace": self.trace_id,
+            "span": self.span_id,
+            "parent": self.parent_id,
+            "service": SERVICE_NAME,
+            "name": self.name,
+            "start": self.start,
+            "duration": time.perf_counter() - self._t0,
+            "attrs": self.attrs,
+        }
+        with _buffer_lock:
+            if len(_buffer) < MAX_BUFFER:
+                _buffer.append(record)
+        _ensure_exporter()
+
+
+class _NoopSpan:
+    span_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class _SpanContext:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        stack = g.trace_stack
+        self.span = Span(g.request_id, stack[-1].span_id, self.name, self.attrs)
+        stack.append(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.span.attrs["error"] = exc_type.__name__
+        g.trace_stack.pop()
+        self.span.finish()
+        timings = g.get("slow_request")
+        if timings is not None:
+            timings.timed(self.name, self.span._t0, time.perf_counter() - self.span._t0)
+        return False
+
+
+class _Timed(_NoopSpan):
+    """An unsampled span, timed only for the slow-request log (see profiling.py)."""
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings.timed(self.name, self.t0, time.perf_counter() - self.t0)
+        return False
+
+
+def span(name, **attrs):
+    """Time a block as a child of the current span. Almost free when the request is not sampled."""
+    if not has_request_context():
+        return _NOOP
+    if not g.get("trace_sampled"):
+        timings = g.get("slow_request")
+        return _NOOP if timings is None else _Timed(timings, name)
+    return _SpanContext(name, attrs)
+
+
+def current_request_id():
+    return g.get("request_id") if has_request_context() else None
+
+
+def _trusted(edge):
+    """True if the current request's sampling headers come from another service (or an admin)."""
+    if INTERNAL_TOKEN and request.headers.get(INTERNAL_HEADER) == INTERNAL_TOKEN:
+        return True
+    if edge:
+        return bool(ADMIN_TOKEN) and request.headers.get("X-Admin-Token") == ADMIN_TOKEN
+    return not INTERNAL_TOKEN
+
+
+def instrument(app, edge=False):
+    """Assign or adopt a request ID for every request and trace the handler.
+
+    ``edge`` is for the services clients call: they make the sampling decision.
+    """
+
+    @app.before_request
+    def _trace_start():
+        incoming = request.headers.get(REQUEST_ID_HEADER)
+        g.request_id = incoming or uuid.uuid4().hex
+        trusted = _trusted(edge)
+        sampled = request.headers.get(SAMPLED_HEADER) if trusted else None
+        if sampled is None:
+            g.trace_sampled = random.random() < SAMPLE_RATE
+        else:
+            g.trace_sampled = sampled == "1"
+        if not g.trace_sampled:
+            return
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        parent = request.headers.get(PARENT_HEADER) if trusted else None
+        root = Span(g.request_id, parent, f"{request.method} {route}", {"path": request.path})
+        g.trace_root = root
+        g.trace_stack = [root]
+
+    @app.after_request
+    def _trace_finish(response):
+        if "request_id" not in g:
+            return response
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+        root = g.get("trace_root")
+        if root is not None:
+            root.attrs["status"] = response.status_code
+            # streamed bodies are still being sent, so end the span on close
+            response.call_on_close(root.finish)
+        return response
+
+    return app
+
+
+class TracedSession(requests.Session):
+    """requests.Session that forwards the request ID and times each upstream call."""
+
+    def request(self, method, url, **kwargs):
+        if not has_request_context() or "request_id" not in g:
+            return super().request(method, url, **kwargs)
+        headers = dict(kwargs.pop("headers", None) or {})
+        headers[REQUEST_ID_HEADER] = g.request_id
+        headers[SAMPLED_HEADER] = "1" if g.trace_sampled else "0"
+        if INTERNAL_TOKEN:
+            headers[INTERNAL_HEADER] = INTERNAL_TOKEN
+        with span(f"{method.upper()} {urlsplit(url).hostname}", url=url) as s:
+            if s.span_id is not None:
+                headers[PARENT_HEADER] = s.span_id
+            resp = super().request(method, url, headers=headers, **kwargs)
+            if s.span_id is not None:
+                s.attrs["status"] = resp.status_code
+            return resp
+
+
+# ---------------- Export ----------------
+def _ensure_exporter():
+    global _exporter
+    if _exporter is None:
+        with _buffer_lock:
+            if _exporter is None:
+                _exporter = threading.Thread(target=_export_loop, daemon=True)
+                _exporter.start()
+
+
+def _export_loop():
+    session = requests.Session()
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush(session)
+
+
+def flush(session=None):
+    global _buffer
+    with _buffer_lock:
+        batch, _buffer = _buffer, []
+    if not batch:
+        return
+    payload = "".join(json.dumps(s) + "\n" for s in batch)
+    if TRACE_FILE:
+        try:
+            os.makedirs(os.path.dirname(TRACE_FILE), exist_ok=True)
+            # one O_APPEND write per batch so several containers can share the file
+            fd = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, payload.encode())
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print(f"trace export to {TRACE_FILE} failed: {e}")
+    if TRACE_COLLECTOR_URL:
+        try:
+            (session or requests).post(TRACE_COLLECTOR_URL, data=payload,
+                                       headers={"Content-Type": "application/x-ndjson"}, timeout=2)
+        except requests.RequestException as e:
+            print(f"trace export to {TRACE_COLLECTOR_URL} failed: {e}")
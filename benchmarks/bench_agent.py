@@ -0,0 +1,98 @@
+"""Command latency of cli.py with and without the client agent.
+
+Runs ``--commands`` CLI invocations (``python cli.py list`` by default)
+as a script would, ``--parallel`` at a time, against a local stand-in for
+the gateway that answers at once, so what is measured is the client's own
+cost per command: interpreter start, imports, token file, connection setup.
+
+  direct   cli.py imports requests and opens its own connection
+  agent    cli.py sends the request to agent.py over its Unix socket
+
+Run from the repo root:  python benchmarks/bench_agent.py --commands 500 --parallel 1 8
+"""
+import argparse
+import http.server
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "arch1", "client")
+
+
+class Gateway(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as the real gateway
+    body = json.dumps([{"filename": f"file{i}.txt", "size": i} for i in range(20)]).encode()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def run(command, env, commands, parallel):
+    def one(_):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(CLIENT, "cli.py"), *command], env=env,
+                       stdout=subprocess.DEVNULL, check=True)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(parallel) as pool:
+        latencies = sorted(pool.map(one, range(commands)))
+    return latencies, time.perf_counter() - start
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--commands", type=int, default=300)
+    parser.add_argument("--parallel", type=int, nargs="+", default=[1, 8], help="CLI invocations running at once")
+    parser.add_argument("--command", default="list", help="CLI command to repeat, e.g. 'usage'")
+    args = parser.parse_args()
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Gateway)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as home:
+        with open(os.path.join(home, ".mini_dropbox_token"), "w") as f:
+            f.write("bench-token")
+        sock = os.path.join(home, "agent.sock")
+        env = dict(os.environ, HOME=home, API_URL=f"http://127.0.0.1:{server.server_port}",
+                   UPLOAD_URL=f"http://127.0.0.1:{server.server_port}", AGENT_SOCKET=sock)
+
+        print(f"{args.commands} x 'cli.py {args.command}', {os.cpu_count()} CPUs")
+        print(f"  {'mode':<8} {'parallel':>8} {'p50 ms':>8} {'p99 ms':>8} {'cmds/s':>8}")
+        for mode in ("direct", "agent"):
+            agent = None
+            if mode == "agent":
+                agent = subprocess.Popen([sys.executable, os.path.join(CLIENT, "agent.py"), "--socket", sock],
+                                         env=env, stdout=subprocess.DEVNULL)
+                while not os.path.exists(sock):
+                    time.sleep(0.05)
+            try:
+                for parallel in args.parallel:
+                    latencies, elapsed = run(args.command.split(), env, args.commands, parallel)
+                    print(f"  {mode:<8} {parallel:>8} {percentile(latencies, 50) * 1000:>8.1f} "
+                          f"{percentile(latencies, 99) * 1000:>8.1f} {args.commands / elapsed:>8.1f}")
+            finally:
+                if agent is not None:
+                    agent.terminate()
+                    agent.wait()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
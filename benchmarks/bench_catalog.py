@@ -0,0 +1,218 @@
+"""Metadata catalog: a dict of dicts vs the column-backed ``Catalog``.
+
+For each file count, random but realistic records (owner, nested path,
+object ID and path, SHA-256, size, mtime, MIME type) are loaded both into a
+plain dict of dicts plus the object ID map (the old ``FILES`` and
+``OBJECTS``) and into ``catalog.Catalog``. Reported per representation:
+
+  bytes/file   memory held by the records (tracemalloc), not counting the
+               filename strings, which the indexes share either way
+  lookup       one record by filename, as ``GET /files/<name>`` reads it
+  list         all records to JSON, as ``GET /files`` sends them
+
+and, for the catalog, the snapshot: how long writers wait while it is
+copied (or, where there is ``os.fork``, while the writing child is forked),
+the time to write it, its size, and the restart time (load it and rebuild
+the indexes), next to a JSON dump of the same records.
+
+Run from the repo root:  python benchmarks/bench_catalog.py --counts 100000 1000000
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "arch1", "metadata"))
+
+import catalog  # noqa: E402
+import indexes  # noqa: E402
+
+USERS = [f"user{i}" for i in range(1000)]
+DIRS = ["projects/app/src/", "photos/2023/summer/", "docs/reports/", "music/", "tmp/"]
+MIMES = ["image/jpeg", "image/png", "application/pdf", "text/plain", "audio/mpeg", "video/mp4"]
+NOW = 1_700_000_000
+
+
+def make_records(count):
+    records = []
+    for i in range(count):
+        object_id = uuid.UUID(int=random.getrandbits(128)).hex
+        segment = random.random() < 0.6  # small files live in segments and have no path
+        fanout = hashlib.md5(object_id.encode()).hexdigest()
+        records.append({
+            "filename": f"{random.choice(DIRS)}file{i:08d}.dat",
+            "object_id": object_id,
+            "store": "segment" if segment else "file",
+            "path": None if segment else f"/storage/objects/{fanout[:2]}/{fanout[2:4]}/{object_id}",
+            "size": int(random.paretovariate(1.2) * 16 * 1024),
+            "version": 1,
+            "sha256": hashlib.sha256(object_id.encode()).hexdigest(),
+            "crc32": random.getrandbits(32),
+            "encrypted": False,
+            "mime": random.choice(MIMES),
+            "modified": NOW - random.uniform(0, 365 * 86400),
+            "user": random.choice(USERS),
+            "node": "storage-1",
+            "password": "",
+        })
+    return records
+
+
+def as_decoded(records):
+    # what the old store held: each record parsed from its own JSON body, so no string is shared
+    return [json.loads(json.dumps(record)) for record in records]
+
+
+def _held(value):
+    # None, booleans and small ints are shared by every record
+    if value is None or type(value) is bool or (type(value) is int and -5 <= value <= 256):
+        return 0
+    return sys.getsizeof(value)
+
+
+def build_dicts(records):
+    files, objects = {}, {}
+    for record in records:
+        files[record["filename"]] = record
+        objects[record["object_id"]] = record["filename"]
+    return files, objects
+
+
+def build_catalog(records):
+    files = catalog.Catalog()
+    for record in records:
+        files[record["filename"]] = record
+    return files
+
+
+def measured(build, records):
+    """(result, bytes allocated by build beyond the records it was given)."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(records)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def per_op(fn, names):
+    start = time.perf_counter()
+    for name in names:
+        fn(name)
+    return (time.perf_counter() - start) / len(names)
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def forked_save(files, idx, path):
+    """(pause, total): how long the caller waited for the fork, and until the child had written ``path``."""
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        files.save(path, idx.names())
+        os._exit(0)
+    pause = time.perf_counter() - start
+    os.waitpid(pid, 0)
+    return pause, time.perf_counter() - start
+
+
+def index(records):
+    idx = indexes.Indexes()
+    for record in records:
+        idx.update(record["filename"], None, record)
+    return idx
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--counts", type=int, nargs="+", default=[100000])
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+    random.seed(0)
+
+    for count in args.counts:
+        print(f"\n{count} files")
+        records = make_records(count)
+        # the dict store holds records as decoded from JSON; the catalog only keeps its columns
+        decoded = as_decoded(records)
+        (dicts, objects), dict_bytes = measured(build_dicts, decoded)
+        dict_bytes += sum(sys.getsizeof(r) + sum(_held(v) for k, v in r.items() if k != "filename") for r in decoded)
+        del decoded
+        files, catalog_bytes = measured(build_catalog, records)
+        assert all(files[r["filename"]] == r for r in records[:1000])
+
+        names = [random.choice(records)["filename"] for _ in range(args.lookups)]
+        dict_lookup = per_op(lambda n: dict(dicts[n]), names)
+        catalog_lookup = per_op(lambda n: files[n], names)
+        dict_list, _ = timed(lambda: json.dumps(list(dicts.values())))
+        catalog_list, _ = timed(lambda: "".join(_json_list(files.freeze().values())))
+
+        print(f"  {'':<10} {'bytes/file':>11} {'lookup us':>10} {'list s':>8}")
+        print(f"  {'dicts':<10} {dict_bytes / count:>11.0f} {dict_lookup * 1e6:>10.2f} {dict_list:>8.2f}")
+        print(f"  {'catalog':<10} {catalog_bytes / count:>11.0f} {catalog_lookup * 1e6:>10.2f} {catalog_list:>8.2f}")
+
+        idx = index(records)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "catalog.snapshot")
+            pause, (frozen, ordered) = timed(lambda: (files.freeze(), idx.names()))
+            write, _ = timed(lambda: frozen.save(path, ordered))
+            size = os.path.getsize(path)
+            del frozen
+            fork_pause, fork_total = forked_save(files, idx, path) if hasattr(os, "fork") else (None, None)
+            del idx
+
+            def restart():
+                loaded = catalog.Catalog()
+                names, _ = loaded.load(path)
+                idx = indexes.Indexes()
+                idx.load(names, *(loaded.column(field, names) for field in ("size", "modified", "user", "mime")))
+                return loaded
+
+            load, loaded = timed(restart)
+            assert all(loaded[r["filename"]] == r for r in records[:1000])
+            del loaded
+
+            json_path = os.path.join(tmp, "records.json")
+            json_write, _ = timed(lambda: json.dump(records, open(json_path, "w")))
+            json_size = os.path.getsize(json_path)
+
+            def json_restart():
+                rebuilt, _ = build_dicts(json.load(open(json_path)))
+                return rebuilt, index(rebuilt.values())
+
+            json_load, _ = timed(json_restart)
+
+        print(f"  snapshot: writers paused {pause * 1e3:.0f} ms, written in {write:.2f} s, "
+              f"{size / count:.0f} bytes/file; restart {load:.2f} s")
+        if fork_pause is not None:
+            print(f"  forked snapshot: writers paused {fork_pause * 1e3:.1f} ms, written in {fork_total:.2f} s")
+        print(f"  json dump: written in {json_write:.2f} s, {json_size / count:.0f} bytes/file; "
+              f"restart {json_load:.2f} s")
+        del files, dicts, objects
+
+
+def _json_list(records):
+    # what GET /files streams: a thousand records per chunk
+    chunk, first = [], True
+    for record in records:
+        chunk.append(json.dumps(record))
+        if len(chunk) == 1000:
+            yield ("[" if first else ",") + ",".join(chunk)
+            chunk, first = [], False
+    if chunk or first:
+        yield ("[" if first else ",") + ",".join(chunk)
+    yield "]"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Storage throughput with encryption at rest on and off.
+
+  write   raw body streamed into ingest.IngestWriter and committed
+  read    whole object read back (plaintext file, or decrypted chunk by chunk)
+  range   1 MiB read from the middle of the object
+
+Encrypted runs are repeated for each ``--threads`` value (CRYPTO_THREADS);
+1 seals and opens chunks inline, more uses the thread pool.
+
+Run from the repo root:  python benchmarks/bench_crypto.py --size-mb 256 --threads 1 4
+INGEST_* / CRYPTO_CHUNK_SIZE are read from the environment as in the service.
+"""
+import argparse
+import base64
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "arch1", "storage"))
+os.environ.setdefault("STORAGE_ENCRYPTION_KEY", base64.b64encode(os.urandom(32)).decode())
+
+import crypto  # noqa: E402
+import ingest  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def write(directory, payload, encrypt):
+    path = os.path.join(directory, "bench.bin")
+    writer = ingest.IngestWriter(path, "bench.bin", encrypt=encrypt)
+    ingest.copy_stream(io.BytesIO(payload), writer)
+    writer.commit()
+    return path
+
+
+def read(path, encrypt, start=0, stop=None):
+    with open(path, "rb", buffering=0) as f:
+        if encrypt:
+            return sum(len(chunk) for chunk in crypto.read_range(f, start, stop))
+        f.seek(start)
+        if stop is None:
+            return sum(len(chunk) for chunk in iter(lambda: f.read(ingest.BUFFER_SIZE), b""))
+        return len(f.read(stop - start))
+
+
+def best(fn, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=128)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, os.cpu_count() or 1])
+    parser.add_argument("--dir", help="Target directory (default: a temp dir)")
+    args = parser.parse_args()
+
+    size = args.size_mb * MB
+    payload = os.urandom(size)
+    middle = size // 2
+    print(f"{args.size_mb} MiB object, chunk={crypto.CHUNK_SIZE}, fsync={ingest.FSYNC}, "
+          f"{os.cpu_count()} CPUs, best of {args.runs}")
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        configs = [("plaintext", False, None)] + [(f"encrypted, {n} thread(s)", True, n) for n in dict.fromkeys(args.threads)]
+        for label, encrypt, threads in configs:
+            if threads is not None:
+                crypto.THREADS = threads
+                crypto._pool = None
+            path = write(directory, payload, encrypt)
+            assert read(path, encrypt) == size
+            w = best(lambda: write(directory, payload, encrypt), args.runs)
+            r = best(lambda: read(path, encrypt), args.runs)
+            g = best(lambda: read(path, encrypt, middle, middle + MB), args.runs)
+            print(f"  {label:<26} write {size / w / 1e6:8.1f} MB/s   read {size / r / 1e6:8.1f} MB/s"
+                  f"   1 MiB range {g * 1e3:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
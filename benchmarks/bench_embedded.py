@@ -0,0 +1,184 @@
+"""Per-request latency and server CPU: three services vs embedded mode.
+
+Runs the arch1 services on this machine and sends them ``--requests``
+authenticated requests per operation, ``--parallel`` at a time:
+
+  layered    gateway, storage and metadata as three processes, each on its
+             own port, calling each other over local HTTP as the containers do
+  embedded   embedded/app.py: all three in one process, internal calls in process
+
+Operations: ``download`` of a ``--size`` byte file (gateway -> storage ->
+metadata) and ``list`` (gateway -> metadata). CPU is the user + system time
+of the server processes while the requests ran, per request (Linux /proc).
+
+Run from the repo root:  python benchmarks/bench_embedded.py --requests 2000 --parallel 1 8
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ARCH1 = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "arch1")
+EMBEDDED = os.path.join(ARCH1, "embedded")
+SERVICES = {"gateway": ("services", "gateway_app"), "storage": ("storage", "storage_app"),
+            "metadata": ("metadata", "metadata_app")}
+OPERATIONS = ("download", "list")
+NO_LIMITS = {"routes": {route: {"rate": 1e9, "burst": 1e9} for route in ("*", "/files/upload", "/files/download")},
+             "max_transfers": 0}
+
+
+# ---------------- Layered mode: one service per process ----------------
+class LocalAdapter(requests.adapters.HTTPAdapter):
+    """Sends requests for a container URL (http://storage:5002) to a local port instead."""
+
+    def __init__(self, base, target):
+        super().__init__()
+        self.base = base
+        self.target = target
+
+    def send(self, request, **kwargs):
+        request.url = self.target + request.url[len(self.base):]
+        return super().send(request, **kwargs)
+
+
+def serve(name, ports):
+    from werkzeug.serving import run_simple
+
+    sys.path.insert(0, EMBEDDED)
+    import inprocess
+
+    directory, module_name = SERVICES[name]
+    service = inprocess.load_service(os.path.join(ARCH1, directory), module_name, directory)
+    for base, target in (("http://metadata:5001", ports["metadata"]), ("http://storage:5002", ports["storage"])):
+        service.http.mount(base + "/", LocalAdapter(base, f"http://127.0.0.1:{target}"))
+    if name == "storage":
+        service.start_background()
+    elif name == "metadata":
+        threading.Thread(target=service._reconcile_loop, daemon=True).start()
+    run_simple("127.0.0.1", ports[name], service.app, threaded=True)
+
+
+# ---------------- Load ----------------
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        total += int(fields[11]) + int(fields[12])  # utime, stime
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+def wait_until_up(url):
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            if requests.get(f"{url}/metrics", timeout=1).status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        if time.monotonic() > deadline:
+            raise SystemExit(f"{url} did not come up")
+        time.sleep(0.1)
+
+
+def prepare(url, size):
+    requests.post(f"{url}/auth/signup", json={"username": "bench", "password": "bench"})
+    token = requests.post(f"{url}/auth/login", json={"username": "bench", "password": "bench"}).json()["token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    for i in range(20):
+        files = {"file": (f"file{i}.bin", os.urandom(size))}
+        for _ in range(100):  # until storage's first heartbeat has reached the node registry
+            r = requests.post(f"{url}/files/upload", headers=headers, files=files)
+            if r.status_code == 200:
+                break
+            time.sleep(0.1)
+        r.raise_for_status()
+    return headers
+
+
+def run(url, headers, operation, count, parallel):
+    local = threading.local()
+
+    def one(i):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        if operation == "download":
+            r = session.get(f"{url}/files/download", headers=headers, params={"filename": f"file{i % 20}.bin"})
+        else:
+            r = session.get(f"{url}/files", headers=headers)
+        r.raise_for_status()
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(parallel) as pool:
+        list(pool.map(one, range(min(count, 50))))  # warm up connections
+        start = time.perf_counter()
+        latencies = sorted(pool.map(one, range(count)))
+    return latencies, time.perf_counter() - start
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def start_servers(mode, env, base_port):
+    ports = {"gateway": base_port, "storage": base_port + 1, "metadata": base_port + 2}
+    if mode == "embedded":
+        cmd = [sys.executable, os.path.join(EMBEDDED, "app.py"), "--host", "127.0.0.1", "--port", str(base_port)]
+        procs = [subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)]
+    else:
+        procs = [subprocess.Popen([sys.executable, __file__, "--serve", name, "--ports", json.dumps(ports)],
+                                  env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                 for name in ("metadata", "storage", "gateway")]
+        wait_until_up(f"http://127.0.0.1:{ports['metadata']}")
+        wait_until_up(f"http://127.0.0.1:{ports['storage']}")
+    wait_until_up(f"http://127.0.0.1:{base_port}")
+    return procs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000, help="requests per operation and parallelism")
+    parser.add_argument("--parallel", type=int, nargs="+", default=[1, 8], help="requests in flight at once")
+    parser.add_argument("--size", type=int, default=4096, help="bytes per downloaded file")
+    parser.add_argument("--port", type=int, default=18000, help="first of the ports the servers listen on")
+    parser.add_argument("--serve", choices=SERVICES, help=argparse.SUPPRESS)
+    parser.add_argument("--ports", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        return serve(args.serve, json.loads(args.ports))
+
+    print(f"{args.requests} requests per row, {args.size} byte files, {os.cpu_count()} CPUs")
+    print(f"  {'mode':<9} {'operation':<9} {'parallel':>8} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8} {'CPU ms/req':>10}")
+    for mode in ("layered", "embedded"):
+        with tempfile.TemporaryDirectory() as storage:
+            env = dict(os.environ, STORAGE_PATH=storage, TRACE_FILE="", HEARTBEAT_INTERVAL="0.5",
+                       ADMISSION_LIMITS=json.dumps(NO_LIMITS), SCRUB_ENABLED="0", PYTHONWARNINGS="ignore")
+            procs = start_servers(mode, env, args.port)
+            try:
+                url = f"http://127.0.0.1:{args.port}"
+                headers = prepare(url, args.size)
+                for operation in OPERATIONS:
+                    for parallel in args.parallel:
+                        cpu = cpu_seconds(p.pid for p in procs)
+                        latencies, elapsed = run(url, headers, operation, args.requests, parallel)
+                        cpu = cpu_seconds(p.pid for p in procs) - cpu
+                        print(f"  {mode:<9} {operation:<9} {parallel:>8} {percentile(latencies, 50) * 1000:>8.2f} "
+                              f"{percentile(latencies, 99) * 1000:>8.2f} {args.requests / elapsed:>8.0f} "
+                              f"{cpu / args.requests * 1000:>10.2f}")
+            finally:
+                for p in procs:
+                    p.terminate()
+                    p.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Upload throughput of the storage service: old save path vs single-pass ingest.
+
+  old        werkzeug spools the multipart part to a temp file, f.save() copies it, getsize() stats it
+  multipart  ingest.IngestWriter receives the part while it is parsed, then renames it into place
+  raw        raw request body streamed into ingest.IngestWriter (what the gateways send)
+
+Run from the repo root:  python benchmarks/bench_ingest.py --size-mb 256 --runs 3
+INGEST_BUFFER_SIZE / INGEST_FSYNC are read from the environment as in the service.
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "arch1", "storage"))
+
+from flask import Flask, Request, jsonify, request  # noqa: E402
+import ingest  # noqa: E402
+
+
+def make_apps(directory):
+    old = Flask("old")
+
+    @old.route("/upload", methods=["POST"])
+    def old_upload():
+        f = request.files["file"]
+        path = os.path.join(directory, f.filename)
+        f.save(path)
+        if ingest.FSYNC != "none":
+            with open(path, "rb") as fh:
+                os.fsync(fh.fileno())
+        return jsonify({"size": os.path.getsize(path)})
+
+    class IngestRequest(Request):
+        form_data_parser_class = ingest.FormDataParser
+
+        def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+            return ingest.IngestWriter(os.path.join(directory, filename), filename, content_type)
+
+    new = Flask("new")
+    new.request_class = IngestRequest
+
+    @new.route("/upload", methods=["POST"])
+    def new_upload():
+        if request.mimetype == "multipart/form-data":
+            f = request.files["file"]
+            writer = f.stream
+        else:
+            filename = request.args["filename"]
+            writer = ingest.copy_stream(request.stream, ingest.IngestWriter(os.path.join(directory, filename), filename))
+        return jsonify(writer.commit())
+
+    return old, new
+
+
+def run(client, payload, raw, runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        if raw:
+            resp = client.post("/upload?filename=bench.bin", data=payload, content_type="application/octet-stream")
+        else:
+            resp = client.post("/upload", data={"file": (io.BytesIO(payload), "bench.bin")})
+        elapsed = time.perf_counter() - start
+        assert resp.status_code == 200, resp.data
+        best = elapsed if best is None else min(best, elapsed)
+    return len(payload) / best / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=128)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--dir", help="Target directory (default: a temp dir)")
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size_mb * 1024 * 1024)
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        old, new = make_apps(directory)
+        print(f"{args.size_mb} MiB upload, buffer={ingest.BUFFER_SIZE}, fsync={ingest.FSYNC}, best of {args.runs}")
+        print(f"  old save path      {run(old.test_client(), payload, False, args.runs):8.1f} MB/s")
+        print(f"  ingest (multipart) {run(new.test_client(), payload, False, args.runs):8.1f} MB/s")
+        print(f"  ingest (raw body)  {run(new.test_client(), payload, True, args.runs):8.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Create and lookup latency of the flat layout vs the hashed fan-out layout.
+
+For each file count, both layouts get that many empty files; then random
+existing names are looked up with os.path.exists and random missing names
+with os.stat (the two calls the storage service and backup make).
+
+Run from the repo root:  python benchmarks/bench_layout.py --counts 1000 10000 100000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "arch1", "storage"))
+
+import layout  # noqa: E402
+
+
+def flat_path(root, object_id):
+    return os.path.join(root, object_id)
+
+
+def fanout_path(root, object_id):
+    return layout.object_path(root, object_id, create=True)
+
+
+def measure(root, count, path_for, samples):
+    ids = [layout.new_object_id() for _ in range(count)]
+    create = []
+    for object_id in ids:
+        start = time.perf_counter()
+        with open(path_for(root, object_id), "wb"):
+            pass
+        create.append(time.perf_counter() - start)
+
+    hits = [path_for(root, i) for i in random.sample(ids, min(samples, count))]
+    misses = [path_for(root, layout.new_object_id()) for _ in range(samples)]
+    lookup = []
+    for path in hits + misses:
+        start = time.perf_counter()
+        os.path.exists(path)
+        lookup.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    seen = sum(len(files) for _, _, files in os.walk(root))
+    scan = time.perf_counter() - start
+    assert seen == count
+    return create, lookup, scan
+
+
+def fmt(values):
+    values = sorted(values)
+    p99 = values[int(len(values) * 0.99) - 1]
+    return f"mean {statistics.mean(values) * 1e6:7.1f} us  p99 {p99 * 1e6:7.1f} us"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--samples", type=int, default=5000, help="Lookups per layout and count")
+    parser.add_argument("--dir", help="Parent directory for the test trees (default: system temp)")
+    args = parser.parse_args()
+
+    for count in args.counts:
+        for name, path_for in (("flat", flat_path), ("fan-out", fanout_path)):
+            with tempfile.TemporaryDirectory(dir=args.dir) as root:
+                layout._made_dirs.clear()
+                create, lookup, scan = measure(root, count, path_for, args.samples)
+            print(f"{count:>9} files  {name:<8} create: {fmt(create)}   lookup: {fmt(lookup)}   full walk {scan:6.2f} s")
+
+
+if __name__ == "__main__":
+    main()
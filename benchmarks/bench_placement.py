@@ -0,0 +1,151 @@
+"""Upload latency under skewed load: fixed placement vs random vs placement.pick.
+
+A discrete-event simulation of storage nodes that each run ``--slots``
+transfers at once and queue the rest. The load is skewed: node 0 also
+serves a stream of downloads (``--hot``, a fraction of its capacity), and
+the last node's disk is ``--slow`` times the speed of the others. Uploads
+arrive at several gateways; transfer times are heavy-tailed.
+
+  fixed    each gateway sends everything to its own configured node (STORAGE_API)
+  random   a uniformly random node
+  p2c      placement.pick: two nodes sampled by free space, lower expected delay wins,
+           from heartbeats every --heartbeat seconds and the gateway's own uploads
+
+Run from the repo root:  python benchmarks/bench_placement.py --load 0.6 --uploads 200000
+"""
+import argparse
+import collections
+import heapq
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "arch1", "services"))
+
+import placement  # noqa: E402
+
+MEAN_SERVICE = 0.06  # seconds, on a full-speed node
+
+
+def service_time(rng):
+    # Pareto, alpha 1.5: mean 3 * 0.02 s, with a long tail of big files
+    return rng.paretovariate(1.5) * MEAN_SERVICE / 3
+
+
+class Node:
+    def __init__(self, node_id, slots, speed):
+        self.id = node_id
+        self.slots = slots
+        self.speed = speed
+        self.busy = 0
+        self.queue = collections.deque()
+        self.latencies = []  # completions since the last heartbeat
+        self.report = {"id": node_id, "url": node_id, "free_bytes": 1, "in_flight": 0, "latency_ms": 0}
+
+    def heartbeat(self):
+        latency = statistics.fmean(self.latencies) * 1000 if self.latencies else 0
+        self.report = dict(self.report, in_flight=self.busy + len(self.queue), latency_ms=latency)
+        self.latencies = []
+
+
+def simulate(policy, args, seed):
+    rng = random.Random(seed)
+    nodes = [Node(f"node{i}", args.slots, args.slow if i == args.nodes - 1 and args.nodes > 1 else 1.0)
+             for i in range(args.nodes)]
+    capacity = [n.slots * n.speed / MEAN_SERVICE for n in nodes]  # transfers per second
+    background = args.hot * capacity[0]
+    upload_rate = args.load * sum(capacity) - background
+    active = [collections.Counter() for _ in range(args.gateways)]  # per gateway: node id -> uploads in progress
+
+    events = []
+    seq = 0
+
+    def push(t, kind, data=None):
+        nonlocal seq
+        seq += 1
+        heapq.heappush(events, (t, seq, kind, data))
+
+    def start(t, node, job):
+        node.busy += 1
+        push(t + service_time(rng) / node.speed, "done", (node, job))
+
+    push(rng.expovariate(upload_rate), "upload")
+    if background:
+        push(rng.expovariate(background), "background")
+    push(args.heartbeat, "heartbeat")
+
+    latencies = []
+    uploads = 0
+    while events:
+        t, _, kind, data = heapq.heappop(events)
+        if kind == "upload":
+            uploads += 1
+            if uploads < args.uploads:
+                push(t + rng.expovariate(upload_rate), "upload")
+            gateway = rng.randrange(args.gateways)
+            if policy == "fixed":
+                node = nodes[gateway % len(nodes)]
+            elif policy == "random":
+                node = rng.choice(nodes)
+            else:
+                report = placement.pick([n.report for n in nodes], active[gateway], rng)
+                node = nodes[int(report["id"][4:])]
+            active[gateway][node.id] += 1
+            job = (t, gateway)
+        elif kind == "background":
+            if uploads < args.uploads:
+                push(t + rng.expovariate(background), "background")
+            node, job = nodes[0], (t, None)
+        elif kind == "heartbeat":
+            for n in nodes:
+                n.heartbeat()
+            if uploads < args.uploads:
+                push(t + args.heartbeat, "heartbeat")
+            continue
+        else:  # done
+            node, (arrived, gateway) = data
+            node.busy -= 1
+            node.latencies.append(t - arrived)
+            if gateway is not None:
+                latencies.append(t - arrived)
+                active[gateway][node.id] -= 1
+            if node.queue:
+                start(t, node, node.queue.popleft())
+            continue
+        if node.busy < node.slots:
+            start(t, node, job)
+        else:
+            node.queue.append(job)
+    return latencies
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--gateways", type=int, default=4)
+    parser.add_argument("--slots", type=int, default=4, help="Concurrent transfers per node")
+    parser.add_argument("--load", type=float, default=0.6, help="Total offered load / total capacity")
+    parser.add_argument("--hot", type=float, default=0.4, help="Share of node 0's capacity taken by downloads")
+    parser.add_argument("--slow", type=float, default=0.5, help="Speed of the last node relative to the others")
+    parser.add_argument("--heartbeat", type=float, default=5.0, help="Seconds between load reports (HEARTBEAT_INTERVAL)")
+    parser.add_argument("--uploads", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{args.nodes} nodes x {args.slots} slots, {args.gateways} gateways, load {args.load}, "
+          f"node0 {args.hot:.0%} busy with downloads, last node at {args.slow}x speed, "
+          f"heartbeat every {args.heartbeat} s")
+    print(f"  {'policy':<8} {'p50 ms':>9} {'p99 ms':>10} {'p99.9 ms':>10} {'max ms':>10}")
+    for policy in ("fixed", "random", "p2c"):
+        latencies = sorted(simulate(policy, args, args.seed))
+        row = [percentile(latencies, p) * 1000 for p in (50, 99, 99.9)] + [latencies[-1] * 1000]
+        print(f"  {policy:<8} " + " ".join(f"{v:>10.1f}" for v in row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Metadata query latency: secondary indexes vs a full scan of every record.
+
+For each file count, random records (owner, path, size, mtime, MIME type)
+are loaded into the metadata indexes; then a few typical queries are timed
+through ``Indexes.query`` and by filtering and sorting all records, which
+is what clients had to do with ``GET /files``.
+
+Run from the repo root:  python benchmarks/bench_query.py --counts 10000 100000 1000000
+"""
+import argparse
+import heapq
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "arch1", "metadata"))
+
+import indexes  # noqa: E402
+
+USERS = [f"user{i}" for i in range(1000)]
+DIRS = ["projects/", "photos/", "docs/", "music/", "tmp/"]
+MIMES = ["image/jpeg", "image/png", "application/pdf", "text/plain", "audio/mpeg", "video/mp4"]
+NOW = 1_700_000_000
+DAY = 86400
+GB = 1024 ** 3
+
+# name -> (query kwargs, equivalent scan predicate and sort)
+QUERIES = {
+    "my files over 1 GB": (
+        dict(owner="user7", min_size=GB, sort="-size", limit=100),
+        lambda r: r["user"] == "user7" and r["size"] >= GB, "size", True),
+    "projects/ changed since yesterday": (
+        dict(prefix="projects/", modified_after=NOW - DAY, sort="-modified", limit=100),
+        lambda r: r["filename"].startswith("projects/") and r["modified"] >= NOW - DAY, "modified", True),
+    "largest files of one user": (
+        dict(owner="user42", sort="-size", limit=10),
+        lambda r: r["user"] == "user42", "size", True),
+    "largest PDFs": (
+        dict(mime="application/pdf", sort="-size", limit=10),
+        lambda r: r["mime"] == "application/pdf", "size", True),
+}
+
+
+def make_records(count):
+    files = {}
+    for i in range(count):
+        name = f"{random.choice(DIRS)}file{i:08d}"
+        # mostly small files with a long tail
+        size = int(random.paretovariate(1.2) * 64 * 1024)
+        files[name] = {
+            "filename": name,
+            "user": random.choice(USERS),
+            "size": size,
+            "modified": NOW - random.uniform(0, 365 * DAY),
+            "mime": random.choice(MIMES),
+        }
+    return files
+
+
+def scan(files, predicate, field, reverse, limit):
+    hits = [r for r in files.values() if predicate(r)]
+    pick = heapq.nlargest if reverse else heapq.nsmallest
+    return pick(limit, hits, key=lambda r: (r[field], r["filename"]))
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--counts", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    random.seed(0)
+
+    for count in args.counts:
+        files = make_records(count)
+        idx = indexes.Indexes()
+        start = time.perf_counter()
+        for name, record in files.items():
+            idx.update(name, None, record)
+        build = time.perf_counter() - start
+        print(f"\n{count} files  (index build {build:.2f} s, {build / count * 1e6:.1f} us/record)")
+
+        for label, (query, predicate, field, reverse) in QUERIES.items():
+            indexed, got = timed(lambda: idx.query(files, **query), args.repeat)
+            scanned, want = timed(lambda: scan(files, predicate, field, reverse, query["limit"]), args.repeat)
+            assert [r["filename"] for r in got] == [r["filename"] for r in want], label
+            print(f"  {label:<36} indexed {indexed * 1e3:8.3f} ms   scan {scanned * 1e3:8.2f} ms"
+                  f"   ({len(got)} results)")
+
+
+if __name__ == "__main__":
+    main()
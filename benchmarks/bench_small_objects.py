@@ -0,0 +1,78 @@
+"""Small-object write and read ops/sec: one file per object vs the segment store.
+
+  files     ingest.IngestWriter into the fan-out tree, read back with open()/read()
+  segments  SegmentStore.put / SegmentStore.get (one pread)
+
+Object sizes are uniform in [--min-kb, --max-kb]. Reads are in random order
+and the page cache is warm for both, so this measures syscall and inode
+overhead rather than the disk. INGEST_FSYNC applies to both layouts.
+
+Run from the repo root:  python benchmarks/bench_small_objects.py --count 20000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "arch1", "storage"))
+
+import ingest  # noqa: E402
+import layout  # noqa: E402
+import segments  # noqa: E402
+
+
+def bench_files(root, payloads):
+    ids = [layout.new_object_id() for _ in payloads]
+    start = time.perf_counter()
+    for object_id, data in zip(ids, payloads):
+        writer = ingest.IngestWriter(layout.object_path(root, object_id, create=True))
+        writer.write(data)
+        writer.commit()
+    write = len(ids) / (time.perf_counter() - start)
+
+    order = random.sample(ids, len(ids))
+    start = time.perf_counter()
+    for object_id in order:
+        with open(layout.object_path(root, object_id), "rb") as f:
+            f.read()
+    read = len(ids) / (time.perf_counter() - start)
+    return write, read
+
+
+def bench_segments(root, payloads):
+    store = segments.SegmentStore(root, fsync=ingest.FSYNC != "none")
+    ids = [layout.new_object_id() for _ in payloads]
+    start = time.perf_counter()
+    for object_id, data in zip(ids, payloads):
+        store.put(object_id, data)
+    write = len(ids) / (time.perf_counter() - start)
+
+    order = random.sample(ids, len(ids))
+    start = time.perf_counter()
+    for object_id in order:
+        store.get(object_id)
+    read = len(ids) / (time.perf_counter() - start)
+    return write, read
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--min-kb", type=int, default=1)
+    parser.add_argument("--max-kb", type=int, default=64)
+    parser.add_argument("--dir", help="Parent directory for the test data (default: system temp)")
+    args = parser.parse_args()
+
+    blob = os.urandom(args.max_kb * 1024)
+    payloads = [blob[:random.randint(args.min_kb * 1024, args.max_kb * 1024)] for _ in range(args.count)]
+    print(f"{args.count} objects of {args.min_kb}-{args.max_kb} KiB, fsync={ingest.FSYNC}")
+    for name, bench in (("files", bench_files), ("segments", bench_segments)):
+        with tempfile.TemporaryDirectory(dir=args.dir) as root:
+            write, read = bench(root, payloads)
+        print(f"  {name:<9} write {write:9.0f} ops/s   read {read:9.0f} ops/s")
+
+
+if __name__ == "__main__":
+    main()